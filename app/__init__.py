@@ -57,8 +57,9 @@ if not app.debug:
 
 
 from app import app, db
-from app.models import Assignment, Course, Outcome, User, UserType
-from app.admin_models import AuthorizedAdminView, UserView, AdminView
+from app.models import Assignment, Course, Job, Outcome, User, UserType
+from app.admin_models import AuthorizedAdminView, MetricsView, UserView, AdminView
+from app import instrumentation
 from app.blueprints.home_blueprint import home_bp
 from app.blueprints.sync_blueprint import sync_bp
 from app.blueprints.courses_blueprint import courses_bp
@@ -66,6 +67,8 @@ from app.blueprints.assignments_blueprint import assignments_bp
 from app.blueprints.outcomes_blueprint import outcomes_bp
 from app.blueprints.users_blueprint import users_bp
 from app.blueprints.auth_blueprint import auth_bp
+from app.blueprints.jobs_blueprint import jobs_bp
+from app.blueprints.metrics_blueprint import metrics_bp
 
 admin = Admin(app, name='masteryhelper', template_mode='bootstrap3', index_view=AuthorizedAdminView())
 
@@ -73,11 +76,16 @@ admin = Admin(app, name='masteryhelper', template_mode='bootstrap3', index_view=
 # TODO: Better admin pages
 admin.add_view(AdminView(Assignment, db.session))
 admin.add_view(ModelView(Course, db.session))
+admin.add_view(AdminView(Job, db.session))
 admin.add_view(ModelView(Outcome, db.session))
 admin.add_view(UserView(User, db.session))
 admin.add_view(ModelView(UserType, db.session))
+admin.add_view(MetricsView(name='Metrics', endpoint='request_metrics', url='metrics'))
 admin.add_link(MenuLink(name='Back', url='/'))
 
+# Request timings and query budgets, when INSTRUMENTATION is on
+instrumentation.init_app(app)
+
 # Register routes
 app.register_blueprint(sync_bp)
 app.register_blueprint(courses_bp)
@@ -85,4 +93,6 @@ app.register_blueprint(assignments_bp)
 app.register_blueprint(outcomes_bp)
 app.register_blueprint(users_bp)
 app.register_blueprint(auth_bp)
+app.register_blueprint(jobs_bp)
+app.register_blueprint(metrics_bp)
 app.register_blueprint(home_bp)
\ No newline at end of file
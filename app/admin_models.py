@@ -1,5 +1,5 @@
 from flask import redirect, url_for
-from flask_admin import AdminIndexView
+from flask_admin import AdminIndexView, BaseView, expose
 from flask_admin.contrib.sqla import ModelView
 from flask_login import current_user
 
@@ -33,3 +33,18 @@ class UserView(AdminView):
     column_sortable_list = ('user_type', ('user_type', 'user_type.name'), 'name')
     column_searchable_list = ['name']
     column_filters = ['user_type']
+
+
+class MetricsView(BaseView):
+    """ Request timings per endpoint from app.instrumentation """
+    @expose('/')
+    def index(self):
+        from app.instrumentation import endpoint_report
+        return self.render('admin/metrics.html', rows=endpoint_report())
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.usertype_id == 1
+
+    def inaccessible_callback(self, name, **kwargs):
+        if not self.is_accessible():
+            return redirect(url_for('home_bp.index'))
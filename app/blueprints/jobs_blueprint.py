@@ -0,0 +1,8 @@
+from flask import Blueprint
+
+jobs_bp = Blueprint('jobs', __name__)
+from app.controllers.jobs import JobAPI
+
+job_view = JobAPI.as_view("job_view")
+
+jobs_bp.add_url_rule("/jobs/<int:job_id>", view_func=job_view, methods=['GET'])
@@ -0,0 +1,8 @@
+from flask import Blueprint
+
+metrics_bp = Blueprint('metrics', __name__)
+from app.controllers.metrics import MetricsAPI
+
+metrics_view = MetricsAPI.as_view("metrics_view")
+
+metrics_bp.add_url_rule("/metrics", view_func=metrics_view, methods=['GET'])
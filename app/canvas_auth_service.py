@@ -1,9 +1,150 @@
+import hashlib
+import threading
 import time
+from collections import OrderedDict
 from flask import request, session
 from canvasapi import Canvas
 from requests_oauthlib import OAuth2Session
 
 from app import app
+from app.canvas_throttle import ThrottledAdapter
+from app.metrics import registry
+
+
+class CanvasClients:
+    """ Process-wide registry of canvasapi clients keyed by base URL and token.
+
+    Each `canvasapi.Canvas` holds its own `requests` session, so building one per request
+    means a new TCP connection and TLS handshake every time. Clients are kept here instead
+    and handed back for the same token, so requests reuse kept-alive connections. Every
+    request for a token also shares its rate limit throttle (see <ThrottledAdapter>).
+
+    Tokens that haven't been used for `ttl` seconds are dropped, and the least recently used
+    token is dropped when more than `max_clients` are held. OAuth tokens are refreshed
+    hourly, so old tokens age out on their own.
+    """
+
+    def __init__(self, max_clients: int=128, ttl: float=3600, pool_size: int=10):
+        self.max_clients = max_clients
+        self.ttl = ttl
+        self.pool_size = pool_size
+
+        # (base_url, token) -> (Canvas, last used), least recently used first
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, base_url: str, token: str) -> Canvas:
+        """ Get the client for a token, creating it if needed.
+
+        Args:
+            base_url (str): Canvas URL without the /api/v1 suffix
+            token (str): API or OAuth access token
+
+        Returns:
+            Canvas: shared `canvasapi.Canvas` instance
+        """
+        key = (base_url, token)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._clients.pop(key, None)
+            if entry is not None and now - entry[1] > self.ttl:
+                self.__close(entry[0])
+                entry = None
+            self.__evict(now)
+
+            client = entry[0] if entry is not None else self.__create(base_url, token)
+            self._clients[key] = (client, now)
+
+        return client
+
+    def bucket_states(self) -> list:
+        """ Rate limit state for each token held, for metrics.
+
+        Tokens are identified by a short hash so they never show up in full.
+
+        Returns:
+            list: dict of <ThrottledAdapter> state with `base_url` and `token` added
+        """
+        with self._lock:
+            clients = list(self._clients.items())
+
+        states = []
+        for (base_url, token), (client, _) in clients:
+            adapter = client._Canvas__requester._session.get_adapter(base_url)
+            if isinstance(adapter, ThrottledAdapter):
+                states.append({
+                    "base_url": base_url,
+                    "token": hashlib.sha256(token.encode()).hexdigest()[:8],
+                    **adapter.state()
+                })
+        return states
+
+    def clear(self) -> None:
+        """ Drop every client and close its connections. """
+        with self._lock:
+            while self._clients:
+                _, (client, _) = self._clients.popitem(last=False)
+                self.__close(client)
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __evict(self, now: float) -> None:
+        # Entries are in order of last use, so stop at the first one worth keeping. One
+        # slot is left free for the client being handed out.
+        while self._clients:
+            key, (client, used) = next(iter(self._clients.items()))
+            if now - used <= self.ttl and len(self._clients) < self.max_clients:
+                break
+            del self._clients[key]
+            self.__close(client)
+
+    def __create(self, base_url: str, token: str) -> Canvas:
+        client = Canvas(base_url, token)
+
+        session = client._Canvas__requester._session
+        adapter = ThrottledAdapter(
+            max_concurrency=self.pool_size, pool_connections=self.pool_size, pool_maxsize=self.pool_size
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return client
+
+    def __close(self, client: Canvas) -> None:
+        # A request still holding the client can keep using it. The session opens new
+        # connections if it needs them.
+        client._Canvas__requester._session.close()
+
+
+clients = CanvasClients(
+    max_clients=app.config.get('CANVAS_CLIENT_MAX', 128),
+    ttl=app.config.get('CANVAS_CLIENT_TTL', 3600),
+    pool_size=app.config.get('CANVAS_CLIENT_POOL_SIZE', 10)
+)
+
+# Rate limit state per token, keyed by the <ThrottledAdapter.state> field each one reports
+bucket_gauges = {
+    "remaining": registry.gauge('canvas_rate_limit_remaining', 'Canvas rate limit quota left', ('base_url', 'token')),
+    "limit": registry.gauge('canvas_concurrency_limit', 'Canvas requests allowed at once', ('base_url', 'token')),
+    "in_flight": registry.gauge('canvas_requests_in_flight', 'Canvas requests running', ('base_url', 'token')),
+}
+
+
+@registry.collector
+def collect_bucket_states() -> None:
+    """ Copy the rate limit state of each held client into <bucket_gauges>. Tokens that have
+    been dropped disappear, and quota is left out until Canvas has reported it.
+    """
+    states = clients.bucket_states()
+    for gauge in bucket_gauges.values():
+        gauge.clear()
+    for state in states:
+        for field, gauge in bucket_gauges.items():
+            if state[field] is not None:
+                gauge.set(state[field], base_url=state["base_url"], token=state["token"])
+
 
 class CanvasAuthService:
     """ Handle authentication through Canvas OAuth. Fall back to scoped
@@ -24,8 +165,8 @@ class CanvasAuthService:
         "url:GET|/api/v1/courses/:course_id/outcome_results",
         "url:GET|/api/v1/outcomes/:id",
         "url:GET|/api/v1/courses/:course_id/assignments/:assignment_id/submissions",
-        "url:GET|/api/v1/courses/:course_id/assignments/:assignment_id/submissions/:user_id",
-        "url:PUT|/api/v1/courses/:course_id/assignments/:assignment_id/submissions/:user_id"
+        "url:POST|/api/v1/courses/:course_id/assignments/:assignment_id/submissions/update_grades",
+        "url:GET|/api/v1/progress/:id"
     ]
 
     scope = " ".join(scope_list)
@@ -39,7 +180,7 @@ class CanvasAuthService:
 
     def init_canvas(self):
         if self.mode == 'server_only':
-            return Canvas(app.config['CANVAS_URI'], app.config['CANVAS_KEY'])
+            return clients.get(app.config['CANVAS_URI'], app.config['CANVAS_KEY'])
         else:
             expire = session['oauth_token']['expires_at']
 
@@ -63,7 +204,7 @@ class CanvasAuthService:
 
             # canvaspi throws an error if you include the /api/v1 suffix. Pass in
             # a short URL to instantiate.
-        return Canvas(app.config['CANVAS_OAUTH']['base_url_short'], session['oauth_token']['access_token'])
+        return clients.get(app.config['CANVAS_OAUTH']['base_url_short'], session['oauth_token']['access_token'])
 
     def login(self):
         return self.oauth.authorization_url(app.config['CANVAS_OAUTH']['authorization_url'])
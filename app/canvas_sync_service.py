@@ -2,13 +2,25 @@ from flask import session
 from flask_login import current_user
 from canvasapi import Canvas
 from canvasapi.course import Course
-from typing import List
+from typing import Iterable, Iterator, List
 
 from app import app, db
-from app.models import Assignment, Course, Outcome, User
+from app.models import Assignment, Course, Outcome, User, user_courses
 from app.errors import deprecation
 from app.canvas_auth_service import CanvasAuthService
+from app.canvas_pager import iterate_pages
+from app.canvas_throttle import ThrottledAdapter
+from app.metrics import registry
+from app.util import canvas_score, chunked, insert_ignore, parse_canvas_datetime
 
+attempts_total = registry.counter('sync_attempts_total', 'Outcome results read and stored', ('course', 'status'))
+attempts_skipped = registry.counter('sync_attempts_skipped_total', 'Outcome results not stored', ('course', 'reason'))
+courses_synced = registry.counter('sync_courses_total', 'Courses synced by flask sync', ('result',))
+grade_posts = registry.counter('grade_posts_total', 'Student grades posted to Canvas', ('result',))
+sync_phase_seconds = registry.histogram(
+    'sync_phase_seconds', 'Time spent on each part of a course sync', ('phase',),
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
 
 
 class CanvasSyncService:
@@ -25,12 +37,49 @@ class CanvasSyncService:
     resources are all checked before committing to memory.
     """
 
+    # Number of Canvas results checked against the database at a time
+    chunk_size = 500
+
+    # Most pages of a Canvas list requested at once
+    page_workers = 4
+
+    # Seconds between checks on a bulk grade update, and how long to wait before giving up
+    progress_interval = 1
+    progress_timeout = 60
+
     # TODO: Set current user param on Sync object to cut down on passing IDs around
     # TODO: Initialize Canvas API tokens with the Auth module
     def __init__(self: None, mode=None) -> None:
         # self.canvas = Canvas(Config.CANVAS_URI, Config.CANVAS_KEY)
         self.canvas = CanvasAuthService(mode).init_canvas()
 
+    def set_connection_pool_size(self: None, size: int) -> None:
+        """ Size the HTTP connection pool for the Canvas client.
+
+        canvasapi sends every request through one `requests` session. When the service is
+        shared between threads, the pool needs a connection for each thread or extra
+        connections are opened and thrown away. The rate limit throttle is allowed up to
+        the same number of requests at once.
+
+        Args:
+            size (int): Number of connections to keep open
+        """
+        session = self.canvas._Canvas__requester._session
+        adapter = ThrottledAdapter(max_concurrency=size, pool_connections=size, pool_maxsize=size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def paginate(self: None, paginated: Iterable) -> Iterator:
+        """ Iterate a canvasapi list, requesting up to `page_workers` pages at once.
+
+        Args:
+            paginated (Iterable): `PaginatedList` returned by canvasapi
+
+        Returns:
+            Iterator: elements in the order Canvas returns them
+        """
+        return iterate_pages(paginated, self.page_workers)
+
     def get_courses(self: None, enrollment_type: str='teacher', state: str='active') -> List[Course]:
         """ Fetch all courses from Canvas. Calls `canvasapi.Canvas.get_courses()`.
 
@@ -41,7 +90,9 @@ class CanvasSyncService:
         Returns:
             List[Course]: List of <Course>
         """
-        return self.canvas.get_courses(enrollment_type=enrollment_type, enrollment_state=state, include='term')
+        return self.paginate(
+            self.canvas.get_courses(enrollment_type=enrollment_type, enrollment_state=state, include='term')
+        )
     
     def get_course(self: None, course_id: int) -> Course:
         """ Fetch a single course from Canvas. Most resources are course-bound, so this provides
@@ -69,7 +120,7 @@ class CanvasSyncService:
         Returns:
             list: list of dict
         """
-        request = self.canvas.get_course(course_id).get_all_outcome_links_in_context()
+        request = self.paginate(self.canvas.get_course(course_id).get_all_outcome_links_in_context())
         
         # We don't need full Outcome objects to do the work, so pare the results down into
         # smaller dicts.
@@ -103,17 +154,30 @@ class CanvasSyncService:
         
         return outcome
 
-    def get_outcome_attempts(self: None, course_id: int, outcome_ids: list=None, user_id: int=None, ) -> None:
+    def get_outcome_attempts(self: None, course_id: int, outcome_ids: list=None, user_id: int=None, full: bool=False) -> None:
         """ 
         Sync all attempts on an outcome for a student. This requests results for all students in a course. Each
         attempt has a unique ID already assigned. If it exists in the database, move on.
 
+        The local <Course> keeps the latest `submitted_or_assessed_at` of the results it has stored in
+        `results_synced_at`. When every outcome in the course is synced, results dated more than
+        RESULTS_SYNC_LOOKBACK_DAYS before that are skipped before any database work is done. The window
+        is there because `submitted_or_assessed_at` is the submission time when there is one, so a
+        teacher grading an old submission produces a result dated before the last sync. Results older
+        than the window are only picked up by a `full` sync. Canvas can't filter results by date, so
+        every page is still read.
+
+        Results from students who aren't enrolled locally don't move the watermark, so they're read
+        again once the student is enrolled. Stored results are found with one lookup per chunk and
+        left out of the insert.
+
         This operations writes outcome attempts to persistent storage.
         
         Args:
             course_id (int): Canvas course ID.
             user_id (int): Canvas user ID.
             outcome_id ([int], optional): Limit results to a single outcome result. Defaults to None.
+            full (bool, optional): Ignore the course watermark and process every result. Defaults to False.
 
         Returns:
             None
@@ -141,11 +205,20 @@ class CanvasSyncService:
         }
 
         """
-        from datetime import datetime
+        from datetime import datetime, timedelta
         from app.models import Course, OutcomeAttempt
+        from app.score_service import record_outcome_attempts
+
+        course = Course.query.filter(Course.canvas_id == course_id).first()
 
-        # Track how many attempts are added to the DB
-        count = 0
+        # The watermark is only valid when results for every outcome in the course are read.
+        course_outcome_ids = {outcome.canvas_id for outcome in course.outcomes}
+        syncs_all_outcomes = outcome_ids is None or course_outcome_ids.issubset(outcome_ids)
+        latest = course.results_synced_at if syncs_all_outcomes else None
+
+        since = None
+        if latest is not None and not full:
+            since = latest - timedelta(days=app.config.get('RESULTS_SYNC_LOOKBACK_DAYS', 30))
 
         # Outcome results are stored at the Course context, which is why the course needs
         # to be loaded first.
@@ -154,44 +227,120 @@ class CanvasSyncService:
         # This is run when a single outcome is imported from the sync service.
         # This process relies on a modded version of canvasapi stored _locally_
         # which returns results in a PaginatedList.
-        
-        results = canvas_course.get_outcome_results(outcome_ids=outcome_ids)
-
-        # Put new results into an array for a single db write.
-        attempts = []
-
-        # results is a flat array that can be iterated directly.
-        for attempt in results:
-
-            # Prevent FK exceptions if the outcome doesn't exist
-
-            attempt_exists = OutcomeAttempt.query.filter(OutcomeAttempt.attempt_canvas_id == attempt.id).scalar()
-            user_exists = User.query.filter(User.canvas_id == attempt.links['user']).first()
-
-            # Only store attempts with a score. This can happen when a teacher scores a rubric 
-            # and then removes that rubric score for some reason.
-            if attempt.score is not None and attempt_exists is None and user_exists is not None:
-                # Convert the datetime string into a Python DateTime object
-                dt = datetime.strptime(attempt.submitted_or_assessed_at[:-1], "%Y-%m-%dT%H:%M:%S")
-                attempts.append(
-                    OutcomeAttempt(
-                        user_canvas_id=int(attempt.links['user']),
-                        outcome_canvas_id=int(attempt.links['learning_outcome']),
-                        attempt_canvas_id=attempt.id,
-                        success=attempt.mastery,
-                        score=attempt.score,
-                        occurred=dt
+        results = self.paginate(canvas_course.get_outcome_results(outcome_ids=outcome_ids))
+
+        fetched = 0
+        stored = 0
+        unscored = 0
+        duplicates = 0
+        unknown_users = 0
+        older = 0
+
+        # results is a flat array that can be iterated directly. It's read in chunks so each
+        # chunk can be checked for unknown users with one query, written with a Core insert
+        # and committed before the next chunk is read. Memory stays flat no matter
+        # how big the course is, and chunks already committed survive a failed sync.
+        try:
+            for chunk in chunked(results, self.chunk_size):
+                fresh = []
+                for attempt in chunk:
+                    fetched += 1
+
+                    # Only store attempts with a score. This can happen when a teacher scores a rubric 
+                    # and then removes that rubric score for some reason.
+                    if attempt.score is None:
+                        unscored += 1
+                        continue
+
+                    # Stored datetimes are naive UTC, like the DATETIME columns they go into
+                    dt = parse_canvas_datetime(attempt.submitted_or_assessed_at).replace(tzinfo=None)
+
+                    if since is not None and dt < since:
+                        older += 1
+                        continue
+
+                    fresh.append((attempt, dt))
+
+                if not fresh:
+                    continue
+
+                user_ids = {int(attempt.links['user']) for attempt, _ in fresh}
+                known_users = {
+                    row.canvas_id for row in db.session.query(User.canvas_id).filter(User.canvas_id.in_(user_ids))
+                }
+
+                rows = []
+                for attempt, dt in fresh:
+                    # Prevent FK exceptions if the user doesn't exist
+                    if int(attempt.links['user']) not in known_users:
+                        unknown_users += 1
+                        continue
+
+                    rows.append({
+                        "user_canvas_id": int(attempt.links['user']),
+                        "outcome_canvas_id": int(attempt.links['learning_outcome']),
+                        "attempt_canvas_id": attempt.id,
+                        "success": attempt.mastery,
+                        "score": canvas_score(attempt.score),
+                        "occurred": dt
+                    })
+
+                if not rows:
+                    continue
+
+                # One lookup per chunk finds the attempts already stored, so exactly the new ones
+                # are inserted and folded into the materialized scores.
+                stored_ids = {
+                    attempt_canvas_id for attempt_canvas_id, in db.session.query(OutcomeAttempt.attempt_canvas_id).filter(
+                        OutcomeAttempt.attempt_canvas_id.in_([row["attempt_canvas_id"] for row in rows])
                     )
-                )
+                }
+                new_rows = [row for row in rows if row["attempt_canvas_id"] not in stored_ids]
+
+                # Another sync of the same course can store some of them between the lookup and
+                # the insert, so the unique key on attempt_canvas_id still skips duplicates.
+                inserted = insert_ignore(OutcomeAttempt, new_rows) if new_rows else 0
+                duplicates += len(rows) - inserted
+
+                # Every row is stored now, either by this insert or an earlier sync.
+                chunk_latest = max(row["occurred"] for row in rows)
+                if latest is None or chunk_latest > latest:
+                    latest = chunk_latest
+
+                # Keep the materialized scores current in the same transaction. If another sync
+                # got to some of the new rows first there's no telling which, so those pairs are
+                # rebuilt instead.
+                if inserted:
+                    record_outcome_attempts(new_rows, rebuild=inserted < len(new_rows))
+                    course.updated_at = datetime.now()
+                    course.bump_version()
 
-        if len(attempts) > 0:
-            db.session.add_all(attempts)
-            canvas_course.updated_at = datetime.now()
-            db.session.commit()
-            
-            result = f"Stored {len(attempts)} new attempts."
+                db.session.commit()
+                stored += inserted
+        finally:
+            # Counted even when the sync fails part way, so the run summary shows how far it got.
+            course_label = str(course_id)
+            attempts_total.inc(fetched, course=course_label, status='fetched')
+            attempts_total.inc(stored, course=course_label, status='stored')
+            for reason, count in (('unscored', unscored), ('older', older), ('duplicate', duplicates), ('unknown_user', unknown_users)):
+                attempts_skipped.inc(count, course=course_label, reason=reason)
+
+        if stored > 0:
+            result = f"Stored {stored} new attempts."
         else: 
             result = "There were no new Outcome attempts."
+
+        # The watermark only moves once every chunk is stored. If the sync fails part way,
+        # the next sync reads the same results again and skips the ones already stored.
+        if syncs_all_outcomes:
+            course.results_synced_at = latest
+
+        db.session.commit()
+
+        app.logger.info(
+            f"Course {course_id}: stored {stored}, skipped {older} older than {since}, "
+            f"{duplicates} duplicates and {unknown_users} from unknown users."
+        )
         
         return result
 
@@ -205,7 +354,7 @@ class CanvasSyncService:
         Returns:
             List[Assignment]: List of <Assignment>
         """
-        assignments = self.canvas.get_course(course_id).get_assignments()
+        assignments = self.paginate(self.canvas.get_course(course_id).get_assignments())
         return assignments
 
     def get_assignment(self: None, course_id: int, assignment_id: int) -> None:
@@ -223,81 +372,170 @@ class CanvasSyncService:
         return assignment
     
     def get_enrollments(self: None, course_id: int) -> Course:
-        """ Get all enrollments for a course. 
+        """ Reconcile a course's students with its active Canvas student enrollments.
+
+        This stores all students in a course when it is added by the user for tracking, and
+        runs again in the nightly sync so later adds and drops are picked up. Students are
+        added as users via their Canvas ID. The local enrollments are compared with Canvas by
+        user ID, so a course that hasn't changed costs one query and no writes.
 
-        This method stores all users in a course when it is added by the user for tracking.
-        Students are added as users via their Canvas ID.
+        Only students are removed. Teachers are enrolled locally when they add the course and
+        don't show up in the Canvas student list. Nobody is removed when Canvas returns no
+        active students, since concluded courses list none and their gradebooks should stay.
 
         Args:
             course_id (int): Canvas course ID
 
         Returns:
-            List[User]: List of Users to append to the course.
+            Course: the updated <Course>
         """
-        users = []
-
         canvas_course = self.canvas.get_course(course_id)
-        enrollments = canvas_course.get_enrollments(
+        enrollments = self.paginate(canvas_course.get_enrollments(
             type='StudentEnrollment',
             state='active'
-        )
-        
-        # This is a poor way to get new users added to the database _and_ associated 
-        # with the course. Right now, this saves multiple database commits after each
-        # record is created. It might not be making any performance difference.
-        for enrollment in enrollments:
-            user_exists = User.query.filter(User.canvas_id == enrollment.user_id).first()
-            if not user_exists:
-                user = User(
-                    canvas_id=enrollment.user_id, 
-                    name=enrollment.user['sortable_name'], 
-                    usertype_id=3,
-                )
-                db.session.add(user)
-                db.session.commit()
+        ))
 
-                users.append(user)
-            else:
-                users.append(user_exists)
+        # A student in more than one section has an enrollment for each, so key by user.
+        names = {}
+        for enrollment in enrollments:
+            names.setdefault(enrollment.user_id, enrollment.user['sortable_name'])
 
         course = Course.query.filter(Course.canvas_id == course_id).first()
-        course.enrollments.extend(users)
-        
+
+        enrolled = db.session.query(User.id, User.canvas_id, User.usertype_id).join(
+            user_courses, user_courses.c.user_id == User.id
+        ).filter(user_courses.c.course_id == course.id).all()
+        enrolled_canvas_ids = {row.canvas_id for row in enrolled}
+
+        added = [canvas_id for canvas_id in names if canvas_id not in enrolled_canvas_ids]
+        removed = list({row.id for row in enrolled if row.usertype_id == 3 and row.canvas_id not in names})
+
+        if removed and not names:
+            app.logger.warning(f"Course {course_id}: Canvas listed no active students, keeping {len(removed)} enrolled.")
+            removed = []
+
+        # Everything below is one transaction: an IN query for the users we already have,
+        # one insert for the new students, one for their enrollments and one delete per 500
+        # dropped students.
+        if added:
+            user_ids = self.__get_user_ids(added)
+
+            missing_users = [
+                {"canvas_id": canvas_id, "name": names[canvas_id], "usertype_id": 3}
+                for canvas_id in added if canvas_id not in user_ids
+            ]
+            if missing_users:
+                # Another request could add the same student first, so duplicates are skipped
+                # and the IDs are read back afterwards.
+                insert_ignore(User, missing_users)
+                user_ids.update(self.__get_user_ids([user["canvas_id"] for user in missing_users]))
+
+            # A result sync job can enroll the same students at the same time, so existing
+            # enrollments are skipped.
+            insert_ignore(user_courses, [
+                {"course_id": course.id, "user_id": user_ids[canvas_id]} for canvas_id in added
+            ])
+
+        for chunk in chunked(removed, 500):
+            db.session.execute(user_courses.delete().where(
+                user_courses.c.course_id == course.id,
+                user_courses.c.user_id.in_(chunk)
+            ))
+
+        if added or removed:
+            course.bump_version()
+
         db.session.commit()
 
+        app.logger.info(f"Course {course_id}: enrolled {len(added)} and removed {len(removed)} students.")
+
         # Return the updated <Course> because it includes all information.
         return course
-    
-    def post_all_assignment_submissions(self: None, course: Course):
+
+    def __get_user_ids(self: None, canvas_ids: Iterable[int]) -> dict:
+        """ Map Canvas user IDs to stored <User> IDs for the users that exist. """
+        user_ids = {}
+        for chunk in chunked(canvas_ids, 500):
+            user_ids.update(
+                db.session.query(User.canvas_id, User.id).filter(User.canvas_id.in_(chunk)).all()
+            )
+        return user_ids
+
+    def post_all_assignment_submissions(self: None, course: Course) -> List[dict]:
         """ Post all assignment scores for a saved course
 
         Args:
             course (Course): <Course>
+
+        Returns:
+            List[dict]: The result of each posted assignment
         """
-        # Loop over all assignments stored in the course
-        for local_assignment in course.assignments:
-            
-            # pass each local_assignment into post_assignment_submission
-            self.post_assignment_submission(local_assignment)
+        # Loop over all assignments stored in the course. Each assignment is a single bulk update.
+        return [
+            self.post_assignment_submission(local_assignment) for local_assignment in course.assignments
+        ]
 
-    def post_assignment_submission(self: None, assignment: Assignment):
+    def post_assignment_submission(self: None, assignment: Assignment) -> dict:
         """ Post a score for all students in an assignment back to the course gradebook
 
+        Only students whose score differs from the last posted score are included. Those scores are
+        sent in one request to the `submissions/update_grades` endpoint. Canvas applies them in a
+        background job, so the returned <Progress> is polled until the job finishes. If the job fails, every student in the grade map is reported as failed.
+
         Args:
             assignment (Assignment): <Assignment>
 
+        Returns:
+            dict: assignment_id, number of grades posted, a list of failed user IDs and the Canvas message
         """
+        import time
+        from datetime import datetime
+
+        # Only scores that changed since they were last posted are sent to Canvas.
+        changed = [
+            assignment_attempt for assignment_attempt in assignment.student_attempts if assignment_attempt.is_dirty
+        ]
+
+        # Build one grade map for the whole assignment, keyed by the student's Canvas ID.
+        grade_data = {
+            str(assignment_attempt.user_id): {"posted_grade": assignment_attempt.score}
+            for assignment_attempt in changed
+        }
+
+        result = {"assignment_id": assignment.canvas_id, "posted": 0, "failed": [], "message": None}
+        if not grade_data:
+            return result
+
         course = self.canvas.get_course(assignment.course[0].canvas_id)
         canvas_assignment = course.get_assignment(assignment.canvas_id)
 
-        # This loops all student records for a given assignment and puts an update into Canvas for that student.
-        # TODO: May be more economical to do a bulk submit for each user. Build a list to submit and pass it to the bulk
-        # update endpoint?
-        for assignment_attempt in assignment.student_attempts:
-            student_submission = canvas_assignment.get_submission(assignment_attempt.user_id)
+        app.logger.info('Posting {} grades for {}'.format(len(grade_data), assignment.name))
+        progress = canvas_assignment.submissions_bulk_update(grade_data=grade_data)
+
+        # Canvas queues the update, so wait for the job to finish before reporting back.
+        waited = 0
+        while progress.workflow_state in ('queued', 'running') and waited < self.progress_timeout:
+            time.sleep(self.progress_interval)
+            waited += self.progress_interval
+            progress = progress.query()
+
+        result["message"] = getattr(progress, 'message', None)
 
-            app.logger.info('Posting {} for {}'.format(assignment_attempt.score, student_submission.user_id))
-            response = student_submission.edit(submission={"posted_grade": assignment_attempt.score})
+        if progress.workflow_state == 'completed':
+            result["posted"] = len(grade_data)
+            grade_posts.inc(len(grade_data), result='succeeded')
 
-            app.logger.info('Score submission finished')
-        return
\ No newline at end of file
+            posted_at = datetime.now()
+            for assignment_attempt in changed:
+                assignment_attempt.posted_score = assignment_attempt.score
+                assignment_attempt.posted_at = posted_at
+            db.session.commit()
+        else:
+            result["failed"] = [int(user_id) for user_id in grade_data]
+            grade_posts.inc(len(grade_data), result='failed')
+            app.logger.error('Posting grades for {} ended as {}: {}'.format(
+                assignment.name, progress.workflow_state, result["message"]
+            ))
+
+        app.logger.info('Score submission finished')
+        return result
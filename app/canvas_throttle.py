@@ -0,0 +1,135 @@
+import random
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from app import app
+from app.instrumentation import record_canvas_call
+from app.metrics import registry
+
+"""
+Canvas gives each token a leaky bucket of request quota. Every response reports what is left in
+`X-Rate-Limit-Remaining`, and once the bucket is empty requests fail with
+`403 Forbidden (Rate Limit Exceeded)` until it drains.
+
+`ThrottledAdapter` sits under the `requests` session of a Canvas client, so everything canvasapi
+sends for that token goes through it. It limits how many requests run at once and adjusts the
+limit from the headers: the limit grows slowly while the bucket is healthy and is halved when it
+runs low (AIMD). Throttled requests are retried after a jittered exponential backoff, so a sync
+or grade post slows down instead of failing part way through.
+"""
+
+request_seconds = registry.histogram('canvas_request_seconds', 'Canvas API request latency', ('method', 'status'))
+throttled_total = registry.counter('canvas_requests_throttled_total', 'Canvas requests refused by the rate limit')
+
+
+class ThrottledAdapter(HTTPAdapter):
+    # Remaining quota below which concurrency is cut. Canvas buckets hold 700 by default.
+    low_water = 150
+
+    # Retries for a throttled request, and the backoff bounds in seconds
+    max_retries_throttled = 5
+    backoff_base = 0.5
+    backoff_cap = 30
+
+    # Seconds between cuts, so a burst of low responses only counts once
+    decrease_interval = 1
+
+    def __init__(self, max_concurrency: int=10, **kwargs):
+        super().__init__(**kwargs)
+        self.max_concurrency = max_concurrency
+
+        self._condition = threading.Condition()
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self._last_decrease = 0
+
+        self.remaining = None
+        self.requests = 0
+        self.throttled = 0
+
+    @property
+    def limit(self) -> int:
+        """ Requests allowed at once right now """
+        return max(1, int(self._limit))
+
+    def state(self) -> dict:
+        """ Current bucket and concurrency state for metrics. """
+        with self._condition:
+            return {
+                "remaining": self.remaining,
+                "limit": self.limit,
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self._in_flight,
+                "requests": self.requests,
+                "throttled": self.throttled,
+            }
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            self.__acquire()
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                response = super().send(request, **kwargs)
+                status = response.status_code
+            finally:
+                self.__release()
+                elapsed = time.perf_counter() - start
+                record_canvas_call(elapsed)
+                request_seconds.observe(elapsed, method=request.method, status=status)
+
+            throttled = self.__record(response)
+            if throttled:
+                throttled_total.inc()
+            if not throttled or attempt >= self.max_retries_throttled:
+                return response
+
+            # Full jitter keeps threads that were throttled together from retrying together.
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+            app.logger.warning('Canvas rate limit hit, retrying {} {} in {:.1f}s'.format(
+                request.method, request.path_url.split('?')[0], delay
+            ))
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def __acquire(self) -> None:
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def __release(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def __record(self, response) -> bool:
+        """ Update the bucket state from a response. Returns True when it was throttled. """
+        throttled = response.status_code == 403 and b'Rate Limit Exceeded' in response.content
+
+        remaining = response.headers.get('X-Rate-Limit-Remaining')
+
+        with self._condition:
+            self.requests += 1
+            if remaining is not None:
+                try:
+                    self.remaining = float(remaining)
+                except ValueError:
+                    pass
+
+            if throttled or (self.remaining is not None and self.remaining < self.low_water):
+                self.throttled += throttled
+                now = time.monotonic()
+                if throttled or now - self._last_decrease >= self.decrease_interval:
+                    self._limit = max(1.0, self._limit / 2)
+                    self._last_decrease = now
+            else:
+                # About one more request at a time for each round of responses
+                self._limit = min(float(self.max_concurrency), self._limit + 1 / self._limit)
+                self._condition.notify_all()
+
+        return throttled
@@ -10,16 +10,10 @@ from app import app, db
 from app.errors import DuplicateException
 from app.models import Assignment, Manager
 from app.schemas import AssignmentSchema, CourseSchema, CreateAssignmentSchema
+from app.util import restricted
 
 
 class AssignmentListAPI(MethodView):
-
-    # TODO: These aren't necessary for every operation. Can loading of these values be put off
-    # until they're needed by a function?
-    def __init__(self):
-        self.calculation_method = current_user.preferences.score_calculation_method.name
-        self.mastery_score = current_user.preferences.mastery_score
-    
     # only return assignments for the current course.
     # This isn't necessary for anything in the application. Assignments linked to a course are returned 
     # from CourseAssignmentsAPI now. 
@@ -69,81 +63,37 @@ class AssignmentListAPI(MethodView):
         
         return jsonify({"message": "Import successful"}), 200
     
+    @restricted()
     def put(self: None, course_id: int) -> List[Assignment]:
-        """ Update student scores for all assignments stored in the course
+        """ Queue a job to update student scores for all assignments stored in the course and
+        post them to Canvas. The job runs in `flask worker`.
+
+        The worker posts with the server token, so Canvas can't check the user's permissions.
+        Only users enrolled in the course can queue it.
 
         Args:
             course_id (int): Canvas course ID
 
         Returns:
-            List[Assignment]: List of UserAssignment
+            Job: the queued <Job>
         """
-        from datetime import datetime
-        from app.models import Course, User, UserAssignment
-        from app.canvas_sync_service import CanvasSyncService
-
-        service = CanvasSyncService()
+        from app.models import Course
+        from app.controllers.jobs import job_response
+        from app.job_service import enqueue
 
         course = Course.query.filter(Course.canvas_id == course_id).first()
         if course is None:
             abort(404)
-        
-        assignments = course.assignments
-        students = course.enrollments.filter(User.usertype_id == 3).all()
-
-        for assignment in assignments:
-            if assignment.watching is not None:
-                app.logger.info('Assignment {} is aligned to outcome {}'.format(assignment.name, assignment.watching.name))
-                for student in students:
-                    student_score = getattr(assignment.watching, self.calculation_method)(student.canvas_id)
-                    app.logger.info('{} has {} on {}'.format(student.name, student_score, assignment.watching.name))
-                    
-                    if student_score is not None:
-                        if student_score >= self.mastery_score:
-                            score = assignment.points_possible
-                        else:
-                            score = 0
-                    else:
-                        score = 0
-
-                    # Find the current assignment record for the student
-                    user_assignment = UserAssignment.query.filter_by(
-                        user_id=student.canvas_id, 
-                        assignment_id=assignment.canvas_id
-                    ).first()
-
-                    if user_assignment is None:
-                        student_record = UserAssignment(
-                            assignment_id=assignment.canvas_id,
-                            user_id=student.canvas_id,
-                            score=score,
-                            occurred=datetime.now()
-                        )
-                        db.session.add(student_record)
-                    else:
-                        user_assignment.score = score
-                        user_assignment.occurred = datetime.now()
-                        db.session.add(user_assignment)
-                    
-                    db.session.commit()
-        
-        service.post_all_assignment_submissions(course)
+        if not current_user.is_enrolled(course):
+            abort(403)
 
-        return jsonify({'message': 'All student scores updated'})
-        # request = service.post_assignment_submission(
-        #     course.canvas_id, 
-        #     outcome.alignment.canvas_id, 
-        #     student.canvas_id, 
-        #     1
-        # )
+        job = enqueue('post_grades', current_user, course_id=course.canvas_id)
+
+        return job_response(job, 'Posting all grades to Canvas')
 
        
 
 class AssignmentAPI(MethodView):
-    def __init__(self):
-        self.calculation_method = current_user.preferences.score_calculation_method.name
-        self.mastery_score = current_user.preferences.mastery_score
-    
     def get(self: None, assignment_canvas_id: int) -> Assignment:
         """ Get a single assignment
 
@@ -160,71 +110,31 @@ class AssignmentAPI(MethodView):
         
         return AssignmentSchema().dump(assignment)
 
+    @restricted()
     def put(self: None, assignment_canvas_id: int) -> Assignment:
-        """ Update scores for a single assignment
+        """ Queue a job to update scores for a single assignment and post them to Canvas.
+        Only users enrolled in the assignment's course can queue it.
 
         Args:
             assignment_id (int): Assignment Canvas ID
 
         Returns:
-            Assignment: Updated Assignment
+            Job: the queued <Job>
         """
-        from datetime import datetime
-        from app.models import User, UserAssignment
-        from app.canvas_sync_service import CanvasSyncService
+        from app.controllers.jobs import job_response
+        from app.job_service import enqueue
 
-        service = CanvasSyncService()
         assignment = Assignment.query.filter(Assignment.canvas_id == assignment_canvas_id).first()
         if assignment is None:
             abort(404)
-        
-        students = assignment.course[0].enrollments.filter(User.usertype_id == 3).all()
-
-        # TODO: This is exactly the same as the AssignmentListAPI method above.
-        # Inherit from a base class?
-        if assignment.watching is not None:
-            app.logger.info('Assignment {} is aligned to outcome {}'.format(assignment.name, assignment.watching.name))
-            for student in students:
-
-                # Get the student's current score on the Outcome
-                student_score = getattr(assignment.watching, self.calculation_method)(student.canvas_id)
-                app.logger.info('{} has {} on {}'.format(student.name, student_score, assignment.watching.name))
-                
-                # Check the score against the cutoff score for the teacher.
-                if student_score is not None:
-                    if student_score >= self.mastery_score:
-                        # TODO: Set to all or nothing now, _could_ be set to the Outcome calculated score with a toggle.
-                        # Add a preference to post all/nothing or the outcome score
-                        score = assignment.points_possible
-                    else:
-                        score = 0
-                else:
-                    score = 0
-
-                # Find the current assignment record for the student
-                user_assignment = UserAssignment.query.filter_by(
-                    user_id=student.canvas_id, 
-                    assignment_id=assignment.canvas_id
-                ).first()
-
-                if user_assignment is None:
-                    student_record = UserAssignment(
-                        assignment_id=assignment.canvas_id,
-                        user_id=student.canvas_id,
-                        score=score,
-                        occurred=datetime.now()
-                    )
-                    db.session.add(student_record)
-                else:
-                    user_assignment.score = score
-                    user_assignment.occurred = datetime.now()
-                    db.session.add(user_assignment)
-                
-                db.session.commit()
-        
-        # Pass the entire assignment object to the function because it relies on
-        # relationships and properties to build the Canvas API object
-        service.post_assignment_submission(assignment)
-        
-        return jsonify({'message': 'Posted scores for {}'.format(assignment.watching)})
+        if not current_user.is_enrolled(assignment.course[0]):
+            abort(403)
+
+        job = enqueue(
+            'post_grades',
+            current_user,
+            course_id=assignment.course[0].canvas_id,
+            assignment_id=assignment.canvas_id
+        )
 
+        return job_response(job, 'Posting grades for {}'.format(assignment.watching))
@@ -1,14 +1,20 @@
 from flask import abort, jsonify, request, render_template
+from markupsafe import Markup
 from flask_login import current_user
 from flask.views import MethodView
 from typing import List
 from webargs import fields
 from webargs.flaskparser import parser
 
-from app import db
-from app.models import Assignment, Course, Manager, Outcome
+from app import app, db
+from app.models import Assignment, Course, Manager, Outcome, course_outcomes
 from app.schemas import CourseSchema, OutcomeListSchema
-from app.util import restricted
+from app.util import LRUCache, make_etag, not_modified, restricted, with_etag
+
+# Rendered teacher gradebooks, keyed by course, score preferences and <Course>.version. Any
+# write that changes what the gradebook shows bumps the version, so stale entries are never
+# read again and age out of the cache.
+gradebook_cache = LRUCache(app.config.get('GRADEBOOK_CACHE_SIZE', 256))
 
 
 class CourseListAPI(MethodView):
@@ -18,7 +24,7 @@ class CourseListAPI(MethodView):
         Returns:
             List[Course]: List of <Course>
         """
-        courses = current_user.enrollments.all()
+        courses = current_user.enrollments.options(*Course.gradebook_options(students=False)).all()
 
         return render_template(
             'shared/partials/sidebar.html',
@@ -75,6 +81,7 @@ class CourseAPI(MethodView):
             Course: Instance of <Course>
         """
         from app.models import User
+        from app.score_service import ScoreService
 
         course = Course.query.filter(Course.canvas_id == course_canvas_id).first()
         
@@ -84,46 +91,77 @@ class CourseAPI(MethodView):
         # process data for a single student
         if current_user.usertype_id == 3:
             template = "course/student_index.html"
+
+            # The version changes with the teacher's preferences as well as the course data.
+            etag = make_etag(course.id, course.version, current_user.id, template)
+            cached = not_modified(etag)
+            if cached is not None:
+                return cached
             
             teacher = course.enrollments.filter(User.usertype_id == 2).first()
 
-            outcomes = course.outcomes.all()
+            course = Course.with_gradebook(students=False).filter(Course.id == course.id).first()
+            outcomes = course.outcome_list
+
+            scores = ScoreService(course, students=[current_user], outcomes=outcomes).get_scores(
+                teacher.preferences.score_calculation_method
+            )[current_user.canvas_id]
 
             for outcome in outcomes:
-                user_score = getattr(outcome, teacher.preferences.score_calculation_method.name)(current_user.canvas_id)
-                outcome.score = user_score
+                outcome.score = scores[outcome.canvas_id]
             
-            return render_template(
+            return with_etag(render_template(
                 template,
                 course=CourseSchema().dump(course), outcomes=outcomes
-            )
+            ), etag)
         else:
             if request.headers.get('HX-Request'):
                 template = "course/teacher_index_htmx.html"
             else:
                 template = "course/teacher_index_full.html"
 
-            students = course.enrollments.filter(User.usertype_id == 3).all()
-
-            # Aggregate all student scores into the course object.
-            for user in students:
-                user.scores = []
-                for outcome in course.outcomes.all():
-                    user_score = getattr(outcome, current_user.preferences.score_calculation_method.name)(user.canvas_id)
-                    user.scores.append({
-                        "outcome_canvas_id": outcome.canvas_id,
-                        "score": user_score
-                    })
-                
-            # Check that the outcomes returned in the course have an alignment. If none do,
-            # disable the "post grades" button.
-            has_alignment = any(o.alignment for o in course.outcomes.all())
-            return render_template(
-                template, 
-                course=CourseSchema().dump(course), 
-                students=students,
-                has_alignment=has_alignment
+            preferences = current_user.preferences
+            key = (
+                course.id,
+                preferences.score_calculation_method,
+                preferences.mastery_score,
+                course.version,
+                template
             )
+
+            etag = make_etag(current_user.id, *key)
+            cached = not_modified(etag)
+            if cached is not None:
+                return cached
+
+            gradebook = gradebook_cache.get(key)
+            if gradebook is None:
+                course = Course.with_gradebook().filter(Course.id == course.id).first()
+
+                # Aggregate all student scores into the course object.
+                students = ScoreService(
+                    course, students=course.students, outcomes=course.outcome_list
+                ).apply_scores(current_user)
+
+                # Check that the outcomes returned in the course have an alignment. If none do,
+                # disable the "post grades" button.
+                has_alignment = any(o.alignment for o in course.outcome_list)
+                course_data = CourseSchema().dump(course)
+
+                # Only the full page shows "Post all grades" in the table header
+                gradebook = {
+                    "course": course_data,
+                    "has_alignment": has_alignment,
+                    "score_table": Markup(render_template(
+                        'course/partials/score_table.html',
+                        students=students,
+                        course=course_data,
+                        has_alignment=has_alignment if template.endswith('_full.html') else None
+                    ))
+                }
+                gradebook_cache.set(key, gradebook)
+
+            return with_etag(render_template(template, **gradebook), etag)
     
     @restricted()
     def delete(self: None, course_canvas_id: int) -> List[Course]:
@@ -175,24 +213,27 @@ class CourseEnrollmentsAPI(MethodView):
         Returns:
             Course: [description]
         """
-        from app.models import User
         from app.schemas import UserSchema
+        from app.score_service import ScoreService
 
         course = Course.query.filter(Course.canvas_id == course_canvas_id).first()
         if course is None:
             abort(404)
+
+        # Preference changes bump the version of the teacher's own courses, but anyone else
+        # viewing the course brings their own preferences.
+        preferences = current_user.preferences
+        etag = make_etag(
+            course.id, course.version, current_user.id,
+            preferences.score_calculation_method if preferences else None
+        )
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
         
-        students = course.enrollments.filter(User.usertype_id == 3).all()
-
-        for user in students:
-            user.scores = []
-            for outcome in course.outcomes.all():
-                user.scores.append({
-                    "outcome_canvas_id": outcome.canvas_id,
-                    "score": outcome.avg(user.canvas_id)
-                })
+        students = ScoreService(course).apply_scores(current_user)
         
-        return jsonify(UserSchema(many=True, only=['canvas_id', 'name', 'scores']).dump(students))
+        return with_etag(jsonify(UserSchema(many=True, only=['canvas_id', 'name', 'scores']).dump(students)), etag)
         
         
 class CourseOutcomesAPI(MethodView):
@@ -206,10 +247,21 @@ class CourseOutcomesAPI(MethodView):
         Returns:
             List[Outcome]: List of Outcomes
         """
-        from app.schemas import OutcomeSchema
+        from sqlalchemy.orm import selectinload
         course = Course.query.filter(Course.canvas_id == course_canvas_id).first()
 
         if course is None:
             abort(404)
+
+        etag = make_etag(course.id, course.version)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        outcomes = Outcome.query.join(
+            course_outcomes, course_outcomes.c.outcome_id == Outcome.id
+        ).filter(
+            course_outcomes.c.course_id == course.id
+        ).order_by(course_outcomes.c.id).options(selectinload(Outcome.alignment)).all()
         
-        return jsonify(OutcomeListSchema(many=True).dump(course.outcomes.all()))
\ No newline at end of file
+        return with_etag(jsonify(OutcomeListSchema(many=True).dump(outcomes)), etag)
\ No newline at end of file
@@ -0,0 +1,52 @@
+import json
+from flask import abort, jsonify, make_response, render_template, request
+from flask.views import MethodView
+from flask_login import current_user
+
+from app.models import Job
+from app.schemas import JobSchema
+from app.util import restricted
+
+
+def job_response(job: Job, message: str):
+    """ Respond to a request that queued a background job.
+
+    htmx requests get the polling job status partial and a toast. Other clients get the
+    job as JSON. Both use 202 Accepted because the work hasn't happened yet.
+
+    Args:
+        job (Job): queued <Job>
+        message (str): message for the user
+
+    Returns:
+        Response: Flask response
+    """
+    if request.headers.get('HX-Request'):
+        response = make_response(render_template('shared/partials/job_status.html', job=job), 202)
+        response.headers.set('HX-Trigger', json.dumps({'showToast': message}))
+        return response
+
+    return jsonify({"message": message, "error": False, "job": JobSchema().dump(job)}), 202
+
+
+class JobAPI(MethodView):
+    @restricted()
+    def get(self: None, job_id: int) -> Job:
+        """ Get the status of a background job. htmx polls this until the job is finished.
+
+        Args:
+            job_id (int): <Job> ID
+
+        Returns:
+            Job: job status partial or JSON
+        """
+        job = Job.query.get(job_id)
+
+        # Jobs are only visible to the user who queued them
+        if job is None or job.user_id != current_user.id:
+            abort(404)
+
+        if request.headers.get('HX-Request'):
+            return render_template('shared/partials/job_status.html', job=job)
+
+        return jsonify(JobSchema().dump(job))
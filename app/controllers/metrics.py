@@ -0,0 +1,38 @@
+import hmac
+
+from flask import abort, current_app, make_response, request
+from flask.views import MethodView
+from flask_login import current_user
+
+from app.metrics import registry
+
+
+def can_read_metrics() -> bool:
+    """ Admins can read metrics in the browser. A collector sends METRICS_TOKEN as a bearer
+    token instead. Client addresses aren't trusted because behind the reverse proxy every
+    request comes from 127.0.0.1.
+    """
+    if current_user.is_authenticated and current_user.usertype_id == 1:
+        return True
+
+    token = current_app.config.get('METRICS_TOKEN')
+    header = request.headers.get('Authorization', '')
+    if token and header.startswith('Bearer '):
+        return hmac.compare_digest(header[len('Bearer '):].encode(), token.encode())
+
+    return False
+
+
+class MetricsAPI(MethodView):
+    def get(self: None) -> str:
+        """ Metrics for this process in the Prometheus text exposition format.
+
+        Returns:
+            str: text exposition
+        """
+        if not can_read_metrics():
+            abort(404)
+
+        response = make_response(registry.exposition())
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
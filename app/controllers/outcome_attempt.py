@@ -62,6 +62,7 @@ class OutcomeAttemptsAPI(MethodView):
             abort(404)
         
         course.outcomes.remove(outcome)
+        course.bump_version()
         db.session.commit()
 
         response = make_response(jsonify({'message': 'ok'}))
@@ -29,8 +29,8 @@ class OutcomeListAPI(MethodView):
             Outcome: <Outcome> instance
         """
         import json
-        from app.models import User
         from app.canvas_sync_service import CanvasSyncService
+        from app.score_service import ScoreService
         self.service = CanvasSyncService()
 
         required_args = {
@@ -51,9 +51,11 @@ class OutcomeListAPI(MethodView):
         
         if outcome_is_imported is None:
             course.outcomes.append(target_outcome)
+            course.bump_version()
 
             try:
-                self.service.get_outcome_attempts(args['course_id'], [args['outcome_id']])
+                # A newly imported outcome has no stored history, so read every result.
+                self.service.get_outcome_attempts(args['course_id'], [args['outcome_id']], full=True)
                 db.session.commit()
             except Exception as e:
                 db.session.rollback()
@@ -61,16 +63,7 @@ class OutcomeListAPI(MethodView):
         else:
             abort(409)
 
-        students = course.enrollments.filter(User.usertype_id == 3).all()
-
-        for user in students:
-            user.scores = []
-            for outcome in course.outcomes.all():
-                user_score = getattr(outcome, current_user.preferences.score_calculation_method.name)(user.canvas_id)
-                user.scores.append({
-                    "outcome_canvas_id": outcome.canvas_id,
-                    "score": user_score
-                })
+        students = ScoreService(course).apply_scores(current_user)
         
         has_alignment = any(o.alignment for o in course.outcomes.all())
 
@@ -154,8 +147,8 @@ class AlignmentAPI(MethodView):
         Returns:
             Assignment: Updated <Assignment>
         """
-        from app.models import User
         from app.schemas import OutcomeSchema
+        from app.score_service import ScoreService
 
         args = parser.parse({"assignment_canvas_id": fields.Int()}, location='form')
 
@@ -169,19 +162,10 @@ class AlignmentAPI(MethodView):
             abort(404, f"No outcome with ID {outcome_canvas_id} found.")
 
         course = target_outcome.course[0]
-        students = course.enrollments.filter(User.usertype_id == 3).all()
 
         try:
             assignment.watch(target_outcome)
-            # TODO: move into it's own util function
-            for user in students:
-                user.scores = []
-                for outcome in course.outcomes.all():
-                    user_score = getattr(outcome, current_user.preferences.score_calculation_method.name)(user.canvas_id)
-                    user.scores.append({
-                        "outcome_canvas_id": outcome.canvas_id,
-                        "score": user_score
-                    })
+            students = ScoreService(course).apply_scores(current_user)
         except DuplicateException as e:
             abort(409, e.__str__())
 
@@ -206,7 +190,7 @@ class AlignmentAPI(MethodView):
         Returns:
             Assignment: Updated Assignment
         """
-        from app.models import User
+        from app.score_service import ScoreService
         target_outcome = Outcome.query.filter(Outcome.canvas_id == outcome_canvas_id).first()
         if not target_outcome:
             abort(404, f"No outcome with ID {outcome_canvas_id} found.")
@@ -214,16 +198,7 @@ class AlignmentAPI(MethodView):
         target_outcome.alignment.unwatch()
         
         course = target_outcome.course[0]
-        students = course.enrollments.filter(User.usertype_id == 3).all()
-        
-        for user in students:
-            user.scores = []
-            for outcome in course.outcomes.all():
-                user_score = getattr(outcome, current_user.preferences.score_calculation_method.name)(user.canvas_id)
-                user.scores.append({
-                    "outcome_canvas_id": outcome.canvas_id,
-                    "score": user_score
-                })
+        students = ScoreService(course).apply_scores(current_user)
         
         has_alignment = any(o.alignment for o in course.outcomes.all())
 
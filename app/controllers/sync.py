@@ -7,6 +7,7 @@ from flask.views import MethodView
 from app import db
 from app.schemas import AssignmentSchema, OutcomeSchema, CourseSchema, CanvasSyncServiceOutcome
 from app.canvas_sync_service import CanvasSyncService
+from app.util import restricted
 
 """
 This module provides an HTTP interface with CanvasSyncService. CanvasSyncService
@@ -98,36 +99,35 @@ class SyncOutcomesAPI(MethodView):
 
 
 class SyncOutcomeAttemptsAPI(MethodView):
-    def __init__(self):
-        self.service = CanvasSyncService()
-
+    @restricted()
     def get(self: None, course_id: int) -> list:
-        """ Fetch Outcome attempts from Canvas.
+        """ Queue a job to fetch Outcome attempts from Canvas. Only users enrolled in the
+        course can queue it, since the worker syncs with the server token.
 
         Args:
             course_id (int): Canvas course ID
 
         Returns:
-            list: List of Canvas Outcomes which can be stored locally.
+            Job: the queued <Job>
         """
         from app.models import Course
         course = Course.query.filter(Course.id == course_id).first()
 
         if course is None:
             abort(404)
+        if not current_user.is_enrolled(course):
+            abort(403)
         
         # Get attempts for all outcomes already synced to a course locally.
         outcome_ids = [outcome.canvas_id for outcome in course.outcomes.all()]
 
         if bool(outcome_ids):
-            try:
-                result = self.service.get_outcome_attempts(course.canvas_id, outcome_ids)
-                return jsonify({
-                    "message": result,
-                    "error": False
-                })
-            except Exception as e:
-                abort(422)
+            from app.controllers.jobs import job_response
+            from app.job_service import enqueue
+
+            # Syncing results can take minutes, so it runs in the background worker.
+            job = enqueue('sync_results', current_user, course_id=course.canvas_id)
+            return job_response(job, 'Syncing results from Canvas')
         else:
             return jsonify({
                 "message": "Sync at least one outcome from Canvas before importing results.",
@@ -8,6 +8,7 @@ from typing import List
 from app import db
 from app.models import User, Manager, Course
 from app.schemas import UserPrefsSchema, UserSchema, CourseSchema
+from app.util import make_etag, not_modified, with_etag
 
 
 class UserListAPI(MethodView):
@@ -52,6 +53,11 @@ class UserPrefsAPI(MethodView):
 
         user.preferences.update(args)
 
+        # Gradebooks and their ETags depend on the teacher's preferences.
+        for course in user.enrollments:
+            course.bump_version()
+        db.session.commit()
+
         return render_template(
             'preferences/partials/user_prefs.html',
             user=user
@@ -64,4 +70,13 @@ class UserCourseAPI(MethodView):
         if user is None:
             abort (404)
         
-        return jsonify(CourseSchema(many=True, exclude=["assignments"]).dump(user.enrollments.all()))
\ No newline at end of file
+        versions = user.enrollments.with_entities(Course.id, Course.version).order_by(Course.id).all()
+
+        etag = make_etag(user.id, [tuple(row) for row in versions])
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        courses = user.enrollments.options(*Course.gradebook_options(students=False)).all()
+
+        return with_etag(jsonify(CourseSchema(many=True, exclude=["assignments"]).dump(courses)), etag)
\ No newline at end of file
@@ -7,3 +7,9 @@ class MasteryCalculation(Enum):
     HIGH_LAST_AVERAGE = 4
     MODE = 5
     NONE = 6
+
+class JobStatus(Enum):
+    QUEUED = 1
+    RUNNING = 2
+    COMPLETED = 3
+    FAILED = 4
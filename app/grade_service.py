@@ -0,0 +1,110 @@
+from datetime import datetime
+from typing import Dict, List
+
+from app import app, db
+from app.models import Assignment, Course, User, UserAssignment
+from app.score_service import ScoreService
+from app.util import upsert
+
+
+class GradeService:
+    """
+    Calculate assignment grades from aligned outcome scores for a whole course at once.
+
+    An assignment aligned to an outcome is worth full points when the student's outcome score
+    meets the teacher's mastery score and zero otherwise. Scores for every student and aligned
+    outcome come from one <ScoreService> read, existing <UserAssignment> rows are loaded in one
+    query, and only new or changed grades are written back in a single upsert.
+    """
+
+    def __init__(self: None, course: Course, user: User) -> None:
+        self.course = course
+        self.calculation_method = user.preferences.score_calculation_method
+        self.mastery_score = user.preferences.mastery_score
+
+    def calculate_grades(self: None, assignments: List[Assignment]=None) -> Dict[tuple, int]:
+        """ Calculate the grade for every student on each aligned assignment.
+
+        Args:
+            assignments (List[Assignment], optional): Assignments to grade. Defaults to all assignments in the course.
+
+        Returns:
+            Dict[tuple, int]: grades keyed by (user_canvas_id, assignment_canvas_id)
+        """
+        if assignments is None:
+            assignments = self.course.assignments
+
+        aligned = [assignment for assignment in assignments if assignment.watching is not None]
+        if not aligned:
+            return {}
+
+        service = ScoreService(self.course, outcomes=[assignment.watching for assignment in aligned])
+        scores = service.get_scores(self.calculation_method)
+
+        # A missing score only means "no attempts" once the scores have been built. Grading
+        # those students would post a 0, so they're left out until the scores exist.
+        missing = set()
+        if any(score is None for row in scores.values() for score in row.values()):
+            missing = service.missing_scores(self.calculation_method)
+        if missing:
+            app.logger.warning('{} has {} student outcomes with attempts but no stored score. '
+                               'Run `flask rebuild-scores`.'.format(self.course.name, len(missing)))
+
+        grades = {}
+        for assignment in aligned:
+            app.logger.info('Assignment {} is aligned to outcome {}'.format(assignment.name, assignment.watching.name))
+            for user_canvas_id, row in scores.items():
+                if (user_canvas_id, assignment.watching.canvas_id) in missing:
+                    continue
+
+                score = row[assignment.watching.canvas_id]
+
+                # TODO: Set to all or nothing now, _could_ be set to the Outcome calculated score with a toggle.
+                # Add a preference to post all/nothing or the outcome score
+                if score is not None and score >= self.mastery_score:
+                    grade = assignment.points_possible
+                else:
+                    grade = 0
+
+                grades[(user_canvas_id, assignment.canvas_id)] = grade
+
+        return grades
+
+    def update_grades(self: None, assignments: List[Assignment]=None) -> int:
+        """ Calculate grades and store them as <UserAssignment> rows in one transaction.
+
+        Rows whose grade hasn't changed are left alone so their `occurred` time and posted
+        state stay as they were.
+
+        Args:
+            assignments (List[Assignment], optional): Assignments to grade. Defaults to all assignments in the course.
+
+        Returns:
+            int: Number of rows inserted or updated
+        """
+        grades = self.calculate_grades(assignments)
+        if not grades:
+            return 0
+
+        assignment_ids = {assignment_id for _, assignment_id in grades}
+        existing = {
+            (row.user_id, row.assignment_id): row.score
+            for row in db.session.query(
+                UserAssignment.user_id,
+                UserAssignment.assignment_id,
+                UserAssignment.score
+            ).filter(UserAssignment.assignment_id.in_(assignment_ids))
+        }
+
+        occurred = datetime.now()
+        rows = [
+            {"user_id": user_id, "assignment_id": assignment_id, "score": grade, "occurred": occurred}
+            for (user_id, assignment_id), grade in grades.items()
+            if (user_id, assignment_id) not in existing or existing[(user_id, assignment_id)] != grade
+        ]
+
+        upsert(UserAssignment, rows, ["user_id", "assignment_id"], ["score", "occurred"])
+        db.session.commit()
+
+        app.logger.info('Updated {} of {} grades in {}'.format(len(rows), len(grades), self.course.name))
+        return len(rows)
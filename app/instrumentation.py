@@ -0,0 +1,266 @@
+import json
+import threading
+import time
+from typing import List
+
+from flask import g, has_app_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.metrics import registry
+
+"""
+Opt-in request instrumentation. With `INSTRUMENTATION = True` in the config, every request counts:
+
+- SQL statements and the time spent running them (SQLAlchemy cursor events)
+- Canvas API calls and their latency (reported by <ThrottledAdapter>)
+- template render time
+
+The totals are sent back in a `Server-Timing` header, written as one JSON log line per request
+and added to per-endpoint histograms in <app.metrics.registry>. The admin metrics page shows
+p50 and p95 estimates from those histograms.
+
+`QUERY_BUDGETS` caps the SQL statements a GET request to an endpoint may run. Going over logs a warning, or
+raises <QueryBudgetExceeded> when `QUERY_BUDGETS_ENFORCE` is set, which the test suite does so
+a change that adds queries to a page fails its tests.
+"""
+
+# Most SQL statements a GET request to each endpoint may run. Writes are left out, since
+# their queries grow with what is being changed. Override or extend with the QUERY_BUDGETS
+# config option.
+QUERY_BUDGETS = {
+    'courses.course_view': 10,
+    'courses.course_list_view': 6,
+    'courses.course_enrollments_view': 6,
+    'courses.course_outcomes_view': 6,
+    'users.user_course_view': 6,
+    'jobs.job_view': 4,
+}
+
+class QueryBudgetExceeded(Exception):
+    """ Raised when an endpoint runs more SQL statements than its budget allows. """
+    def __init__(self, description):
+        super().__init__(description)
+
+
+class RequestMetrics:
+    """ Counters for a single request. Canvas calls can be made from pager threads, so
+    updates take a lock.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.canvas_count = 0
+        self.canvas_time = 0.0
+        self.render_time = 0.0
+
+        self._render_depth = 0
+        self._render_start = None
+        self._lock = threading.Lock()
+
+    def add_sql(self, seconds: float) -> None:
+        with self._lock:
+            self.sql_count += 1
+            self.sql_time += seconds
+
+    def add_canvas(self, seconds: float) -> None:
+        with self._lock:
+            self.canvas_count += 1
+            self.canvas_time += seconds
+
+    def start_render(self) -> None:
+        # Partials render inside their page, so only the outermost template is timed.
+        if self._render_depth == 0:
+            self._render_start = time.perf_counter()
+        self._render_depth += 1
+
+    def finish_render(self) -> None:
+        self._render_depth -= 1
+        if self._render_depth == 0 and self._render_start is not None:
+            self.render_time += time.perf_counter() - self._render_start
+
+    def summary(self) -> dict:
+        """ Millisecond totals for the request so far """
+        return {
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 2),
+            "sql_count": self.sql_count,
+            "sql_ms": round(self.sql_time * 1000, 2),
+            "canvas_count": self.canvas_count,
+            "canvas_ms": round(self.canvas_time * 1000, 2),
+            "render_ms": round(self.render_time * 1000, 2),
+        }
+
+
+# Histograms per endpoint, keyed by the RequestMetrics.summary() field they record. Durations
+# are stored in seconds, as Prometheus expects, and shown in milliseconds on the admin page.
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+request_histograms = {
+    "duration_ms": registry.histogram('http_request_duration_seconds', 'Time to handle a request', ('endpoint',)),
+    "sql_count": registry.histogram('http_request_queries', 'SQL statements run per request', ('endpoint',), buckets=COUNT_BUCKETS),
+    "sql_ms": registry.histogram('http_request_db_seconds', 'Time spent in SQL per request', ('endpoint',)),
+    "canvas_count": registry.histogram('http_request_canvas_calls', 'Canvas API calls per request', ('endpoint',), buckets=COUNT_BUCKETS),
+    "canvas_ms": registry.histogram('http_request_canvas_seconds', 'Time spent on Canvas API calls per request', ('endpoint',)),
+    "render_ms": registry.histogram('http_request_render_seconds', 'Time spent rendering templates per request', ('endpoint',)),
+}
+
+requests_total = registry.counter('http_requests_total', 'Requests handled', ('endpoint', 'status'))
+
+
+def record_request(endpoint: str, status: int, summary: dict) -> None:
+    """ Add a request summary to the endpoint histograms """
+    requests_total.inc(endpoint=endpoint, status=status)
+    for field, histogram in request_histograms.items():
+        value = summary[field]
+        histogram.observe(value / 1000 if field.endswith('_ms') else value, endpoint=endpoint)
+
+
+def endpoint_report() -> List[dict]:
+    """ Estimated p50 and p95 of each field per endpoint, slowest endpoints first.
+
+    Returns:
+        List[dict]: {"endpoint", "requests", "<field>": {"p50", "p95"}}
+    """
+    duration = request_histograms["duration_ms"]
+
+    rows = []
+    for labels in duration.label_sets():
+        row = {"endpoint": labels["endpoint"], "requests": duration.count(**labels)}
+        for field, histogram in request_histograms.items():
+            scale = 1000 if field.endswith('_ms') else 1
+            row[field] = {
+                quantile: round((histogram.quantile(q, **labels) or 0) * scale, 2)
+                for quantile, q in (("p50", 0.5), ("p95", 0.95))
+            }
+        rows.append(row)
+
+    return sorted(rows, key=lambda row: row["duration_ms"]["p95"], reverse=True)
+
+
+def current_metrics() -> RequestMetrics:
+    """ Metrics for the request being handled, or None outside an instrumented request. """
+    if not has_app_context():
+        return None
+    return g.get('request_metrics')
+
+
+def record_canvas_call(seconds: float) -> None:
+    """ Count a Canvas API call against the current request. """
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_canvas(seconds)
+
+
+def server_timing(summary: dict) -> str:
+    return ', '.join([
+        'db;dur={sql_ms};desc="{sql_count} queries"'.format(**summary),
+        'canvas;dur={canvas_ms};desc="{canvas_count} calls"'.format(**summary),
+        'render;dur={render_ms}'.format(**summary),
+        'total;dur={duration_ms}'.format(**summary),
+    ])
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get('query_start')
+    if not stack:
+        # The listeners were attached while this statement was already running
+        return
+    start = stack.pop()
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_sql(time.perf_counter() - start)
+
+
+def handle_error(exception_context):
+    # after_cursor_execute doesn't run for a failed statement, so drop its start time here.
+    # Otherwise the stack on a pooled connection grows with every error.
+    conn = exception_context.connection
+    if conn is not None and exception_context.execution_context is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def listen_for_queries() -> None:
+    """ Attach the SQL timing listeners to every Engine. This is only done once INSTRUMENTATION
+    is on, so otherwise statements run without any listener.
+    """
+    global _listening
+    if _listening:
+        return
+    with _listening_lock:
+        if not _listening:
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+            _listening = True
+
+
+def query_budget(app, endpoint: str) -> int:
+    budgets = dict(QUERY_BUDGETS, **app.config.get('QUERY_BUDGETS', {}))
+    return budgets.get(endpoint)
+
+
+def init_app(app) -> None:
+    """ Register the instrumentation hooks. They do nothing unless INSTRUMENTATION is set, and
+    the SQL listeners are only attached once it is.
+    """
+    if app.config.get('INSTRUMENTATION'):
+        listen_for_queries()
+
+    @before_render_template.connect_via(app)
+    def before_render(sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.start_render()
+
+    @template_rendered.connect_via(app)
+    def after_render(sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.finish_render()
+
+    @app.before_request
+    def start_request():
+        if app.config.get('INSTRUMENTATION'):
+            # The flag can be turned on after start up, eg by the test suite
+            listen_for_queries()
+            g.request_metrics = RequestMetrics()
+
+    @app.after_request
+    def finish_request(response):
+        metrics = g.pop('request_metrics', None)
+        if metrics is None:
+            return response
+
+        summary = metrics.summary()
+        endpoint = request.endpoint or 'unknown'
+
+        response.headers['Server-Timing'] = server_timing(summary)
+        record_request(endpoint, response.status_code, summary)
+        app.logger.info(json.dumps({
+            "event": "request",
+            "endpoint": endpoint,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            **summary
+        }))
+
+        budget = query_budget(app, endpoint) if request.method == 'GET' else None
+        if budget is not None and summary["sql_count"] > budget:
+            message = '{} ran {} queries, over its budget of {}'.format(endpoint, summary["sql_count"], budget)
+            if app.config.get('QUERY_BUDGETS_ENFORCE'):
+                raise QueryBudgetExceeded(message)
+            app.logger.warning(message)
+
+        return response
@@ -0,0 +1,284 @@
+import json
+import time
+from datetime import datetime
+from typing import Callable, Dict
+
+from app import app, db
+from app.enums import JobStatus
+from app.metrics import registry
+from app.models import Job, User
+
+"""
+Long Canvas operations run outside of the web request. Endpoints queue a <Job> with `enqueue()`
+and return right away. `flask worker` claims queued jobs from the database and runs the matching
+handler, writing progress back to the job so the UI can poll it.
+
+Workers don't have access to a user's OAuth session, so handlers talk to Canvas with the
+server token (`CanvasSyncService('server_only')`). Canvas can't check the user's permissions
+on those calls, so handlers check that the job's user is enrolled in the course first.
+"""
+
+# Job handlers, keyed by job name
+HANDLERS: Dict[str, Callable] = {}
+
+# Shown for jobs failed by <fail_stale_jobs>
+STALE_MESSAGE = "This job stopped before it finished. Please try again."
+
+job_seconds = registry.histogram('job_seconds', 'Time to run a background job', ('name', 'status'))
+
+
+class JobFailed(Exception):
+    """ Raised by a handler to fail a job with a message for the user. """
+    def __init__(self, description):
+        super().__init__(description)
+
+
+def handler(name: str) -> Callable:
+    """ Register a function to run jobs with the given name. The function is called with the
+    <Job> and the job arguments, and returns a message for the user.
+    """
+    def _handler(func):
+        HANDLERS[name] = func
+        return func
+    return _handler
+
+
+def enqueue(name: str, user: User=None, **arguments) -> Job:
+    """ Queue a job for the worker.
+
+    Args:
+        name (str): Registered handler name
+        user (User, optional): User the job runs for
+
+    Returns:
+        Job: the queued <Job>
+    """
+    if name not in HANDLERS:
+        raise ValueError(f"No job handler named {name}.")
+
+    job = Job(
+        name=name,
+        status=JobStatus.QUEUED,
+        user_id=user.id if user is not None else None,
+        arguments=json.dumps(arguments),
+        progress=0,
+        created_at=datetime.now()
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    return job
+
+
+def fail_stale_jobs() -> int:
+    """ Fail jobs left RUNNING by a worker that was killed or lost its database connection.
+
+    Jobs aren't requeued, since a half-finished grade post may already have reached Canvas.
+    The user sees the failure and can start it again.
+
+    Returns:
+        int: Number of jobs failed
+    """
+    failed = Job.query.filter(
+        Job.status == JobStatus.RUNNING,
+        Job.started_at < Job.stale_before()
+    ).update(
+        {
+            "status": JobStatus.FAILED,
+            "message": STALE_MESSAGE,
+            "finished_at": datetime.now()
+        },
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    if failed:
+        app.logger.warning('Failed {} jobs running for longer than JOB_TIMEOUT'.format(failed))
+    return failed
+
+
+def claim_next() -> Job:
+    """ Claim the oldest queued job.
+
+    The claim is a conditional UPDATE, so when more than one worker is running only one of
+    them can move a job from QUEUED to RUNNING. Jobs that have been running for longer than
+    JOB_TIMEOUT are failed first, so a crashed worker doesn't leave them running forever.
+
+    Returns:
+        Job: the claimed <Job>, or None when the queue is empty
+    """
+    fail_stale_jobs()
+
+    while True:
+        job_id = db.session.query(Job.id).filter(
+            Job.status == JobStatus.QUEUED
+        ).order_by(Job.id).limit(1).scalar()
+
+        if job_id is None:
+            db.session.commit()
+            return None
+
+        claimed = Job.query.filter(
+            Job.id == job_id,
+            Job.status == JobStatus.QUEUED
+        ).update(
+            {"status": JobStatus.RUNNING, "started_at": datetime.now()},
+            synchronize_session=False
+        )
+        db.session.commit()
+
+        if claimed:
+            return Job.query.get(job_id)
+
+
+def run_job(job: Job) -> Job:
+    """ Run a claimed job and store the result.
+
+    Args:
+        job (Job): <Job> in the RUNNING state
+
+    Returns:
+        Job: the finished <Job>
+    """
+    job_id = job.id
+    start = time.perf_counter()
+
+    try:
+        message = HANDLERS[job.name](job, **json.loads(job.arguments or '{}'))
+        job.status = JobStatus.COMPLETED
+        job.message = message
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('Job {} ({}) failed'.format(job_id, job.name))
+
+        job = Job.query.get(job_id)
+        job.status = JobStatus.FAILED
+        job.message = e.args[0] if isinstance(e, JobFailed) else 'Something went wrong. Please try again.'
+
+    job.finished_at = datetime.now()
+    db.session.commit()
+
+    elapsed = time.perf_counter() - start
+    job_seconds.observe(elapsed, name=job.name, status=job.status.name.lower())
+    app.logger.info('Job {} ({}) {} in {:.1f}s'.format(
+        job_id, job.name, job.status.name.lower(), elapsed
+    ))
+
+    return job
+
+
+def work(interval: float=2, once: bool=False) -> int:
+    """ Run queued jobs until stopped.
+
+    Args:
+        interval (float, optional): Seconds to wait when the queue is empty. Defaults to 2.
+        once (bool, optional): Stop when the queue is empty instead of waiting. Defaults to False.
+
+    Returns:
+        int: Number of jobs run
+    """
+    count = 0
+    while True:
+        job = claim_next()
+        if job is not None:
+            run_job(job)
+            db.session.remove()
+            count += 1
+        elif once:
+            return count
+        else:
+            time.sleep(interval)
+
+
+def require_enrollment(job: Job, course) -> None:
+    """ Fail the job unless its user is enrolled in the course.
+
+    Endpoints check this before queueing, but it's checked again when the job runs because
+    the server token can write to any course.
+
+    Args:
+        job (Job): running <Job>
+        course (Course): <Course> the job works on
+    """
+    if job.user is None or not job.user.is_enrolled(course):
+        raise JobFailed("You don't have access to this course.")
+
+
+@handler('sync_results')
+def sync_results(job: Job, course_id: int) -> str:
+    """ Sync outcome attempts for every outcome stored in a course.
+
+    Args:
+        job (Job): running <Job>
+        course_id (int): Canvas course ID
+    """
+    from app.canvas_sync_service import CanvasSyncService
+    from app.models import Course
+
+    course = Course.query.filter(Course.canvas_id == course_id).first()
+    if course is None:
+        raise JobFailed("Course not found.")
+    require_enrollment(job, course)
+
+    outcome_ids = [outcome.canvas_id for outcome in course.outcomes.all()]
+    if not outcome_ids:
+        raise JobFailed("Sync at least one outcome from Canvas before importing results.")
+
+    # Pick up new students first so their results aren't skipped as unknown users.
+    job.update_progress(0, 1)
+    service = CanvasSyncService('server_only')
+    service.get_enrollments(course_id)
+    result = service.get_outcome_attempts(course_id, outcome_ids)
+    job.update_progress(1)
+
+    return result
+
+
+@handler('post_grades')
+def post_grades(job: Job, course_id: int, assignment_id: int=None) -> str:
+    """ Calculate grades for aligned assignments and post changed grades to Canvas.
+
+    Progress is counted in student grades so the UI can show eg, "42/150 posted".
+
+    Args:
+        job (Job): running <Job>
+        course_id (int): Canvas course ID
+        assignment_id (int, optional): Canvas assignment ID. Defaults to every assignment in the course.
+    """
+    from app.canvas_sync_service import CanvasSyncService
+    from app.grade_service import GradeService
+    from app.models import Assignment, Course
+
+    course = Course.query.filter(Course.canvas_id == course_id).first()
+    if course is None:
+        raise JobFailed("Course not found.")
+    require_enrollment(job, course)
+
+    if assignment_id is not None:
+        assignments = Assignment.query.filter(
+            Assignment.canvas_id == assignment_id,
+            Assignment.course.contains(course)
+        ).all()
+    else:
+        assignments = course.assignments
+
+    GradeService(course, job.user).update_grades(assignments)
+
+    total = sum(
+        1 for assignment in assignments for assignment_attempt in assignment.student_attempts if assignment_attempt.is_dirty
+    )
+    job.update_progress(0, total)
+
+    service = CanvasSyncService('server_only')
+    posted = 0
+    failed = 0
+    for assignment in assignments:
+        result = service.post_assignment_submission(assignment)
+        posted += result['posted']
+        failed += len(result['failed'])
+        job.update_progress(posted + failed)
+
+    if failed:
+        raise JobFailed(f"Posted {posted} grades. {failed} could not be posted to Canvas.")
+
+    return f"Posted {posted} grades."
@@ -0,0 +1,320 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Tuple
+
+"""
+Counters, gauges and histograms for sync, grade posting and request throughput.
+
+Metrics are declared once at module level next to the code that updates them:
+
+    pages_fetched = registry.counter('canvas_pages_fetched_total', 'Canvas list pages read')
+    pages_fetched.inc()
+
+Gauges that mirror state held elsewhere, eg Canvas rate limit buckets, are filled in by a
+function registered with `registry.collector`, which runs whenever the metrics are read.
+
+`registry.exposition()` renders everything in the Prometheus text format for `/metrics`, and
+`registry.summary()` gives a JSON-friendly view that `flask sync`, `flask worker` and
+`flask rebuild-scores` append to `METRICS_SUMMARY_FILE` when they finish.
+
+Values live in memory and belong to one process. Each gunicorn worker serves its own numbers
+on `/metrics`, and each CLI run starts from zero.
+"""
+
+# Request and Canvas call latencies in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...]=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError('{} takes labels {}, got {}'.format(self.name, self.labels, tuple(labels)))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def label_sets(self) -> List[dict]:
+        """ Every combination of labels with a value """
+        with self._lock:
+            keys = list(self._values)
+        return [dict(zip(self.labels, key)) for key in keys]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labels, key)), value
+
+    def summarize(self, value: float) -> dict:
+        return {"value": value}
+
+
+class Counter(Metric):
+    """ A value that only goes up, eg attempts stored. """
+    type = 'counter'
+
+    def inc(self, amount: float=1, **labels) -> None:
+        if amount < 0:
+            raise ValueError('Counters can only be increased')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, eg requests in flight. """
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+
+class Histogram(Metric):
+    """ Observations counted into cumulative buckets, eg request durations. """
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...]=(), buckets: Tuple[float, ...]=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe the seconds spent in a `with` block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0))
+        return sum(counts)
+
+    def sum(self, **labels) -> float:
+        with self._lock:
+            _, total = self._values.get(self._key(labels), ([0], 0))
+        return total
+
+    def quantile(self, q: float, **labels) -> float:
+        """ Estimate a quantile from the buckets the way Prometheus' `histogram_quantile` does.
+
+        Args:
+            q (float): quantile between 0 and 1
+
+        Returns:
+            float: estimated value, or None without observations
+        """
+        with self._lock:
+            counts = list(self._values.get(self._key(labels), ([], 0))[0])
+        return self._quantile(q, counts)
+
+    def _quantile(self, q: float, counts: List[int]) -> float:
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts[:-1]):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+
+        # Past the last bucket there's no upper bound to interpolate to.
+        return self.buckets[-1]
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+    def summarize(self, value: tuple) -> dict:
+        counts, total = value
+        return {
+            "count": sum(counts),
+            "sum": round(total, 6),
+            "p50": self._quantile(0.5, counts),
+            "p95": self._quantile(0.95, counts),
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str, labels: Tuple[str, ...]=()) -> Counter:
+        return self.__register(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str, labels: Tuple[str, ...]=()) -> Gauge:
+        return self.__register(Gauge, name, description, labels)
+
+    def histogram(self, name: str, description: str, labels: Tuple[str, ...]=(), buckets: Tuple[float, ...]=DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram, name, description, labels, buckets=buckets)
+
+    def collector(self, func: Callable[[], None]) -> Callable[[], None]:
+        """ Register a function that updates gauges from current state. It's called before
+        every exposition and summary. Usable as a decorator.
+        """
+        with self._lock:
+            self._collectors.append(func)
+        return func
+
+    def collect(self) -> None:
+        """ Run the registered collectors """
+        for func in list(self._collectors):
+            func()
+
+    def get(self, name: str) -> Metric:
+        return self._metrics.get(name)
+
+    def clear(self) -> None:
+        """ Reset every value. Metrics stay registered. """
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+    def exposition(self) -> str:
+        """ All metrics in the Prometheus text exposition format """
+        self.collect()
+        lines = []
+        for metric in sorted(self._metrics.values(), key=lambda metric: metric.name):
+            lines.append('# HELP {} {}'.format(metric.name, _escape(metric.description, help=True)))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> Dict[str, List[dict]]:
+        """ Metrics with values as plain data, for JSON.
+
+        Returns:
+            Dict[str, List[dict]]: a list of {"labels", ...values} per metric name
+        """
+        self.collect()
+        summary = {}
+        for metric in sorted(self._metrics.values(), key=lambda metric: metric.name):
+            with metric._lock:
+                values = list(metric._values.items())
+            if values:
+                summary[metric.name] = [
+                    dict(labels=dict(zip(metric.labels, key)), **metric.summarize(value))
+                    for key, value in values
+                ]
+        return summary
+
+    def __register(self, cls, name, description, labels, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, description, labels, **kwargs)
+            elif type(metric) is not cls or metric.labels != tuple(labels):
+                raise ValueError('{} is already registered as a different metric'.format(name))
+            return metric
+
+
+def _escape(value: str, help: bool=False) -> str:
+    value = value.replace('\\', r'\\').replace('\n', r'\n')
+    return value if help else value.replace('"', r'\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, _escape(value)) for label, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(float(value))
+    return repr(float(value))
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def cli_run(command: str):
+    """ Log a JSON summary of the metrics when a CLI command finishes, and append it to
+    `METRICS_SUMMARY_FILE` when that is set.
+
+    The summary is written even when the command fails or is interrupted, with the status
+    recorded, so partial runs still show up in the history.
+
+    Args:
+        command (str): command name, eg "sync"
+    """
+    from app import app
+
+    path = app.config.get('METRICS_SUMMARY_FILE')
+
+    started = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        yield
+        status = 'completed'
+    except KeyboardInterrupt:
+        status = 'interrupted'
+        raise
+    finally:
+        summary = {
+            "command": command,
+            "started": started.isoformat(),
+            "duration_seconds": round(time.perf_counter() - start, 3),
+            "status": status,
+            "metrics": registry.summary(),
+        }
+        line = json.dumps(summary, sort_keys=True)
+        app.logger.info('Metrics: {}'.format(line))
+        if path:
+            with open(path, 'a') as summary_file:
+                summary_file.write(line + '\n')
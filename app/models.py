@@ -1,12 +1,20 @@
+import uuid
+from datetime import datetime, timedelta
+
 from flask_login import UserMixin
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import backref, selectinload
 from sqlalchemy.dialects.mysql import FLOAT
 
-from app import db, lm
-from app.enums import MasteryCalculation
+from app import app, db, lm
+from app.enums import JobStatus, MasteryCalculation
 from app.errors import DuplicateException
 
 
+def new_version() -> str:
+    """ Random token for <Course>.version """
+    return uuid.uuid4().hex
+
+
 class Manager(object):
     def create(self, cls, data):
         item = cls(**data)
@@ -95,13 +103,63 @@ class Course(db.Model, Manager):
     canvas_id = db.Column(db.Integer, unique=True)
     name = db.Column(db.String(255))
     updated_at = db.Column(db.DateTime)
+    # Latest `submitted_or_assessed_at` of the outcome results stored by a full course sync.
+    # Later syncs skip results older than this, less RESULTS_SYNC_LOOKBACK_DAYS.
+    results_synced_at = db.Column(db.DateTime)
+    # Changes whenever data shown in the gradebook changes, so rendered copies can be reused
+    # until then. Set with `bump_version()`.
+    version = db.Column(db.String(32), default=new_version)
 
     outcomes = db.relationship("Outcome", secondary="course_outcomes", backref="course", lazy='dynamic')
     assignments = db.relationship("Assignment", cascade='all,delete', secondary="course_assignments", backref="course")
 
+    # `outcomes` and `User.enrollments` are dynamic, so they can't be eager loaded. These
+    # read-only lists can, which lets the gradebook load a whole course with `with_gradebook()`.
+    outcome_list = db.relationship(
+        "Outcome",
+        secondary="course_outcomes",
+        order_by="course_outcomes.c.id",
+        viewonly=True
+    )
+    students = db.relationship(
+        "User",
+        secondary="user_courses",
+        secondaryjoin="and_(User.id == user_courses.c.user_id, User.usertype_id == 3)",
+        order_by="user_courses.c.id",
+        viewonly=True
+    )
+
     def __repr__(self):
         return self.name
 
+    def bump_version(self):
+        """ Mark the course's gradebook data as changed. This does not commit. """
+        self.version = new_version()
+
+    @classmethod
+    def gradebook_options(cls, students: bool=True) -> list:
+        """ Loader options for the outcomes, alignments, assignments and students the gradebook
+        shows. Each collection is loaded with one more query no matter how big the course is.
+
+        Args:
+            students (bool, optional): Load the student roster too. Defaults to True.
+
+        Returns:
+            list: options for `Query.options()`
+        """
+        options = [
+            selectinload(cls.outcome_list).selectinload(Outcome.alignment),
+            selectinload(cls.assignments)
+        ]
+        if students:
+            options.append(selectinload(cls.students))
+        return options
+
+    @classmethod
+    def with_gradebook(cls, students: bool=True):
+        """ Query courses with `gradebook_options()` applied. """
+        return cls.query.options(*cls.gradebook_options(students))
+
 
 class Outcome(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -120,10 +178,14 @@ class Outcome(db.Model):
 
     def __get_scores(self, user_id):
         return [
-            item.score for item in self.attempts.filter(OutcomeAttempt.user_canvas_id == user_id).all()
+            item.score for item in self.attempts.filter(
+                OutcomeAttempt.user_canvas_id == user_id,
+                OutcomeAttempt.score.isnot(None)
+            ).order_by(OutcomeAttempt.occurred, OutcomeAttempt.attempt_canvas_id).all()
         ]
 
-    # Define all of the math to run on an outcome
+    # Define all of the math to run on an outcome. The calculations live in
+    # app.score_service so they can also be run for a whole course at once.
     def AVERAGE(self: None, user_id:int) -> float:
         """ Calculate the outcome average
 
@@ -133,12 +195,8 @@ class Outcome(db.Model):
         Returns:
             float: average
         """
-        from statistics import fmean
-        scores = self.__get_scores(user_id)
-        if len(scores) == 0:
-            return None
-        else:
-            return round(fmean(scores), 1)
+        from app.score_service import average
+        return average(self.__get_scores(user_id))
     
     def DECAYING_AVERAGE(self: None, user_id: int) -> float:
         """ Calulate a decaying average for the outcome.
@@ -156,17 +214,8 @@ class Outcome(db.Model):
         Returns:
             float: decaying average
         """
-        from statistics import fmean
-        scores = self.__get_scores(user_id)
-        if len(scores) == 0:
-            return None
-        elif len(scores) == 1:
-            # Handle a single attempt, return as a float for aesthetics.
-            return float(scores[0])
-        else:
-            all = round((fmean(scores[:-1]) * 0.35), 2)
-            last = round((scores[-1] * 0.65), 2)
-            return round(all + last, 1)
+        from app.score_service import decaying_average
+        return decaying_average(self.__get_scores(user_id))
 
     def HIGHEST(self: None, user_id: int) -> float:
         """ Return the highest score attempt
@@ -177,11 +226,8 @@ class Outcome(db.Model):
         Returns:
             float: highest attempt
         """
-        scores = self.__get_scores(user_id)
-        if len(scores) == 0:
-            return None
-        else:
-            return max(scores)
+        from app.score_service import highest
+        return highest(self.__get_scores(user_id))
 
     def HIGH_LAST_AVERAGE(self: None, user_id: int) -> float:
         """ Average the last attemp with the highest attempt.
@@ -200,11 +246,8 @@ class Outcome(db.Model):
         Returns:
             float: average
         """
-        scores = self.__get_scores(user_id)
-        if len(scores) == 0:
-            return None
-        else:
-            return round((max(scores) + scores[-1]) / 2, 1)
+        from app.score_service import high_last_average
+        return high_last_average(self.__get_scores(user_id))
     
     def MODE(self: None, user_id: int) -> float:
         """ Return the mode for the score sample.
@@ -218,12 +261,8 @@ class Outcome(db.Model):
         Returns:
             float: mode
         """
-        from statistics import mode
-        scores = self.__get_scores(user_id)
-        if len(scores) == 0:
-            return None
-        else:
-            return mode(scores)
+        from app.score_service import mode_score
+        return mode_score(self.__get_scores(user_id))
 
 
 class Assignment(db.Model):
@@ -251,12 +290,16 @@ class Assignment(db.Model):
     def watch(self, outcome):
         if not self.is_watching(outcome):
             self.watching = outcome
+            for course in self.course:
+                course.bump_version()
             db.session.commit()
         else:
             raise DuplicateException(f"{self.name} is aleady aligned to Outcome {self.watching.name}.")
         
     def unwatch(self):
         self.watching = None
+        for course in self.course:
+            course.bump_version()
         db.session.commit()
 
     def is_watching(self, outcome):
@@ -279,6 +322,11 @@ class Log(db.Model):
 # Many to many
 
 class OutcomeAttempt(db.Model):
+    # Scores are always read for a student on an outcome, usually in the order they happened.
+    __table_args__ = (
+        db.Index("ix_outcome_attempt_outcome_user_occurred", "outcome_canvas_id", "user_canvas_id", "occurred"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_canvas_id = db.Column(db.Integer, db.ForeignKey("user.canvas_id", ondelete='CASCADE', onupdate='CASCADE' ))
     outcome_canvas_id = db.Column(db.Integer, db.ForeignKey("outcome.canvas_id", ondelete='CASCADE', onupdate='CASCADE'))
@@ -291,16 +339,56 @@ class OutcomeAttempt(db.Model):
         return "{} - {}".format(self.user, self.occurred)
 
 
+class OutcomeScore(db.Model):
+    """ Materialized outcome score for a student, stored for each calculation method.
+
+    Running aggregates are kept alongside the score so new attempts can be folded in
+    during a sync without reading every stored attempt again.
+    """
+    __table_args__ = (
+        db.UniqueConstraint("user_canvas_id", "outcome_canvas_id", "calculation_method"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_canvas_id = db.Column(db.Integer, db.ForeignKey("user.canvas_id", ondelete='CASCADE', onupdate='CASCADE'))
+    outcome_canvas_id = db.Column(db.Integer, db.ForeignKey("outcome.canvas_id", ondelete='CASCADE', onupdate='CASCADE'))
+    calculation_method = db.Column(db.Enum(MasteryCalculation))
+    attempt_count = db.Column(db.Integer)
+    total = db.Column(db.Integer)
+    highest = db.Column(db.Integer)
+    last_score = db.Column(db.Integer)
+    last_occurred = db.Column(db.DateTime)
+    last_attempt_canvas_id = db.Column(db.Integer)
+    # JSON list of [score, count] pairs in the order each score was first seen
+    histogram = db.Column(db.Text)
+    score = db.Column(db.Float)
+
+    def __repr__(self):
+        return "{} - {} {}".format(self.user_canvas_id, self.calculation_method, self.score)
+
+
 class UserAssignment(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "assignment_id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.canvas_id", onupdate="CASCADE", ondelete="CASCADE"))
     assignment_id = db.Column(db.Integer, db.ForeignKey("assignment.canvas_id", onupdate="CASCADE", ondelete="CASCADE"))
     score = db.Column(db.Integer)
     occurred = db.Column(db.DateTime)
 
+    # The last score sent to Canvas. Only rows where this differs from `score` are posted.
+    posted_score = db.Column(db.Integer)
+    posted_at = db.Column(db.DateTime)
+
     def __repr__(self):
         return "{} - {}".format(self.user, self.score)
 
+    @property
+    def is_dirty(self):
+        return self.posted_at is None or self.posted_score != self.score
+
 
 class UserPreferences(Manager, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -313,7 +401,9 @@ user_courses = db.Table(
     "user_courses", 
     db.Column("id", db.Integer, primary_key=True),
     db.Column("course_id", db.Integer, db.ForeignKey("course.id", onupdate="CASCADE", ondelete="CASCADE")),
-    db.Column("user_id", db.Integer, db.ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE"))
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE")),
+    # The nightly sync and result sync jobs can enroll the same student at the same time
+    db.UniqueConstraint("course_id", "user_id")
 )
 
 course_outcomes = db.Table(
@@ -337,3 +427,53 @@ assignment_outcome = db.Table(
     db.Column("outcome_id", db.Integer, db.ForeignKey("outcome.id", onupdate="CASCADE", ondelete="CASCADE"))
 )
 
+
+class Job(db.Model):
+    """ Background job stored in the database.
+
+    Long Canvas operations are queued here by the web app and run by `flask worker`. Progress
+    is written back as the job runs so the UI can poll for it.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64))
+    status = db.Column(db.Enum(JobStatus), default=JobStatus.QUEUED, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE"))
+    # JSON object of keyword arguments passed to the job handler
+    arguments = db.Column(db.Text)
+    progress = db.Column(db.Integer, default=0)
+    total = db.Column(db.Integer)
+    message = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    user = db.relationship("User")
+
+    def __repr__(self):
+        return "{} {} - {}".format(self.name, self.id, self.status)
+
+    @property
+    def is_finished(self):
+        return self.status in (JobStatus.COMPLETED, JobStatus.FAILED)
+
+    @property
+    def is_stale(self):
+        """ Still RUNNING past JOB_TIMEOUT, so the worker running it has most likely stopped. """
+        return self.status == JobStatus.RUNNING and self.started_at is not None and self.started_at < Job.stale_before()
+
+    @staticmethod
+    def stale_before() -> datetime:
+        """ Jobs started before this time have been running for longer than JOB_TIMEOUT """
+        return datetime.now() - timedelta(seconds=app.config.get('JOB_TIMEOUT', 3600))
+
+    def update_progress(self, progress: int, total: int=None) -> None:
+        """ Store the job progress so it can be read while the job is running.
+
+        Args:
+            progress (int): Number of items finished
+            total (int, optional): Number of items in the job. Left as is when not given.
+        """
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        db.session.commit()
@@ -32,7 +32,7 @@ class CourseSchema(Schema):
     id = fields.Int(dump_only=True)
     canvas_id = fields.Int()
     name = fields.Str()
-    outcomes = fields.List(fields.Nested("OutcomeListSchema"), dump_only=True)
+    outcomes = fields.List(fields.Nested("OutcomeListSchema"), attribute="outcome_list", dump_only=True)
     assignments = fields.List(fields.Nested(lambda: AssignmentSchema(exclude=('watching',))))
     # enrollments = fields.List(fields.Nested(lambda: UserSchema(exclude=('enrollments',))))
 
@@ -89,4 +89,13 @@ class OutcomeAttemptSchema(Schema):
     success = fields.Bool()
     score = fields.Float()
     occurred = fields.DateTime()
-    assignments = fields.List(fields.Nested(lambda: AssignmentSchema(exclude=('watching',))))
\ No newline at end of file
+    assignments = fields.List(fields.Nested(lambda: AssignmentSchema(exclude=('watching',))))
+
+class JobSchema(Schema):
+    id = fields.Int(dump_only=True)
+    name = fields.Str(dump_only=True)
+    status = fields.Function(lambda job: job.status.name.lower())
+    progress = fields.Int(dump_only=True)
+    total = fields.Int(dump_only=True)
+    message = fields.Str(dump_only=True)
+    finished = fields.Bool(attribute="is_finished", dump_only=True)
@@ -0,0 +1,699 @@
+import json
+from collections import Counter, defaultdict
+from datetime import datetime
+from statistics import fmean, mode
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.enums import MasteryCalculation
+from app.models import Course, OutcomeAttempt, OutcomeScore, User, new_version
+from app.util import chunked
+
+
+# Define all of the math to run on a list of outcome scores. These are shared by
+# the <Outcome> model methods and the course-level ScoreService.
+def average(scores: List[int]) -> float:
+    """ Calculate the average of all attempts
+
+    Args:
+        scores (List[int]): attempt scores
+
+    Returns:
+        float: average
+    """
+    if len(scores) == 0:
+        return None
+    return round(fmean(scores), 1)
+
+
+def decaying_average(scores: List[int]) -> float:
+    """ Calulate a decaying average for the attempts.
+
+    The last attempt is weighted higher than the average of all
+    previous attempts. Canvas defaults to 35/65 for weights,
+    those are matched here for consistency.
+
+    Args:
+        scores (List[int]): attempt scores
+
+    Returns:
+        float: decaying average
+    """
+    if len(scores) == 0:
+        return None
+    elif len(scores) == 1:
+        # Handle a single attempt, return as a float for aesthetics.
+        return float(scores[0])
+    else:
+        all = round((fmean(scores[:-1]) * 0.35), 2)
+        last = round((scores[-1] * 0.65), 2)
+        return round(all + last, 1)
+
+
+def highest(scores: List[int]) -> float:
+    """ Return the highest attempt
+
+    Args:
+        scores (List[int]): attempt scores
+
+    Returns:
+        float: highest attempt
+    """
+    if len(scores) == 0:
+        return None
+    return max(scores)
+
+
+def high_last_average(scores: List[int]) -> float:
+    """ Average the last attempt with the highest attempt.
+
+    Args:
+        scores (List[int]): attempt scores
+
+    Returns:
+        float: average
+    """
+    if len(scores) == 0:
+        return None
+    return round((max(scores) + scores[-1]) / 2, 1)
+
+
+def mode_score(scores: List[int]) -> float:
+    """ Return the mode for all stored attempts.
+
+    Args:
+        scores (List[int]): attempt scores
+
+    Returns:
+        float: mode
+    """
+    if len(scores) == 0:
+        return None
+    return mode(scores)
+
+
+CALCULATIONS = {
+    MasteryCalculation.AVERAGE: average,
+    MasteryCalculation.DECAYING_AVERAGE: decaying_average,
+    MasteryCalculation.HIGHEST: highest,
+    MasteryCalculation.HIGH_LAST_AVERAGE: high_last_average,
+    MasteryCalculation.MODE: mode_score,
+}
+
+# These calculations only need the attempt count, the sum, the highest score and
+# the last score, so they can be run from one aggregate row per (student, outcome).
+AGGREGATE_CALCULATIONS = [
+    MasteryCalculation.AVERAGE,
+    MasteryCalculation.DECAYING_AVERAGE,
+    MasteryCalculation.HIGHEST,
+    MasteryCalculation.HIGH_LAST_AVERAGE,
+]
+
+
+# Calculations which return one of the stored attempt scores. These are cast back to
+# int when read from the materialized <OutcomeScore> table.
+INTEGER_CALCULATIONS = [
+    MasteryCalculation.HIGHEST,
+    MasteryCalculation.MODE,
+]
+
+
+# Attempts are always read in this order. Each (student, outcome) pair comes back as one
+# contiguous run, oldest attempt first, so "last" is the same on every database.
+ATTEMPT_ORDER = (
+    OutcomeAttempt.user_canvas_id,
+    OutcomeAttempt.outcome_canvas_id,
+    OutcomeAttempt.occurred,
+    OutcomeAttempt.attempt_canvas_id,
+)
+
+# Rows fetched from the database at a time when streaming attempts
+STREAM_SIZE = 1000
+
+
+def attempt_sort_key(occurred: datetime, attempt_canvas_id: int) -> tuple:
+    """ Position of an attempt in ATTEMPT_ORDER within its (student, outcome) pair """
+    return (occurred or datetime.min, attempt_canvas_id or 0)
+
+
+def attempt_rows(*criteria):
+    """ Stream scored attempts in ATTEMPT_ORDER.
+
+    Args:
+        criteria: filters to apply to <OutcomeAttempt>
+
+    Returns:
+        Query: rows of (user_canvas_id, outcome_canvas_id, attempt_canvas_id, score, occurred)
+    """
+    return db.session.query(
+        OutcomeAttempt.user_canvas_id,
+        OutcomeAttempt.outcome_canvas_id,
+        OutcomeAttempt.attempt_canvas_id,
+        OutcomeAttempt.score,
+        OutcomeAttempt.occurred
+    ).filter(
+        OutcomeAttempt.score.isnot(None),
+        *criteria
+    ).order_by(*ATTEMPT_ORDER).yield_per(STREAM_SIZE)
+
+
+def fold_attempts(rows: Iterable[tuple]) -> Iterator[Tuple[tuple, "ScoreAggregate"]]:
+    """ Fold a stream of attempt rows into one <ScoreAggregate> per student and outcome.
+
+    Rows must be sorted by ATTEMPT_ORDER, as returned by `attempt_rows()`. Only the
+    aggregate for the current pair is held while reading.
+
+    Args:
+        rows (Iterable[tuple]): (user_canvas_id, outcome_canvas_id, attempt_canvas_id, score, occurred)
+
+    Yields:
+        Tuple[tuple, ScoreAggregate]: ((user_canvas_id, outcome_canvas_id), aggregate)
+    """
+    pair = None
+    aggregate = None
+
+    for user_canvas_id, outcome_canvas_id, attempt_canvas_id, score, occurred in rows:
+        if (user_canvas_id, outcome_canvas_id) != pair:
+            if pair is not None:
+                yield pair, aggregate
+            pair = (user_canvas_id, outcome_canvas_id)
+            aggregate = ScoreAggregate()
+
+        aggregate.add(score, occurred, attempt_canvas_id)
+
+    if pair is not None:
+        yield pair, aggregate
+
+
+def calculate_from_aggregates(method: MasteryCalculation, count: int, total: int, high: int, last: int) -> float:
+    """ Run a calculation from aggregate values instead of a full list of attempts.
+
+    Results match the list-based calculations above.
+
+    Args:
+        method (MasteryCalculation): One of AGGREGATE_CALCULATIONS
+        count (int): number of attempts
+        total (int): sum of all attempt scores
+        high (int): highest attempt score
+        last (int): score of the last attempt
+
+    Returns:
+        float: calculated score
+    """
+    if not count:
+        return None
+
+    if method is MasteryCalculation.AVERAGE:
+        return round(total / count, 1)
+    elif method is MasteryCalculation.DECAYING_AVERAGE:
+        if count == 1:
+            return float(last)
+        all = round(((total - last) / (count - 1)) * 0.35, 2)
+        last = round((last * 0.65), 2)
+        return round(all + last, 1)
+    elif method is MasteryCalculation.HIGHEST:
+        return high
+    elif method is MasteryCalculation.HIGH_LAST_AVERAGE:
+        return round((high + last) / 2, 1)
+    else:
+        raise ValueError(f"{method.name} cannot be calculated from aggregates.")
+
+
+class ScoreService:
+    """
+    Calculate outcome scores for every student in a course at once.
+
+    Calling the <Outcome> score methods in a loop runs one query per student per outcome.
+    The gradebook reads the materialized <OutcomeScore> table instead (see
+    `record_outcome_attempts()` and `rebuild_outcome_scores()`), so the whole course is read
+    in a single query. `get_matrix()` calculates every method from the attempts themselves,
+    reading them in a single ordered query and folding them into a running aggregate per
+    (student, outcome) pair. `calculate_scores()` runs a single method, grouping the attempts
+    in SQL where the method allows it.
+    """
+
+    def __init__(self: None, course: Course, students: List[User]=None, outcomes: list=None) -> None:
+        self.course = course
+        self.outcomes = outcomes if outcomes is not None else course.outcomes.all()
+
+        if students is None:
+            students = course.enrollments.filter(User.usertype_id == 3).all()
+        self.students = students
+
+    def get_attempt_aggregates(self: None) -> Dict[tuple, "ScoreAggregate"]:
+        """ Fold every attempt for the course into a <ScoreAggregate> per student and outcome.
+
+        Attempts are read in one ordered, streaming query, so scores aren't collected into
+        lists first.
+
+        Returns:
+            Dict[tuple, ScoreAggregate]: aggregates keyed by (user_canvas_id, outcome_canvas_id)
+        """
+        outcome_ids = [outcome.canvas_id for outcome in self.outcomes]
+        user_ids = [student.canvas_id for student in self.students]
+
+        if not outcome_ids or not user_ids:
+            return {}
+
+        return dict(fold_attempts(attempt_rows(
+            OutcomeAttempt.outcome_canvas_id.in_(outcome_ids),
+            OutcomeAttempt.user_canvas_id.in_(user_ids)
+        )))
+
+    def get_aggregates(self: None) -> Dict[tuple, tuple]:
+        """ Aggregate attempts in the database, returning one row per student and outcome.
+
+        The last attempt is the one with the latest `occurred` value, with the attempt
+        Canvas ID as a tie breaker. It is looked up with a correlated subquery so the
+        query runs on both SQLite and MySQL. Unscored attempts are skipped, like everywhere
+        else scores are calculated.
+
+        Returns:
+            Dict[tuple, tuple]: (count, sum, highest, last) keyed by (user_canvas_id, outcome_canvas_id)
+        """
+        outcome_ids = [outcome.canvas_id for outcome in self.outcomes]
+        user_ids = [student.canvas_id for student in self.students]
+
+        if not outcome_ids or not user_ids:
+            return {}
+
+        last_attempt = aliased(OutcomeAttempt)
+        last_score = select(last_attempt.score).where(
+            last_attempt.user_canvas_id == OutcomeAttempt.user_canvas_id,
+            last_attempt.outcome_canvas_id == OutcomeAttempt.outcome_canvas_id,
+            last_attempt.score.isnot(None)
+        ).order_by(
+            last_attempt.occurred.desc(),
+            last_attempt.attempt_canvas_id.desc()
+        ).limit(1).correlate(OutcomeAttempt).scalar_subquery()
+
+        rows = db.session.query(
+            OutcomeAttempt.user_canvas_id,
+            OutcomeAttempt.outcome_canvas_id,
+            func.count(OutcomeAttempt.score),
+            func.coalesce(func.sum(OutcomeAttempt.score), 0),
+            func.max(OutcomeAttempt.score),
+            last_score
+        ).filter(
+            OutcomeAttempt.score.isnot(None),
+            OutcomeAttempt.outcome_canvas_id.in_(outcome_ids),
+            OutcomeAttempt.user_canvas_id.in_(user_ids)
+        ).group_by(
+            OutcomeAttempt.user_canvas_id,
+            OutcomeAttempt.outcome_canvas_id
+        )
+
+        # MySQL returns SUM() as a Decimal, so cast back to int for the math.
+        return {
+            (user_canvas_id, outcome_canvas_id): (count, int(total), high, last)
+            for user_canvas_id, outcome_canvas_id, count, total, high, last in rows
+        }
+
+    def calculate_scores(self: None, method: MasteryCalculation) -> Dict[int, Dict[int, float]]:
+        """ Calculate a single score method for every student and outcome from stored attempts.
+
+        Methods in AGGREGATE_CALCULATIONS are calculated from aggregates in the database. Others
+        fall back to loading the attempts.
+
+        Args:
+            method (MasteryCalculation): Calculation to run
+
+        Returns:
+            Dict[int, Dict[int, float]]: {user_canvas_id: {outcome_canvas_id: score}}
+        """
+        if method not in AGGREGATE_CALCULATIONS:
+            matrix = self.get_matrix([method])
+            return {
+                user_canvas_id: {outcome_canvas_id: scores[method.name] for outcome_canvas_id, scores in row.items()}
+                for user_canvas_id, row in matrix.items()
+            }
+
+        aggregates = self.get_aggregates()
+        empty = (0, 0, None, None)
+
+        return {
+            student.canvas_id: {
+                outcome.canvas_id: calculate_from_aggregates(
+                    method, *aggregates.get((student.canvas_id, outcome.canvas_id), empty)
+                )
+                for outcome in self.outcomes
+            }
+            for student in self.students
+        }
+
+    def get_scores(self: None, method: MasteryCalculation) -> Dict[int, Dict[int, float]]:
+        """ Read a single score method for every student and outcome from the materialized
+        <OutcomeScore> table. Students without attempts on an outcome get None.
+
+        Args:
+            method (MasteryCalculation): Calculation to read
+
+        Returns:
+            Dict[int, Dict[int, float]]: {user_canvas_id: {outcome_canvas_id: score}}
+        """
+        scores = {
+            student.canvas_id: {outcome.canvas_id: None for outcome in self.outcomes}
+            for student in self.students
+        }
+
+        outcome_ids = [outcome.canvas_id for outcome in self.outcomes]
+        user_ids = [student.canvas_id for student in self.students]
+
+        if not outcome_ids or not user_ids or method not in CALCULATIONS:
+            return scores
+
+        rows = db.session.query(
+            OutcomeScore.user_canvas_id,
+            OutcomeScore.outcome_canvas_id,
+            OutcomeScore.score
+        ).filter(
+            OutcomeScore.calculation_method == method,
+            OutcomeScore.outcome_canvas_id.in_(outcome_ids),
+            OutcomeScore.user_canvas_id.in_(user_ids)
+        )
+
+        for user_canvas_id, outcome_canvas_id, score in rows:
+            if score is not None and method in INTEGER_CALCULATIONS:
+                score = int(score)
+            scores[user_canvas_id][outcome_canvas_id] = score
+
+        return scores
+
+    def missing_scores(self: None, method: MasteryCalculation) -> set:
+        """ Find students and outcomes with scored attempts but no stored <OutcomeScore>.
+
+        Those scores haven't been built yet, eg before `flask rebuild-scores` has run, so a None
+        from `get_scores()` doesn't mean the student has no attempts.
+
+        Args:
+            method (MasteryCalculation): Calculation to check
+
+        Returns:
+            set: (user_canvas_id, outcome_canvas_id) pairs
+        """
+        outcome_ids = [outcome.canvas_id for outcome in self.outcomes]
+        user_ids = [student.canvas_id for student in self.students]
+
+        if not outcome_ids or not user_ids:
+            return set()
+
+        rows = db.session.query(
+            OutcomeAttempt.user_canvas_id,
+            OutcomeAttempt.outcome_canvas_id
+        ).outerjoin(OutcomeScore, and_(
+            OutcomeScore.user_canvas_id == OutcomeAttempt.user_canvas_id,
+            OutcomeScore.outcome_canvas_id == OutcomeAttempt.outcome_canvas_id,
+            OutcomeScore.calculation_method == method
+        )).filter(
+            OutcomeAttempt.score.isnot(None),
+            OutcomeAttempt.outcome_canvas_id.in_(outcome_ids),
+            OutcomeAttempt.user_canvas_id.in_(user_ids),
+            OutcomeScore.id.is_(None)
+        ).distinct()
+
+        return {(user_canvas_id, outcome_canvas_id) for user_canvas_id, outcome_canvas_id in rows}
+
+    def get_matrix(self: None, methods: List[MasteryCalculation]=None) -> Dict[int, Dict[int, Dict[str, float]]]:
+        """ Build a student x outcome score matrix.
+
+        Every requested calculation is read from the aggregate for each (student, outcome) pair,
+        built in a single ordered pass over the attempts.
+
+        Args:
+            methods (List[MasteryCalculation], optional): Calculations to run. Defaults to all of them.
+
+        Returns:
+            Dict[int, Dict[int, Dict[str, float]]]: {user_canvas_id: {outcome_canvas_id: {method name: score}}}
+        """
+        if methods is None:
+            methods = list(CALCULATIONS)
+
+        aggregates = self.get_attempt_aggregates()
+        empty = ScoreAggregate()
+        matrix = {}
+
+        for student in self.students:
+            row = {}
+            for outcome in self.outcomes:
+                aggregate = aggregates.get((student.canvas_id, outcome.canvas_id), empty)
+                row[outcome.canvas_id] = {
+                    method.name: aggregate.score(method) if method in CALCULATIONS else None
+                    for method in methods
+                }
+            matrix[student.canvas_id] = row
+
+        return matrix
+
+    def apply_scores(self: None, user: User) -> List[User]:
+        """ Attach a `scores` list to each student for rendering the gradebook.
+
+        Scores are calculated with the calculation method set in `user`'s preferences.
+
+        Args:
+            user (User): <User> whose preferences decide the calculation method
+
+        Returns:
+            List[User]: students with scores set
+        """
+        if not self.students or not self.outcomes:
+            for student in self.students:
+                student.scores = []
+            return self.students
+
+        scores = self.get_scores(user.preferences.score_calculation_method)
+
+        for student in self.students:
+            student.scores = [
+                {
+                    "outcome_canvas_id": outcome.canvas_id,
+                    "score": scores[student.canvas_id][outcome.canvas_id]
+                }
+                for outcome in self.outcomes
+            ]
+
+        return self.students
+
+
+class ScoreAggregate:
+    """
+    Running aggregate of the attempts for one student on one outcome. Attempts can be
+    added one at a time and every calculation method can be read at any point.
+    """
+
+    def __init__(
+        self: None,
+        count: int=0,
+        total: int=0,
+        highest: int=None,
+        last_score: int=None,
+        last_occurred: datetime=None,
+        last_attempt_canvas_id: int=None,
+        histogram: list=None
+    ) -> None:
+        self.count = count
+        self.total = total
+        self.highest = highest
+        self.last_score = last_score
+        self.last_occurred = last_occurred
+        self.last_attempt_canvas_id = last_attempt_canvas_id
+        # Scores are kept in the order they were first seen so the mode breaks ties
+        # the same way as `statistics.mode`.
+        self.histogram = Counter(dict(histogram or []))
+
+    @classmethod
+    def from_row(cls, row: OutcomeScore) -> "ScoreAggregate":
+        return cls(
+            count=row.attempt_count,
+            total=row.total,
+            highest=row.highest,
+            last_score=row.last_score,
+            last_occurred=row.last_occurred,
+            last_attempt_canvas_id=row.last_attempt_canvas_id,
+            histogram=json.loads(row.histogram) if row.histogram else None
+        )
+
+    def add(self: None, score: int, occurred: datetime, attempt_canvas_id: int) -> None:
+        """ Fold a single attempt into the aggregate.
+
+        Args:
+            score (int): attempt score
+            occurred (datetime): when the attempt was assessed
+            attempt_canvas_id (int): Canvas ID for the attempt
+        """
+        self.count += 1
+        self.total += score
+        self.highest = score if self.highest is None else max(self.highest, score)
+        self.histogram[score] += 1
+
+        # Attempts can arrive out of order, so only move the last attempt forward.
+        if self.last_score is None or attempt_sort_key(occurred, attempt_canvas_id) >= attempt_sort_key(
+            self.last_occurred, self.last_attempt_canvas_id
+        ):
+            self.last_score = score
+            self.last_occurred = occurred
+            self.last_attempt_canvas_id = attempt_canvas_id
+
+    def score(self: None, method: MasteryCalculation) -> float:
+        """ Calculate a score method from the aggregate.
+
+        Args:
+            method (MasteryCalculation): Calculation to run
+
+        Returns:
+            float: calculated score
+        """
+        if self.count == 0:
+            return None
+        if method is MasteryCalculation.MODE:
+            return self.histogram.most_common(1)[0][0]
+        return calculate_from_aggregates(method, self.count, self.total, self.highest, self.last_score)
+
+    def update_row(self: None, row: OutcomeScore) -> OutcomeScore:
+        """ Copy the aggregate values onto an <OutcomeScore> row.
+
+        Args:
+            row (OutcomeScore): row to update
+
+        Returns:
+            OutcomeScore: updated row
+        """
+        row.attempt_count = self.count
+        row.total = self.total
+        row.highest = self.highest
+        row.last_score = self.last_score
+        row.last_occurred = self.last_occurred
+        row.last_attempt_canvas_id = self.last_attempt_canvas_id
+        row.histogram = json.dumps(list(self.histogram.items()))
+        row.score = self.score(row.calculation_method)
+        return row
+
+
+def record_outcome_attempts(attempts: Iterable[dict], rebuild: bool=False) -> int:
+    """ Fold newly stored attempts into the materialized <OutcomeScore> table.
+
+    This is called by the sync service in the same transaction as the attempt insert, so it
+    does not commit. Pairs that have no stored scores yet are rebuilt from all of their
+    attempts, which includes the new ones. So are pairs where a new attempt sorts before the
+    stored last attempt: the MODE histogram keeps scores in the order they were first seen,
+    and folding an older attempt in at the end would break ties differently from a rebuild.
+    All of the rebuilt pairs are read in one query.
+
+    Args:
+        attempts (Iterable[dict]): <OutcomeAttempt> column values for the inserted rows
+        rebuild (bool, optional): Rebuild every pair from stored attempts instead of folding
+            `attempts` in. Use this when some of `attempts` may already have been stored. Defaults to False.
+
+    Returns:
+        int: number of (student, outcome) pairs updated
+    """
+    new_attempts = defaultdict(list)
+    for attempt in attempts:
+        new_attempts[(attempt["user_canvas_id"], attempt["outcome_canvas_id"])].append(attempt)
+
+    if not new_attempts:
+        return 0
+
+    # Make sure new attempts are visible to queries for pairs which need a rebuild.
+    db.session.flush()
+
+    user_ids = {user_canvas_id for user_canvas_id, _ in new_attempts}
+    outcome_ids = {outcome_canvas_id for _, outcome_canvas_id in new_attempts}
+
+    stored = defaultdict(dict)
+    for row in OutcomeScore.query.filter(
+        OutcomeScore.user_canvas_id.in_(user_ids),
+        OutcomeScore.outcome_canvas_id.in_(outcome_ids)
+    ):
+        stored[(row.user_canvas_id, row.outcome_canvas_id)][row.calculation_method] = row
+
+    def in_order(pair):
+        last = next(iter(stored[pair].values()))
+        last_key = attempt_sort_key(last.last_occurred, last.last_attempt_canvas_id)
+        return all(
+            attempt_sort_key(attempt["occurred"], attempt["attempt_canvas_id"]) > last_key
+            for attempt in new_attempts[pair]
+        )
+
+    rebuild_pairs = set(new_attempts) if rebuild else {
+        pair for pair in new_attempts if pair not in stored or not in_order(pair)
+    }
+    rebuilt = {}
+    if rebuild_pairs:
+        rebuilt = {
+            pair: aggregate for pair, aggregate in fold_attempts(attempt_rows(
+                OutcomeAttempt.user_canvas_id.in_({user_canvas_id for user_canvas_id, _ in rebuild_pairs}),
+                OutcomeAttempt.outcome_canvas_id.in_({outcome_canvas_id for _, outcome_canvas_id in rebuild_pairs})
+            ))
+            if pair in rebuild_pairs
+        }
+
+    for pair, pair_attempts in new_attempts.items():
+        rows = stored.get(pair)
+
+        if pair in rebuild_pairs:
+            aggregate = rebuilt.get(pair, ScoreAggregate())
+        else:
+            aggregate = ScoreAggregate.from_row(next(iter(rows.values())))
+            pair_attempts = sorted(
+                pair_attempts, key=lambda attempt: attempt_sort_key(attempt["occurred"], attempt["attempt_canvas_id"])
+            )
+            for attempt in pair_attempts:
+                aggregate.add(attempt["score"], attempt["occurred"], attempt["attempt_canvas_id"])
+
+        for method in CALCULATIONS:
+            row = rows.get(method) if rows else None
+            if row is None:
+                row = OutcomeScore(
+                    user_canvas_id=pair[0],
+                    outcome_canvas_id=pair[1],
+                    calculation_method=method
+                )
+                db.session.add(row)
+            aggregate.update_row(row)
+
+    return len(new_attempts)
+
+
+def rebuild_outcome_scores() -> int:
+    """ Rebuild the materialized <OutcomeScore> table from every stored attempt.
+
+    Returns:
+        int: number of (student, outcome) pairs stored
+    """
+    OutcomeScore.query.delete()
+
+    user_ids = sorted(
+        user_canvas_id for user_canvas_id, in db.session.query(OutcomeAttempt.user_canvas_id).distinct()
+    )
+
+    # Students are rebuilt in batches so the session stays small. Each batch is read to the
+    # end before its rows are written because a streaming read can't share the connection
+    # with writes on MySQL.
+    count = 0
+    for chunk in chunked(user_ids, STREAM_SIZE):
+        rows = []
+        for (user_canvas_id, outcome_canvas_id), aggregate in fold_attempts(
+            attempt_rows(OutcomeAttempt.user_canvas_id.in_(chunk))
+        ):
+            for method in CALCULATIONS:
+                row = OutcomeScore(
+                    user_canvas_id=user_canvas_id,
+                    outcome_canvas_id=outcome_canvas_id,
+                    calculation_method=method
+                )
+                rows.append(aggregate.update_row(row))
+            count += 1
+
+        db.session.add_all(rows)
+        db.session.flush()
+        for row in rows:
+            db.session.expunge(row)
+
+    # Rendered gradebooks may have been built from the old rows.
+    Course.query.update({Course.version: new_version()}, synchronize_session=False)
+    db.session.commit()
+
+    return count
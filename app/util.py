@@ -1,5 +1,12 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from decimal import ROUND_HALF_UP, Decimal
 from functools import wraps
-from flask import abort, g, redirect, request, url_for
+from itertools import islice
+from typing import Any, Hashable, Iterable, Iterator, List
+from flask import Response, abort, g, make_response, redirect, request, url_for
 from flask_login import current_user
 
 
@@ -15,4 +22,211 @@ def restricted():
                     return abort(401, "You do not have permission to view this page.")
                 return func(*args, **kwargs)
         return __restricted
-    return _restricted
\ No newline at end of file
+    return _restricted
+
+
+def make_etag(*parts) -> str:
+    """ Build an ETag value from everything a response depends on.
+
+    Args:
+        parts: values that change whenever the response would, eg <Course>.version
+
+    Returns:
+        str: ETag value, without quotes
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag: str) -> Response:
+    """ Answer a conditional GET before doing any work for it.
+
+    Args:
+        etag (str): ETag the full response would have
+
+    Returns:
+        Response: an empty 304 when the client already has `etag`, otherwise None
+    """
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(Response(status=304), etag)
+    return None
+
+
+def with_etag(rv, etag: str) -> Response:
+    """ Attach a strong ETag to a view's return value.
+
+    Clients are told to revalidate every time, which the ETag turns into a 304 when
+    nothing changed. htmx and full page requests get different bodies from the same URL.
+    """
+    response = make_response(rv)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.update(['Cookie', 'HX-Request'])
+    return response
+
+
+class LRUCache:
+    """ Thread-safe mapping that drops the least recently used entry past `max_size` items. """
+
+    def __init__(self, max_size: int=256):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """ Split an iterable into lists of at most `size` items without loading
+    the whole iterable into memory.
+
+    Args:
+        iterable (Iterable): items to split
+        size (int): maximum chunk size
+
+    Yields:
+        List: next chunk of items
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_canvas_datetime(value: str) -> datetime:
+    """ Parse an ISO 8601 timestamp from the Canvas API.
+
+    Canvas sends UTC with a trailing Z, eg "2022-03-04T17:46:29Z", but fractional seconds and
+    other offsets are accepted too. Before Python 3.11 `fromisoformat` doesn't understand Z
+    and only takes 3 or 6 fractional digits, so those are normalized first.
+
+    Args:
+        value (str): timestamp string
+
+    Returns:
+        datetime: timezone-aware datetime in UTC. Values without an offset are taken as UTC.
+    """
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+
+    if '.' in value:
+        head, fraction = value.split('.', 1)
+        digits = len(fraction) - len(fraction.lstrip('0123456789'))
+        value = f"{head}.{fraction[:digits][:6].ljust(6, '0')}{fraction[digits:]}"
+
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def canvas_score(value: float) -> int:
+    """ Convert a Canvas outcome score to the integer stored in <OutcomeAttempt>.score.
+
+    Canvas sends scores as floats, eg 2.5, and MySQL rounds them half away from zero when
+    they're written to an INTEGER column. Rounding here first means the values folded into
+    the materialized scores are the ones a rebuild reads back.
+
+    Args:
+        value (float): score from the Canvas API
+
+    Returns:
+        int: rounded score
+    """
+    return int(Decimal(str(value)).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def upsert(model, rows: List[dict], index_elements: List[str], update_columns: List[str], size: int=500) -> None:
+    """ Insert rows, updating the existing row when a unique key already exists.
+
+    Uses `INSERT ... ON DUPLICATE KEY UPDATE` on MySQL and `INSERT ... ON CONFLICT DO UPDATE`
+    on SQLite. Rows are written in batches of `size` to stay under the bound parameter limits.
+    This does not commit.
+
+    Args:
+        model: SQLAlchemy model to write to
+        rows (List[dict]): column values for each row
+        index_elements (List[str]): columns in the unique constraint being checked
+        update_columns (List[str]): columns to overwrite on an existing row
+        size (int, optional): rows per statement. Defaults to 500.
+    """
+    from app import db
+
+    dialect = db.engine.dialect.name
+    table = model.__table__
+
+    for chunk in chunked(rows, size):
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(table).values(chunk)
+            statement = statement.on_duplicate_key_update(
+                {column: statement.inserted[column] for column in update_columns}
+            )
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+            statement = insert(table).values(chunk)
+            statement = statement.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={column: statement.excluded[column] for column in update_columns}
+            )
+        else:
+            raise NotImplementedError(f"Upserts are not supported on {dialect}.")
+
+        db.session.execute(statement)
+
+
+def insert_ignore(model, rows: List[dict], size: int=500) -> int:
+    """ Insert rows, skipping any that would break a unique constraint.
+
+    Uses `INSERT IGNORE` on MySQL and `INSERT ... ON CONFLICT DO NOTHING` on SQLite. Rows are
+    written in executemany batches of `size`. This does not commit.
+
+    Args:
+        model: SQLAlchemy model or Table to write to
+        rows (List[dict]): column values for each row
+        size (int, optional): rows per executemany batch. Defaults to 500.
+
+    Returns:
+        int: number of rows actually inserted
+    """
+    from app import db
+
+    dialect = db.engine.dialect.name
+    table = getattr(model, '__table__', model)
+
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table).prefix_with('IGNORE')
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        statement = insert(table).on_conflict_do_nothing()
+    else:
+        raise NotImplementedError(f"Insert ignore is not supported on {dialect}.")
+
+    # Executemany leaves the statement cached and lets the driver batch rows. Both drivers
+    # report the rows actually inserted across the whole batch.
+    inserted = 0
+    for chunk in chunked(rows, size):
+        inserted += db.session.execute(statement, chunk).rowcount
+
+    return inserted
@@ -0,0 +1,83 @@
+"""
+Benchmark parsing Canvas outcome result timestamps.
+
+Compares the per-row cost of the `strptime` call the sync used to make with
+`app.util.parse_canvas_datetime` on the same timestamps Canvas sends, eg
+"2022-03-04T17:46:29Z". A second run mixes in fractional seconds and offsets.
+
+Run from the project root with the same environment as the app:
+
+    python benchmarks/canvas_datetime_parsing.py
+    python benchmarks/canvas_datetime_parsing.py --results 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.util import parse_canvas_datetime
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--results', type=int, default=100_000, help='Timestamps to parse (default: 100,000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case (default: 5)')
+    return parser.parse_args()
+
+
+def timestamps(count, mixed=False):
+    random.seed(42)
+    start = datetime(2022, 1, 1)
+    values = []
+    for i in range(count):
+        dt = start + timedelta(seconds=random.randrange(365 * 24 * 3600))
+        if not mixed or i % 3 == 0:
+            values.append(dt.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        elif i % 3 == 1:
+            values.append(dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{random.randrange(1000):03d}Z")
+        else:
+            values.append(dt.strftime("%Y-%m-%dT%H:%M:%S-06:00"))
+    return values
+
+
+def strptime(value):
+    return datetime.strptime(value[:-1], "%Y-%m-%dT%H:%M:%S")
+
+
+def measure(func, values, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in values:
+            func(value)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    args = parse_args()
+
+    plain = timestamps(args.results)
+    mixed = timestamps(args.results, mixed=True)
+
+    results = [
+        ("strptime", measure(strptime, plain, args.repeat)),
+        ("parse_canvas_datetime", measure(parse_canvas_datetime, plain, args.repeat)),
+        # strptime can't read the fractional or offset forms, so there's nothing to compare here
+        ("parse_canvas_datetime (mixed)", measure(parse_canvas_datetime, mixed, args.repeat)),
+    ]
+
+    print(f'Parsing {args.results:,} timestamps\n')
+    print(f'{"Case":<32}{"Total (ms)":>12}{"Per row (us)":>14}{"vs strptime":>13}')
+    baseline = results[0][1]
+    for name, seconds in results:
+        print(f'{name:<32}{seconds * 1000:>12.1f}{seconds / args.results * 1e6:>14.2f}{baseline / seconds:>12.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,41 @@ class Config(object):
     CANVAS_URI = os.environ.get('CANVAS_URI')
     CANVAS_KEY = os.environ.get('CANVAS_KEY')
 
+    # Canvas clients are shared within each process so HTTP connections are reused.
+    # Tokens idle for CANVAS_CLIENT_TTL seconds are dropped, and the least recently used
+    # is dropped past CANVAS_CLIENT_MAX. Each client keeps up to CANVAS_CLIENT_POOL_SIZE
+    # connections open.
+    CANVAS_CLIENT_MAX = 128
+    CANVAS_CLIENT_TTL = 3600
+    CANVAS_CLIENT_POOL_SIZE = 10
+
+    # Rendered teacher gradebooks kept in memory by each process
+    GRADEBOOK_CACHE_SIZE = 256
+
+    # `flask sync` skips outcome results dated more than this many days before the latest
+    # result already stored for the course. Canvas dates a result with its submission time,
+    # so this is how late an old submission can be graded and still be picked up. Run
+    # `flask sync --full` to read everything.
+    RESULTS_SYNC_LOOKBACK_DAYS = 30
+
+    # Count queries, Canvas calls and render time for each request. Results are sent in a
+    # Server-Timing header, logged and shown on /admin/metrics. Endpoints going over their
+    # QUERY_BUDGETS log a warning, or fail with QUERY_BUDGETS_ENFORCE.
+    INSTRUMENTATION = False
+    QUERY_BUDGETS = {}
+    QUERY_BUDGETS_ENFORCE = False
+
+    # Counters, gauges and histograms are served in the Prometheus text format on /metrics to admins
+    # and to requests with `Authorization: Bearer <METRICS_TOKEN>`. Without a token only admins
+    # can read them. CLI commands log a JSON summary when they finish and append it to
+    # METRICS_SUMMARY_FILE, when set.
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_SUMMARY_FILE = 'logs/metrics.jsonl'
+
+    # Seconds a background job may run before it's assumed its worker died. `flask worker`
+    # fails older RUNNING jobs, and the job status stops polling them.
+    JOB_TIMEOUT = 3600
+
     # Set your OAuth parameters in your environment file or
     # overwrite each key below with your Canvas information.
     CANVAS_OAUTH = {
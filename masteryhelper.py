@@ -1,12 +1,17 @@
+import click
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging.handlers import RotatingFileHandler
 
 from app import app, db
 from app.models import (
     Assignment, 
     Course, 
+    Job,
     Outcome,
     OutcomeAttempt, 
+    OutcomeScore,
     User,
     UserType
     )
@@ -17,8 +22,10 @@ def make_shell_context():
         'db': db,
         'Assignment': Assignment,
         'Course': Course,
+        'Job': Job,
         'Outcome': Outcome,
         'OutcomeAttempt': OutcomeAttempt,
+        'OutcomeScore': OutcomeScore,
         'User': User,
         'UserType': UserType
     }
@@ -38,9 +45,72 @@ def seed():
     print('Roles created successfully.')
 
 
+@app.cli.command('rebuild-scores')
+def rebuild_scores():
+    """ Rebuild the stored outcome scores from all outcome attempts.
+    """
+    from app.metrics import cli_run
+    from app.score_service import rebuild_outcome_scores
+    print('Rebuilding outcome scores')
+    with cli_run('rebuild-scores'):
+        count = rebuild_outcome_scores()
+    print('Stored scores for {} student outcomes.'.format(count))
+
+
+@app.cli.command('worker')
+@click.option('--interval', default=2.0, show_default=True, help='Seconds to wait between checks when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty instead of waiting for new jobs.')
+def worker(interval, once):
+    """ Run queued background jobs.
+    """
+    from app.job_service import work
+    from app.metrics import cli_run
+    app.logger.setLevel('INFO')
+    app.logger.info('Worker started')
+    with cli_run('worker'):
+        count = work(interval=interval, once=once)
+    app.logger.info('Worker finished {} jobs'.format(count))
+
+
+def sync_course(service, course_id: int, full: bool=False) -> str:
+    """ Sync enrollments and outcome attempts for a single course.
+
+    This runs in a worker thread during `flask sync`, so it pushes its own app context
+    and gets its own database session.
+    """
+    from app.canvas_sync_service import sync_phase_seconds
+
+    with app.app_context(), sync_phase_seconds.time(phase='course'):
+        start = time.perf_counter()
+        try:
+            course = Course.query.get(course_id)
+            app.logger.info('Starting {}'.format(course.name))
+
+            # Pick up added and dropped students first so new students' results are stored.
+            with sync_phase_seconds.time(phase='enrollments'):
+                service.get_enrollments(course.canvas_id)
+
+            outcome_ids = [outcome.canvas_id for outcome in course.outcomes.all()]
+            if outcome_ids:
+                with sync_phase_seconds.time(phase='outcome_attempts'):
+                    result = service.get_outcome_attempts(course.canvas_id, outcome_ids, full=full)
+            else:
+                result = "No outcomes stored for {}".format(course.name)
+            app.logger.info('{}: {} ({:.1f}s)'.format(course.name, result, time.perf_counter() - start))
+            return result
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Sync failed for course {} after {:.1f}s'.format(course_id, time.perf_counter() - start))
+            raise
+        finally:
+            db.session.remove()
+
+
 @app.cli.command('sync')
-def sync():
-    """ Sync outcome attempts from Canvas for all courses.
+@click.option('--full', is_flag=True, help='Process every outcome result instead of only results since the last sync, less the lookback window.')
+@click.option('--workers', default=1, show_default=True, type=click.IntRange(min=1), help='Number of courses to sync at once.')
+def sync(full, workers):
+    """ Sync enrollments and outcome attempts from Canvas for all courses.
     """
     # Handle logging for this execution
 
@@ -56,18 +126,43 @@ def sync():
     app.logger.setLevel('INFO')
     app.logger.info('Startup')
 
-    from app.canvas_sync_service import CanvasSyncService
-    app.logger.info('Starting sync...')
-    courses = Course.query.all()
-    service = CanvasSyncService('server_only')
-    for course in courses:
-        app.logger.info('Starting {}'.format(course.name))
-        outcome_ids = [outcome.canvas_id for outcome in course.outcomes.all()]
-        if outcome_ids:
-            result = service.get_outcome_attempts(course.canvas_id, outcome_ids)
-        else:
-            result = "No outcomes stored for {}".format(course.name)
-        app.logger.info(result)
-    app.logger.info('Finished')
+    from app.canvas_sync_service import CanvasSyncService, courses_synced
+    from app.metrics import cli_run
+
+    # The metrics summary is logged and appended to METRICS_SUMMARY_FILE when the run ends,
+    # so throughput can be charted across nightly runs.
+    with cli_run('sync'):
+        app.logger.info('Starting sync with {} worker(s)...'.format(workers))
+        start = time.perf_counter()
+
+        course_ids = [course.id for course in Course.query.all()]
+        db.session.remove()
+
+        # All workers share one Canvas client so HTTP connections are reused. Each worker can
+        # have several pages of results in flight.
+        service = CanvasSyncService('server_only')
+        service.set_connection_pool_size(workers * service.page_workers)
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(sync_course, service, course_id, full): course_id for course_id in course_ids}
+
+            # One failing course shouldn't stop the rest of the run. The error is logged by
+            # the worker, so only keep track of which courses failed here.
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    failed.append(futures[future])
+                    courses_synced.inc(result='failed')
+                else:
+                    courses_synced.inc(result='completed')
+
+        app.logger.info('Finished {} courses in {:.1f}s. {} failed: {}'.format(
+            len(course_ids), time.perf_counter() - start, len(failed), failed
+        ))
+
+        from app.canvas_auth_service import clients
+        for state in clients.bucket_states():
+            app.logger.info('Canvas token {token}: {requests} requests, {throttled} throttled, '
+                            '{remaining} quota left, {limit} at once'.format(**state))
 
     app.logger.removeHandler(file_handler)
@@ -0,0 +1,118 @@
+"""backfill outcome score
+
+Revision ID: b3e8f1c6d2a4
+Revises: c4a91d2e7b35
+Create Date: 2026-10-18 18:40:12.551903
+
+"""
+import uuid
+from types import SimpleNamespace
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e8f1c6d2a4'
+down_revision = 'c4a91d2e7b35'
+branch_labels = None
+depends_on = None
+
+# Students read at a time
+BATCH_SIZE = 500
+
+
+def upgrade():
+    # outcome_score was created empty. Until it's filled every student reads as having no
+    # score, which grades as 0, so build it from the stored attempts here. Databases that
+    # already ran `flask rebuild-scores` are left alone.
+    from app.score_service import CALCULATIONS, ScoreAggregate
+
+    conn = op.get_bind()
+
+    attempt = sa.table(
+        'outcome_attempt',
+        sa.column('user_canvas_id', sa.Integer),
+        sa.column('outcome_canvas_id', sa.Integer),
+        sa.column('attempt_canvas_id', sa.Integer),
+        sa.column('score', sa.Integer),
+        sa.column('occurred', sa.DateTime),
+    )
+    outcome_score = sa.table(
+        'outcome_score',
+        sa.column('id', sa.Integer),
+        sa.column('user_canvas_id', sa.Integer),
+        sa.column('outcome_canvas_id', sa.Integer),
+        sa.column('calculation_method', sa.String),
+        sa.column('attempt_count', sa.Integer),
+        sa.column('total', sa.Integer),
+        sa.column('highest', sa.Integer),
+        sa.column('last_score', sa.Integer),
+        sa.column('last_occurred', sa.DateTime),
+        sa.column('last_attempt_canvas_id', sa.Integer),
+        sa.column('histogram', sa.Text),
+        sa.column('score', sa.Float),
+    )
+
+    if conn.execute(sa.select(sa.func.count()).select_from(outcome_score)).scalar():
+        return
+
+    user_ids = [
+        user_id for (user_id,) in conn.execute(
+            sa.select(attempt.c.user_canvas_id).where(attempt.c.score.isnot(None)).distinct()
+        )
+    ]
+
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        rows = conn.execute(
+            sa.select(
+                attempt.c.user_canvas_id,
+                attempt.c.outcome_canvas_id,
+                attempt.c.attempt_canvas_id,
+                attempt.c.score,
+                attempt.c.occurred,
+            ).where(
+                attempt.c.score.isnot(None),
+                attempt.c.user_canvas_id.in_(user_ids[start:start + BATCH_SIZE])
+            ).order_by(
+                attempt.c.user_canvas_id,
+                attempt.c.outcome_canvas_id,
+                attempt.c.occurred,
+                attempt.c.attempt_canvas_id,
+            )
+        ).fetchall()
+
+        aggregates = {}
+        for user_id, outcome_id, attempt_id, score, occurred in rows:
+            aggregates.setdefault((user_id, outcome_id), ScoreAggregate()).add(score, occurred, attempt_id)
+
+        values = []
+        for (user_id, outcome_id), aggregate in aggregates.items():
+            for method in CALCULATIONS:
+                row = aggregate.update_row(SimpleNamespace(calculation_method=method))
+                values.append({
+                    "user_canvas_id": user_id,
+                    "outcome_canvas_id": outcome_id,
+                    "calculation_method": method.name,
+                    "attempt_count": row.attempt_count,
+                    "total": row.total,
+                    "highest": row.highest,
+                    "last_score": row.last_score,
+                    "last_occurred": row.last_occurred,
+                    "last_attempt_canvas_id": row.last_attempt_canvas_id,
+                    "histogram": row.histogram,
+                    "score": row.score,
+                })
+
+        if values:
+            conn.execute(outcome_score.insert(), values)
+
+    # Cached gradebooks were rendered without scores.
+    course = sa.table('course', sa.column('id', sa.Integer), sa.column('version', sa.String))
+    for (course_id,) in conn.execute(sa.select(course.c.id)).fetchall():
+        conn.execute(course.update().where(course.c.id == course_id).values(version=uuid.uuid4().hex))
+
+
+def downgrade():
+    # The scores are derived data, so there's nothing to undo.
+    pass
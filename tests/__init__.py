@@ -0,0 +1,7 @@
+from app import app
+
+# Every request in the suite is instrumented, and an endpoint going over its query budget
+# raises instead of being turned into a 500 page, so the test making the request fails.
+app.config["INSTRUMENTATION"] = True
+app.config["QUERY_BUDGETS_ENFORCE"] = True
+app.config["PROPAGATE_EXCEPTIONS"] = True
@@ -0,0 +1,111 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+from canvasapi.paginated_list import PaginatedList
+
+from app.canvas_pager import iterate_pages
+
+
+class FakeRequester:
+    """ Serves numbered pages of integers the way Canvas links them """
+    base_url = 'https://canvas.test/api/v1/'
+
+    def __init__(self, pages, per_page=3, last=True, bookmark=False, delay=0):
+        self.pages = pages
+        self.per_page = per_page
+        self.last = last
+        self.bookmark = bookmark
+        self.delay = delay
+        self.requested = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.lock = threading.Lock()
+
+    def link(self, page):
+        value = f"bookmark:{page}" if self.bookmark else page
+        return {"url": f"{self.base_url}items?page={value}&per_page={self.per_page}"}
+
+    def request(self, method, endpoint, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+
+        time.sleep(self.delay)
+
+        page = parse_qs(urlsplit(endpoint).query).get('page', ['1'])[0]
+        page = int(page.split(':')[-1])
+
+        with self.lock:
+            self.requested.append(page)
+            self.in_flight -= 1
+
+        links = {}
+        if page < self.pages:
+            links['next'] = self.link(page + 1)
+            if self.last:
+                links['last'] = self.link(self.pages)
+
+        start = (page - 1) * self.per_page
+        items = [{"id": id} for id in range(start, start + self.per_page)]
+        return SimpleNamespace(links=links, json=lambda: {"items": items})
+
+
+def paginated(requester):
+    return PaginatedList(
+        lambda requester, attributes: attributes['id'], requester, 'GET', 'items', _root='items'
+    )
+
+
+class TestCanvasPager(unittest.TestCase):
+    def test_pages_yield_in_order(self):
+        requester = FakeRequester(pages=6, delay=0.01)
+
+        items = list(iterate_pages(paginated(requester), max_workers=3))
+
+        self.assertEqual(items, list(range(18)))
+        self.assertEqual(sorted(requester.requested), [1, 2, 3, 4, 5, 6])
+        self.assertGreater(requester.most_in_flight, 1)
+
+    def test_concurrency_is_bounded(self):
+        requester = FakeRequester(pages=12, delay=0.01)
+
+        list(iterate_pages(paginated(requester), max_workers=2))
+
+        self.assertLessEqual(requester.most_in_flight, 2)
+
+    def test_single_page(self):
+        requester = FakeRequester(pages=1)
+
+        self.assertEqual(list(iterate_pages(paginated(requester))), [0, 1, 2])
+
+    def test_without_last_link_pages_are_sequential(self):
+        requester = FakeRequester(pages=4, last=False)
+
+        self.assertEqual(list(iterate_pages(paginated(requester))), list(range(12)))
+        self.assertEqual(requester.requested, [1, 2, 3, 4])
+
+    def test_bookmark_pages_are_sequential(self):
+        requester = FakeRequester(pages=4, bookmark=True)
+
+        self.assertEqual(list(iterate_pages(paginated(requester))), list(range(12)))
+        self.assertEqual(requester.requested, [1, 2, 3, 4])
+
+    def test_pages_added_during_fetch_are_read(self):
+        requester = FakeRequester(pages=3)
+        request = requester.request
+
+        # A new page shows up after the first page reports the last one
+        def growing(method, endpoint, **kwargs):
+            response = request(method, endpoint, **kwargs)
+            requester.pages = 4
+            return response
+
+        requester.request = growing
+
+        self.assertEqual(list(iterate_pages(paginated(requester))), list(range(12)))
+
+    def test_other_iterables_pass_through(self):
+        self.assertEqual(list(iterate_pages([1, 2, 3])), [1, 2, 3])
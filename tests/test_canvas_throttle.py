@@ -0,0 +1,122 @@
+import unittest
+from unittest import mock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.canvas_auth_service import CanvasClients, bucket_gauges, clients
+from app.canvas_throttle import ThrottledAdapter
+
+
+def response(status=200, remaining=700, content=b'[]'):
+    """ Build a Canvas response with rate limit headers """
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = content
+    if remaining is not None:
+        resp.headers['X-Rate-Limit-Remaining'] = str(remaining)
+    return resp
+
+
+def throttled():
+    return response(403, remaining=0, content=b'403 Forbidden (Rate Limit Exceeded)')
+
+
+class TestThrottledAdapter(unittest.TestCase):
+    def setUp(self):
+        self.adapter = ThrottledAdapter(max_concurrency=8)
+        self.request = requests.Request('GET', 'https://canvas.test/api/v1/courses').prepare()
+
+    def send(self, *responses):
+        with mock.patch.object(HTTPAdapter, 'send', side_effect=list(responses)) as send, \
+                mock.patch('app.canvas_throttle.time.sleep') as sleep:
+            result = self.adapter.send(self.request)
+        return result, send, sleep
+
+    def test_headers_are_recorded(self):
+        self.send(response(remaining=512.5))
+
+        state = self.adapter.state()
+        self.assertEqual(state['remaining'], 512.5)
+        self.assertEqual(state['requests'], 1)
+        self.assertEqual(state['in_flight'], 0)
+
+    def test_low_bucket_halves_concurrency(self):
+        self.send(response(remaining=100))
+        self.assertEqual(self.adapter.limit, 4)
+
+        # Further low responses right away don't cut again
+        self.send(response(remaining=90))
+        self.assertEqual(self.adapter.limit, 4)
+
+    def test_healthy_bucket_grows_concurrency(self):
+        self.send(response(remaining=100))
+
+        for _ in range(40):
+            self.send(response(remaining=600))
+
+        self.assertEqual(self.adapter.limit, 8)
+
+    def test_throttled_request_is_retried(self):
+        with self.assertLogs(level='WARNING'):
+            result, send, sleep = self.send(throttled(), throttled(), response())
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.adapter.state()['throttled'], 2)
+        self.assertEqual(self.adapter.limit, 2)
+
+        # Backoff is jittered under an exponential cap
+        self.assertLessEqual(sleep.call_args_list[0][0][0], ThrottledAdapter.backoff_base)
+        self.assertLessEqual(sleep.call_args_list[1][0][0], ThrottledAdapter.backoff_base * 2)
+
+    def test_gives_up_after_max_retries(self):
+        responses = [throttled() for _ in range(ThrottledAdapter.max_retries_throttled + 1)]
+
+        with self.assertLogs(level='WARNING'):
+            result, send, _ = self.send(*responses)
+
+        self.assertEqual(result.status_code, 403)
+        self.assertEqual(send.call_count, ThrottledAdapter.max_retries_throttled + 1)
+
+    def test_other_forbidden_responses_are_not_retried(self):
+        result, send, sleep = self.send(response(403, content=b'{"errors": "unauthorized"}'))
+
+        self.assertEqual(result.status_code, 403)
+        self.assertEqual(send.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_bucket_states_hide_tokens(self):
+        clients = CanvasClients()
+        clients.get('https://canvas.test/', 'secret-token')
+
+        states = clients.bucket_states()
+
+        self.assertEqual(len(states), 1)
+        self.assertEqual(states[0]['base_url'], 'https://canvas.test/')
+        self.assertNotIn('secret', states[0]['token'])
+        self.assertIsNone(states[0]['remaining'])
+
+    def test_bucket_states_are_exported(self):
+        from app.metrics import registry
+
+        client = clients.get('https://canvas.test/', 'secret-token')
+        self.addCleanup(clients.clear)
+        adapter = client._Canvas__requester._session.get_adapter('https://canvas.test/')
+        adapter.remaining = 420
+        token = clients.bucket_states()[0]['token']
+
+        text = registry.exposition()
+
+        labels = dict(base_url='https://canvas.test/', token=token)
+        self.assertEqual(bucket_gauges['remaining'].value(**labels), 420)
+        self.assertEqual(bucket_gauges['limit'].value(**labels), adapter.limit)
+        self.assertEqual(bucket_gauges['in_flight'].value(**labels), 0)
+        self.assertIn('canvas_rate_limit_remaining{{base_url="https://canvas.test/",token="{}"}} 420.0'.format(token), text)
+        self.assertNotIn('secret', text)
+
+        # Dropped clients stop being reported
+        clients.clear()
+        registry.exposition()
+        self.assertIsNone(bucket_gauges['remaining'].value(**labels))
@@ -192,6 +192,137 @@ class TestCourseAPI(TestBase):
             self.assertTrue('course/student_index.html' in templates_rendered)
             self.assertTrue('outcome/student/outcome_card.html' in templates_rendered)
     
+    def test_gradebook_is_cached_until_version_changes(self):
+        self.login("Teacher")
+        headers = {'HX-Request': True}
+        self.client.get('/courses/123', headers=headers)
+
+        with captured_templates(app) as templates:
+            resp = self.client.get('/courses/123', headers=headers)
+            templates_rendered = [template['template_name'] for template in templates]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Student', resp.get_data(as_text=True))
+            self.assertNotIn('course/partials/score_table.html', templates_rendered)
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        course.bump_version()
+        db.session.commit()
+
+        with captured_templates(app) as templates:
+            self.client.get('/courses/123', headers=headers)
+            templates_rendered = [template['template_name'] for template in templates]
+
+            self.assertIn('course/partials/score_table.html', templates_rendered)
+
+    def test_gradebook_cache_follows_preferences(self):
+        self.login("Teacher")
+        self.client.get('/courses/123')
+
+        teacher = User.query.filter(User.name == "Teacher").first()
+        teacher.preferences.score_calculation_method = MasteryCalculation.HIGHEST
+        db.session.commit()
+
+        with captured_templates(app) as templates:
+            self.client.get('/courses/123')
+            templates_rendered = [template['template_name'] for template in templates]
+
+            self.assertIn('course/partials/score_table.html', templates_rendered)
+
+    def test_not_modified_skips_score_queries(self):
+        from sqlalchemy import event
+
+        self.login("Teacher")
+        resp = self.client.get('/courses/123', headers={'HX-Request': True})
+        etag = resp.headers['ETag']
+        self.assertIn('HX-Request', resp.headers['Vary'])
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            resp = self.client.get('/courses/123', headers={'HX-Request': True, 'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b'')
+        self.assertFalse([s for s in statements if 'outcome_attempt' in s or 'outcome_score' in s])
+
+        # The full page is a different response
+        resp = self.client.get('/courses/123', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_preference_change_modifies_course(self):
+        self.login("Teacher")
+        etag = self.client.get('/courses/123/outcomes').headers['ETag']
+
+        self.assertEqual(self.client.get('/courses/123/outcomes', headers={'If-None-Match': etag}).status_code, 304)
+
+        self.client.put('/users/123/edit', data={'score_calculation_method': 'HIGHEST', 'mastery_score': 3})
+
+        self.assertEqual(self.client.get('/courses/123/outcomes', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_gradebook_query_count_is_fixed(self):
+        from sqlalchemy import event
+        from app.controllers.courses import gradebook_cache
+
+        def count_queries():
+            gradebook_cache.clear()
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = self.client.get('/courses/123', headers={'HX-Request': True})
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+            self.assertEqual(resp.status_code, 200)
+            return len(statements)
+
+        self.login("Teacher")
+        small = count_queries()
+
+        # Grow the course to 20 students and 6 outcomes, half of them aligned
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        for i in range(19):
+            student = User(name=f"Student {i}", usertype_id=3, canvas_id=1000 + i)
+            db.session.add(student)
+            student.enroll(course)
+        for i in range(5):
+            outcome = Outcome(name=f"Outcome {i}", canvas_id=200 + i)
+            course.outcomes.append(outcome)
+            if i % 2 == 0:
+                assignment = Assignment(name=f"Assignment {i}", canvas_id=300 + i)
+                course.assignments.append(assignment)
+                assignment.watch(outcome)
+        db.session.commit()
+
+        large = count_queries()
+
+        # Session user, course, preferences, the course with its outcomes, alignments,
+        # assignments and students, and scores
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 10)
+
+    def test_alignment_changes_version(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        version = course.version
+
+        assignment = Assignment.query.first()
+        assignment.watch(Outcome.query.first())
+        self.assertNotEqual(course.version, version)
+
+        version = course.version
+        assignment.unwatch()
+        self.assertNotEqual(course.version, version)
+
     # 404 if the local db ID is used
     def test_get_single_course_by_local_id(self):
         self.login("Teacher")
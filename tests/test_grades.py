@@ -0,0 +1,99 @@
+from datetime import datetime
+
+from sqlalchemy import event
+
+from app import app, db
+from app.grade_service import GradeService
+from app.models import Assignment, Course, Outcome, OutcomeScore, User, UserAssignment
+from app.score_service import rebuild_outcome_scores
+
+from tests.test_scores import ScoreTestBase
+
+
+class TestGradeService(ScoreTestBase):
+    def setUp(self):
+        super().setUp()
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        a1 = Assignment(canvas_id=55, name="Assignment 1", points_possible=10)
+        a2 = Assignment(canvas_id=66, name="Assignment 2", points_possible=10)
+        a1.watching = Outcome.query.filter(Outcome.canvas_id == 11).first()
+        a2.watching = Outcome.query.filter(Outcome.canvas_id == 22).first()
+        course.assignments.extend([a1, a2])
+        db.session.commit()
+
+        rebuild_outcome_scores()
+
+        self.course = course
+        self.teacher = User.query.filter(User.name == "Teacher").first()
+
+    def grades(self):
+        return {(row.user_id, row.assignment_id): row.score for row in UserAssignment.query.all()}
+
+    def test_calculate_grades(self):
+        grades = GradeService(self.course, self.teacher).calculate_grades()
+
+        self.assertEqual(grades, {
+            (456, 55): 10, (789, 55): 10, (999, 55): 0,
+            (456, 66): 10, (789, 66): 0, (999, 66): 0,
+        })
+
+    def test_attempts_without_scores_are_not_graded(self):
+        # Student 1's scores haven't been built yet. Student 3 has no attempts at all.
+        OutcomeScore.query.filter(OutcomeScore.user_canvas_id == 456).delete()
+        db.session.commit()
+
+        with self.assertLogs(app.logger, level='WARNING'):
+            grades = GradeService(self.course, self.teacher).calculate_grades()
+
+        self.assertEqual(grades, {
+            (789, 55): 10, (999, 55): 0,
+            (789, 66): 0, (999, 66): 0,
+        })
+
+    def test_update_grades_writes_all_rows(self):
+        self.assertEqual(GradeService(self.course, self.teacher).update_grades(), 6)
+        self.assertEqual(self.grades(), GradeService(self.course, self.teacher).calculate_grades())
+
+    def test_update_single_assignment(self):
+        assignment = Assignment.query.filter(Assignment.canvas_id == 66).first()
+        GradeService(self.course, self.teacher).update_grades([assignment])
+
+        self.assertEqual(self.grades(), {(456, 66): 10, (789, 66): 0, (999, 66): 0})
+
+    def test_only_changed_rows_are_written(self):
+        posted_at = datetime(2022, 1, 1)
+        db.session.add_all([
+            UserAssignment(user_id=456, assignment_id=55, score=10, occurred=posted_at, posted_score=10, posted_at=posted_at),
+            UserAssignment(user_id=789, assignment_id=66, score=10, occurred=posted_at, posted_score=10, posted_at=posted_at),
+        ])
+        db.session.commit()
+
+        self.assertEqual(GradeService(self.course, self.teacher).update_grades(), 5)
+
+        unchanged = UserAssignment.query.filter_by(user_id=456, assignment_id=55).one()
+        self.assertEqual(unchanged.occurred, posted_at)
+        self.assertFalse(unchanged.is_dirty)
+
+        # The existing row is updated in place rather than duplicated
+        changed = UserAssignment.query.filter_by(user_id=789, assignment_id=66).one()
+        self.assertEqual(changed.score, 0)
+        self.assertEqual(changed.posted_score, 10)
+        self.assertTrue(changed.is_dirty)
+
+    def test_existing_rows_loaded_in_one_query(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'user_assignment' in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            GradeService(self.course, self.teacher).update_grades()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        # One read of the existing rows and one upsert
+        self.assertEqual(len(statements), 2)
+        self.assertIn('ON CONFLICT', statements[1])
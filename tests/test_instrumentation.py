@@ -0,0 +1,184 @@
+import unittest
+from unittest import mock
+
+import requests
+from flask import g
+from requests.adapters import HTTPAdapter
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+from app import app, db
+from app import instrumentation
+from app.canvas_pager import iterate_pages
+from app.canvas_throttle import ThrottledAdapter
+from app.enums import MasteryCalculation
+from app.instrumentation import QueryBudgetExceeded, RequestMetrics, after_cursor_execute, endpoint_report, record_canvas_call
+from app.metrics import registry
+from app.models import Course, User, UserPreferences
+
+from tests.test_canvas_pager import FakeRequester, paginated
+from tests.util import TestBase
+
+
+class TestRequestInstrumentation(TestBase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.create_all()
+        self.client = app.test_client()
+
+        course = Course(canvas_id=123, name="Course 1")
+        admin = User(name="Admin", usertype_id=1, canvas_id=1)
+        teacher = User(name="Teacher", usertype_id=2, canvas_id=123)
+        db.session.add_all([admin, teacher, course])
+        db.session.commit()
+
+        db.session.add(UserPreferences(user_id=teacher.id, score_calculation_method=MasteryCalculation(1), mastery_score=3))
+        teacher.enroll(course)
+        db.session.commit()
+
+        registry.clear()
+
+    def tearDown(self):
+        app.config["INSTRUMENTATION"] = True
+        app.config["QUERY_BUDGETS_ENFORCE"] = True
+        app.config.pop("QUERY_BUDGETS", None)
+        registry.clear()
+        db.session.remove()
+        db.drop_all()
+
+    def test_server_timing_header(self):
+        self.login("Teacher")
+
+        resp = self.client.get('/courses')
+
+        timing = resp.headers['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('canvas;dur=0', timing)
+        self.assertIn('render;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertNotIn('desc="0 queries"', timing)
+
+    def test_request_is_logged(self):
+        self.login("Teacher")
+
+        with self.assertLogs(app.logger, level='INFO') as logs:
+            self.client.get('/courses')
+
+        line = [message for message in logs.output if 'course_list_view' in message][0]
+        self.assertIn('"status": 200', line)
+        self.assertIn('"sql_count"', line)
+
+    def test_samples_are_kept_per_endpoint(self):
+        self.login("Teacher")
+        for _ in range(3):
+            self.client.get('/courses')
+
+        report = {row["endpoint"]: row for row in endpoint_report()}
+
+        self.assertEqual(report['courses.course_list_view']["requests"], 3)
+        self.assertGreater(report['courses.course_list_view']["sql_count"]["p95"], 0)
+
+    def test_disabled(self):
+        app.config["INSTRUMENTATION"] = False
+        self.login("Teacher")
+
+        resp = self.client.get('/courses')
+
+        self.assertNotIn('Server-Timing', resp.headers)
+        self.assertEqual(endpoint_report(), [])
+
+    def test_sql_listeners_wait_for_the_flag(self):
+        with mock.patch.object(instrumentation, '_listening', False), \
+                mock.patch.object(event, 'listen') as listen:
+            app.config["INSTRUMENTATION"] = False
+            self.login("Teacher")
+            self.client.get('/courses')
+            listen.assert_not_called()
+
+            app.config["INSTRUMENTATION"] = True
+            self.client.get('/courses')
+            self.assertIn(mock.call(Engine, 'after_cursor_execute', after_cursor_execute), listen.call_args_list)
+
+    def test_failed_statement_clears_its_start(self):
+        self.login("Teacher")
+        self.client.get('/courses')
+        self.assertTrue(event.contains(Engine, 'after_cursor_execute', after_cursor_execute))
+
+        with db.engine.connect() as conn:
+            for _ in range(3):
+                with self.assertRaises(Exception):
+                    conn.execute(text("SELECT * FROM missing_table"))
+
+            self.assertEqual(conn.connection.info.get('query_start', []), [])
+
+    def test_query_budget_enforced(self):
+        self.login("Teacher")
+        app.config["QUERY_BUDGETS"] = {'courses.course_list_view': 1}
+
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/courses')
+
+    def test_query_budget_warns(self):
+        self.login("Teacher")
+        app.config["QUERY_BUDGETS"] = {'courses.course_list_view': 1}
+        app.config["QUERY_BUDGETS_ENFORCE"] = False
+
+        with self.assertLogs(app.logger, level='WARNING') as logs:
+            resp = self.client.get('/courses')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(any('over its budget of 1' in message for message in logs.output))
+
+    def test_metrics_page(self):
+        self.login("Teacher")
+        self.client.get('/courses')
+        self.login("Admin")
+
+        resp = self.client.get('/admin/metrics/')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'courses.course_list_view', resp.data)
+
+    def test_metrics_page_is_admin_only(self):
+        self.login("Teacher")
+
+        resp = self.client.get('/admin/metrics/')
+
+        self.assertEqual(resp.status_code, 302)
+
+
+class TestCanvasCallMetrics(unittest.TestCase):
+    def test_adapter_records_calls(self):
+        adapter = ThrottledAdapter()
+        request = requests.Request('GET', 'https://canvas.test/api/v1/courses').prepare()
+        response = requests.Response()
+        response.status_code = 200
+
+        with app.test_request_context(), mock.patch.object(HTTPAdapter, 'send', return_value=response):
+            g.request_metrics = RequestMetrics()
+            adapter.send(request)
+            adapter.send(request)
+
+            self.assertEqual(g.request_metrics.canvas_count, 2)
+
+    def test_pager_threads_record_calls(self):
+        requester = FakeRequester(pages=4)
+        request = requester.request
+
+        def counted(*args, **kwargs):
+            record_canvas_call(0.01)
+            return request(*args, **kwargs)
+
+        requester.request = counted
+
+        with app.test_request_context():
+            g.request_metrics = RequestMetrics()
+            list(iterate_pages(paginated(requester), max_workers=2))
+
+            self.assertEqual(g.request_metrics.canvas_count, 4)
+
+    def test_outside_a_request(self):
+        # Sync and worker calls have no request to count against
+        record_canvas_call(0.01)
+
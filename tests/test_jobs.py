@@ -0,0 +1,233 @@
+import json
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app import app, db
+from app.canvas_auth_service import CanvasAuthService
+from app.enums import JobStatus
+from app.job_service import STALE_MESSAGE, JobFailed, claim_next, enqueue, handler, job_seconds, run_job, work
+from app.models import Assignment, Course, Job, Outcome, User, UserAssignment, UserPreferences
+
+from tests.test_scores import ScoreTestBase
+from tests.test_sync import FakeCanvas, FakeCanvasAssignment, FakeCanvasCourse, FakeProgress
+from tests.util import TestBase
+
+
+@handler('test_add')
+def add(job, a, b):
+    job.update_progress(1, 1)
+    return f"{a + b}"
+
+
+@handler('test_fail')
+def fail(job, expected=True):
+    if expected:
+        raise JobFailed("Expected failure")
+    raise RuntimeError("Unexpected failure")
+
+
+class JobTestBase(ScoreTestBase, TestBase):
+    def setUp(self):
+        super().setUp()
+        self.client = app.test_client()
+        self.teacher = User.query.filter(User.name == "Teacher").first()
+
+
+class TestJobQueue(JobTestBase):
+    def test_enqueue_and_run(self):
+        job = enqueue('test_add', self.teacher, a=1, b=2)
+        self.assertEqual(job.status, JobStatus.QUEUED)
+        self.assertEqual(json.loads(job.arguments), {"a": 1, "b": 2})
+
+        claimed = claim_next()
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, JobStatus.RUNNING)
+
+        runs = job_seconds.count(name='test_add', status='completed')
+        finished = run_job(claimed)
+        self.assertEqual(finished.status, JobStatus.COMPLETED)
+        self.assertEqual(finished.message, "3")
+        self.assertEqual((finished.progress, finished.total), (1, 1))
+        self.assertIsNotNone(finished.finished_at)
+        self.assertEqual(job_seconds.count(name='test_add', status='completed'), runs + 1)
+
+    def test_unknown_job(self):
+        with self.assertRaises(ValueError):
+            enqueue('missing')
+
+    def test_claimed_job_is_not_claimed_again(self):
+        enqueue('test_add', a=1, b=2)
+
+        self.assertIsNotNone(claim_next())
+        self.assertIsNone(claim_next())
+
+    def test_jobs_run_in_order(self):
+        first = enqueue('test_add', a=1, b=2).id
+        second = enqueue('test_add', a=2, b=2).id
+
+        self.assertEqual(work(once=True), 2)
+        self.assertLess(Job.query.get(first).finished_at, Job.query.get(second).finished_at)
+
+    def test_failed_job_message(self):
+        expected = enqueue('test_fail').id
+        unexpected = enqueue('test_fail', expected=False).id
+
+        with self.assertLogs(app.logger, level='ERROR'):
+            work(once=True)
+
+        self.assertEqual(Job.query.get(expected).status, JobStatus.FAILED)
+        self.assertEqual(Job.query.get(expected).message, "Expected failure")
+
+        # Exception details aren't shown to the user
+        self.assertEqual(Job.query.get(unexpected).status, JobStatus.FAILED)
+        self.assertNotIn("Unexpected", Job.query.get(unexpected).message)
+
+    def test_stale_running_jobs_are_failed(self):
+        stale = enqueue('test_add', a=1, b=2).id
+        running = enqueue('test_add', a=2, b=2).id
+        claim_next()
+        claim_next()
+        Job.query.get(stale).started_at = datetime.now() - timedelta(hours=2)
+        db.session.commit()
+
+        with self.assertLogs(app.logger, level='WARNING'):
+            self.assertIsNone(claim_next())
+
+        self.assertEqual(Job.query.get(stale).status, JobStatus.FAILED)
+        self.assertEqual(Job.query.get(stale).message, STALE_MESSAGE)
+        self.assertIsNotNone(Job.query.get(stale).finished_at)
+        self.assertEqual(Job.query.get(running).status, JobStatus.RUNNING)
+
+
+class TestPostGradesJob(JobTestBase):
+    def setUp(self):
+        super().setUp()
+        from app.score_service import rebuild_outcome_scores
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        assignment = Assignment(canvas_id=55, name="Assignment 1", points_possible=10)
+        assignment.watching = Outcome.query.filter(Outcome.canvas_id == 11).first()
+        course.assignments.append(assignment)
+        db.session.commit()
+
+        rebuild_outcome_scores()
+
+        self.canvas_assignment = FakeCanvasAssignment(55, FakeProgress(['completed']))
+        self.canvas = FakeCanvas(FakeCanvasCourse(123, assignments={55: self.canvas_assignment}))
+
+    def test_post_grades(self):
+        job_id = enqueue('post_grades', self.teacher, course_id=123).id
+
+        with mock.patch.object(CanvasAuthService, 'init_canvas', return_value=self.canvas):
+            work(once=True)
+
+        job = Job.query.get(job_id)
+        self.assertEqual(job.status, JobStatus.COMPLETED)
+        self.assertEqual(job.message, "Posted 3 grades.")
+        self.assertEqual((job.progress, job.total), (3, 3))
+        self.assertEqual(len(self.canvas_assignment.updates), 1)
+        self.assertFalse(any(row.is_dirty for row in UserAssignment.query.all()))
+
+    def test_push_endpoint_queues_job(self):
+        self.login("Teacher")
+        resp = self.client.put('/courses/123/assignments/push')
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['job']['status'], 'queued')
+
+        job = Job.query.one()
+        self.assertEqual(job.name, 'post_grades')
+        self.assertEqual(job.user_id, self.teacher.id)
+
+        # Nothing is posted until the worker runs
+        self.assertEqual(UserAssignment.query.count(), 0)
+
+    def test_push_endpoint_returns_polling_partial(self):
+        self.login("Teacher")
+        resp = self.client.put('/assignments/55/push', headers={"HX-Request": "true"})
+
+        job = Job.query.one()
+        self.assertEqual(resp.status_code, 202)
+        self.assertIn(f'hx-get="/jobs/{job.id}"', resp.get_data(as_text=True))
+        self.assertEqual(json.loads(job.arguments), {"course_id": 123, "assignment_id": 55})
+
+    def test_job_status(self):
+        job_id = enqueue('post_grades', self.teacher, course_id=123).id
+        self.login("Teacher")
+
+        resp = self.client.get(f'/jobs/{job_id}')
+        self.assertEqual(resp.json['status'], 'queued')
+
+        with mock.patch.object(CanvasAuthService, 'init_canvas', return_value=self.canvas):
+            work(once=True)
+
+        resp = self.client.get(f'/jobs/{job_id}', headers={"HX-Request": "true"})
+        body = resp.get_data(as_text=True)
+
+        # Finished jobs stop polling
+        self.assertIn("Posted 3 grades.", body)
+        self.assertNotIn("hx-get", body)
+
+    def test_stale_job_status_stops_polling(self):
+        job = enqueue('post_grades', self.teacher, course_id=123)
+        job.status = JobStatus.RUNNING
+        job.started_at = datetime.now() - timedelta(hours=2)
+        db.session.commit()
+        job_id = job.id
+        self.login("Teacher")
+
+        body = self.client.get(f'/jobs/{job_id}', headers={"HX-Request": "true"}).get_data(as_text=True)
+
+        self.assertIn("stopped before it finished", body)
+        self.assertNotIn("hx-get", body)
+
+    def test_job_admin_is_admin_only(self):
+        enqueue('post_grades', self.teacher, course_id=123)
+        self.login("Teacher")
+
+        resp = self.client.get('/admin/job/')
+
+        self.assertEqual(resp.status_code, 302)
+
+    def test_push_requires_enrollment(self):
+        other = User(name="Other Teacher", usertype_id=2, canvas_id=2)
+        db.session.add(other)
+        db.session.commit()
+        course_id = Course.query.filter(Course.canvas_id == 123).first().id
+        self.login("Other Teacher")
+
+        self.assertEqual(self.client.put('/courses/123/assignments/push').status_code, 403)
+        self.assertEqual(self.client.put('/assignments/55/push').status_code, 403)
+        self.assertEqual(self.client.get(f'/sync/courses/{course_id}/outcomes/results').status_code, 403)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_push_without_preferences(self):
+        UserPreferences.query.filter(UserPreferences.user_id == self.teacher.id).delete()
+        db.session.commit()
+        self.login("Teacher")
+
+        self.assertEqual(self.client.put('/courses/123/assignments/push').status_code, 202)
+        self.assertEqual(self.client.put('/assignments/55/push').status_code, 202)
+
+    def test_jobs_check_enrollment(self):
+        other = User(name="Other Teacher", usertype_id=2, canvas_id=2)
+        db.session.add(other)
+        db.session.commit()
+        post = enqueue('post_grades', other, course_id=123).id
+        sync = enqueue('sync_results', other, course_id=123).id
+
+        with mock.patch.object(CanvasAuthService, 'init_canvas', return_value=self.canvas):
+            work(once=True)
+
+        for job_id in (post, sync):
+            self.assertEqual(Job.query.get(job_id).status, JobStatus.FAILED)
+            self.assertEqual(Job.query.get(job_id).message, "You don't have access to this course.")
+        self.assertEqual(self.canvas_assignment.updates, [])
+
+    def test_job_status_for_other_user(self):
+        other = User.query.filter(User.canvas_id == 456).first()
+        job_id = enqueue('post_grades', other, course_id=123).id
+        self.login("Teacher")
+
+        resp = self.client.get(f'/jobs/{job_id}')
+        self.assertEqual(resp.status_code, 404)
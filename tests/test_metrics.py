@@ -0,0 +1,194 @@
+import json
+import os
+import tempfile
+import unittest
+
+from app import app, db
+from app.canvas_sync_service import grade_posts
+from app.metrics import MetricsRegistry, cli_run, registry
+from app.models import User
+
+from tests.util import TestBase
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter('jobs_total', 'Jobs run', ('result',))
+
+        counter.inc(result='completed')
+        counter.inc(2, result='completed')
+        counter.inc(result='failed')
+
+        self.assertEqual(counter.value(result='completed'), 3)
+        self.assertEqual(counter.value(result='failed'), 1)
+        self.assertEqual(counter.value(result='missing'), 0)
+
+    def test_labels_must_match(self):
+        counter = self.registry.counter('jobs_total', 'Jobs run', ('result',))
+
+        with self.assertRaises(ValueError):
+            counter.inc()
+        with self.assertRaises(ValueError):
+            counter.inc(result='completed', course=1)
+
+    def test_counters_only_increase(self):
+        with self.assertRaises(ValueError):
+            self.registry.counter('jobs_total', 'Jobs run').inc(-1)
+
+    def test_registering_twice_returns_the_metric(self):
+        counter = self.registry.counter('jobs_total', 'Jobs run')
+
+        self.assertIs(self.registry.counter('jobs_total', 'Jobs run'), counter)
+        with self.assertRaises(ValueError):
+            self.registry.histogram('jobs_total', 'Jobs run')
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('in_flight', 'Requests running', ('token',))
+
+        gauge.set(3, token='a')
+        gauge.set(1, token='a')
+
+        self.assertEqual(gauge.value(token='a'), 1)
+        self.assertIsNone(gauge.value(token='b'))
+
+    def test_collectors_run_before_reading(self):
+        gauge = self.registry.gauge('queue_length', 'Jobs waiting')
+        queue = []
+        self.registry.collector(lambda: gauge.set(len(queue)))
+
+        queue.extend([1, 2])
+
+        self.assertIn('# TYPE queue_length gauge\nqueue_length 2.0\n', self.registry.exposition())
+        self.assertEqual(self.registry.summary()['queue_length'], [{"labels": {}, "value": 2}])
+
+    def test_histogram_quantiles(self):
+        histogram = self.registry.histogram('duration_seconds', 'Duration', buckets=(1, 2, 5))
+        for value in [0.5] * 50 + [1.5] * 45 + [4] * 4 + [10]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.count(), 100)
+        self.assertAlmostEqual(histogram.sum(), 25 + 67.5 + 16 + 10)
+        self.assertAlmostEqual(histogram.quantile(0.5), 1)
+        self.assertAlmostEqual(histogram.quantile(0.95), 2)
+        self.assertEqual(histogram.quantile(1), 5)
+        self.assertIsNone(self.registry.histogram('empty_seconds', 'Empty').quantile(0.5))
+
+    def test_exposition(self):
+        counter = self.registry.counter('pages_total', 'Pages read', ('course',))
+        counter.inc(3, course='a "b"')
+        histogram = self.registry.histogram('request_seconds', 'Request time', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        text = self.registry.exposition()
+
+        self.assertIn('# HELP pages_total Pages read\n# TYPE pages_total counter\n', text)
+        self.assertIn('pages_total{course="a \\"b\\""} 3.0\n', text)
+        self.assertIn('# TYPE request_seconds histogram\n', text)
+        self.assertIn('request_seconds_bucket{le="0.1"} 1.0\n', text)
+        self.assertIn('request_seconds_bucket{le="1.0"} 2.0\n', text)
+        self.assertIn('request_seconds_bucket{le="+Inf"} 3.0\n', text)
+        self.assertIn('request_seconds_sum 2.55\n', text)
+        self.assertIn('request_seconds_count 3.0\n', text)
+
+    def test_summary(self):
+        self.registry.counter('pages_total', 'Pages read').inc(3)
+        self.registry.histogram('request_seconds', 'Request time', ('method',)).observe(0.2, method='GET')
+        self.registry.counter('unused_total', 'Never counted')
+
+        summary = self.registry.summary()
+
+        self.assertEqual(summary['pages_total'], [{"labels": {}, "value": 3}])
+        self.assertEqual(summary['request_seconds'][0]['labels'], {"method": "GET"})
+        self.assertEqual(summary['request_seconds'][0]['count'], 1)
+        self.assertNotIn('unused_total', summary)
+
+    def test_clear(self):
+        counter = self.registry.counter('pages_total', 'Pages read')
+        counter.inc()
+
+        self.registry.clear()
+
+        self.assertEqual(counter.value(), 0)
+        self.assertIs(self.registry.get('pages_total'), counter)
+
+
+class TestMetricsEndpoint(TestBase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.create_all()
+        self.client = app.test_client()
+
+        db.session.add_all([
+            User(name="Admin", usertype_id=1, canvas_id=1),
+            User(name="Teacher", usertype_id=2, canvas_id=2),
+        ])
+        db.session.commit()
+        app.config["METRICS_TOKEN"] = "scrape-token"
+
+    def tearDown(self):
+        app.config.pop("METRICS_TOKEN")
+        db.session.remove()
+        db.drop_all()
+
+    def test_admins_can_read_metrics(self):
+        self.login("Admin")
+
+        resp = self.client.get('/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'# TYPE sync_attempts_total counter', resp.data)
+
+    def test_collectors_send_the_token(self):
+        resp = self.client.get('/metrics', headers={'Authorization': 'Bearer scrape-token'})
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_proxied_requests_are_refused(self):
+        # Behind Apache every request comes from 127.0.0.1
+        resp = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(resp.status_code, 404)
+
+        self.login("Teacher")
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class TestCliSummary(unittest.TestCase):
+    def setUp(self):
+        registry.clear()
+        self.path = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+        app.config['METRICS_SUMMARY_FILE'] = self.path
+
+    def tearDown(self):
+        app.config.pop('METRICS_SUMMARY_FILE')
+        registry.clear()
+
+    def read(self):
+        with open(self.path) as summary_file:
+            return [json.loads(line) for line in summary_file]
+
+    def test_summary_is_appended(self):
+        for _ in range(2):
+            with cli_run('sync'):
+                grade_posts.inc(result='succeeded')
+
+        runs = self.read()
+
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(runs[0]['command'], 'sync')
+        self.assertEqual(runs[0]['status'], 'completed')
+        self.assertEqual(runs[1]['metrics']['grade_posts_total'], [{"labels": {"result": "succeeded"}, "value": 2}])
+
+    def test_failed_runs_are_recorded(self):
+        with self.assertRaises(RuntimeError):
+            with cli_run('rebuild-scores'):
+                raise RuntimeError('Database went away')
+
+        self.assertEqual(self.read()[0]['status'], 'failed')
@@ -0,0 +1,341 @@
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app import app, db
+from app.enums import MasteryCalculation
+from app.models import Course, Outcome, OutcomeAttempt, OutcomeScore, User, UserPreferences
+from app.score_service import CALCULATIONS, ScoreService, rebuild_outcome_scores, record_outcome_attempts
+
+
+class ScoreTestBase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.create_all()
+
+        course = Course(canvas_id=123, name="Course 1")
+        teacher = User(name="Teacher", usertype_id=2, canvas_id=1)
+        s1 = User(name="Student 1", usertype_id=3, canvas_id=456)
+        s2 = User(name="Student 2", usertype_id=3, canvas_id=789)
+        s3 = User(name="Student 3", usertype_id=3, canvas_id=999)
+        o1 = Outcome(name="Outcome 1", canvas_id=11)
+        o2 = Outcome(name="Outcome 2", canvas_id=22)
+
+        db.session.add_all([course, teacher, s1, s2, s3, o1, o2])
+        db.session.commit()
+
+        prefs = UserPreferences(user_id=teacher.id, score_calculation_method=MasteryCalculation(2), mastery_score=3)
+        db.session.add(prefs)
+
+        for user in [teacher, s1, s2, s3]:
+            user.enroll(course)
+        course.outcomes.extend([o1, o2])
+
+        # Student 3 has no attempts at all.
+        scores = {
+            (456, 11): [1, 4, 2, 3, 5, 3, 6],
+            (456, 22): [3],
+            (789, 11): [1, 2, 3, 4],
+            (789, 22): [4, 3, 3, 1],
+        }
+        start = datetime(2022, 1, 1)
+        attempt_id = 1
+        for (user_id, outcome_id), values in scores.items():
+            for offset, score in enumerate(values):
+                db.session.add(OutcomeAttempt(
+                    user_canvas_id=user_id,
+                    outcome_canvas_id=outcome_id,
+                    attempt_canvas_id=attempt_id,
+                    score=score,
+                    occurred=start + timedelta(days=offset)
+                ))
+                attempt_id += 1
+
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def assertScoresMatchOutcomes(self, service):
+        """ Every stored score matches the <Outcome> method calculated from the attempts """
+        for method in CALCULATIONS:
+            scores = service.get_scores(method)
+            for student in service.students:
+                for outcome in service.outcomes:
+                    self.assertEqual(
+                        scores[student.canvas_id][outcome.canvas_id],
+                        getattr(outcome, method.name)(student.canvas_id)
+                    )
+
+
+class TestScoreService(ScoreTestBase):
+    def test_scores_match_outcome_methods(self):
+        rebuild_outcome_scores()
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+
+        self.assertEqual(set(service.get_scores(MasteryCalculation.AVERAGE).keys()), {456, 789, 999})
+        self.assertScoresMatchOutcomes(service)
+
+    def test_missing_attempts_are_none(self):
+        rebuild_outcome_scores()
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+
+        for method in CALCULATIONS:
+            self.assertEqual(service.get_scores(method)[999], {11: None, 22: None})
+
+    def test_matrix_matches_outcome_methods(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        matrix = ScoreService(course).get_matrix()
+
+        self.assertEqual(set(matrix.keys()), {456, 789, 999})
+
+        for outcome in course.outcomes.all():
+            for user_canvas_id, row in matrix.items():
+                for method in ['AVERAGE', 'DECAYING_AVERAGE', 'HIGHEST', 'HIGH_LAST_AVERAGE', 'MODE']:
+                    self.assertEqual(
+                        row[outcome.canvas_id][method],
+                        getattr(outcome, method)(user_canvas_id)
+                    )
+
+    def test_matrix_missing_attempts_are_none(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        matrix = ScoreService(course).get_matrix()
+
+        self.assertEqual(matrix[999][11], {
+            'AVERAGE': None,
+            'DECAYING_AVERAGE': None,
+            'HIGHEST': None,
+            'HIGH_LAST_AVERAGE': None,
+            'MODE': None
+        })
+
+    def test_attempts_loaded_in_one_query(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            service.get_matrix()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(statements), 1)
+
+    def test_unscored_attempts_are_skipped(self):
+        db.session.add(OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=22, attempt_canvas_id=200, score=None, occurred=datetime(2022, 3, 1)))
+        db.session.commit()
+        rebuild_outcome_scores()
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        outcome = Outcome.query.filter(Outcome.canvas_id == 22).first()
+        service = ScoreService(course)
+
+        self.assertIsNone(outcome.AVERAGE(999))
+        self.assertIsNone(service.get_scores(MasteryCalculation.AVERAGE)[999][22])
+        self.assertIsNone(service.get_matrix()[999][22]['AVERAGE'])
+        self.assertEqual(service.missing_scores(MasteryCalculation.AVERAGE), set())
+
+    def test_scores_loaded_in_one_query(self):
+        rebuild_outcome_scores()
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            service.get_scores(MasteryCalculation.DECAYING_AVERAGE)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(statements), 1)
+
+    def test_aggregate_scores_match_matrix(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+        matrix = service.get_matrix()
+
+        for method in MasteryCalculation:
+            if method is MasteryCalculation.NONE:
+                continue
+            scores = service.calculate_scores(method)
+            for user_canvas_id, row in matrix.items():
+                for outcome_canvas_id, expected in row.items():
+                    self.assertEqual(scores[user_canvas_id][outcome_canvas_id], expected[method.name])
+
+    def test_aggregates_return_one_row_per_pair(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        aggregates = ScoreService(course).get_aggregates()
+
+        # Student 3 has no attempts, so only four pairs come back.
+        self.assertEqual(len(aggregates), 4)
+        self.assertEqual(aggregates[(456, 11)], (7, 24, 6, 6))
+        self.assertEqual(aggregates[(789, 22)], (4, 11, 4, 1))
+
+    def test_aggregates_skip_unscored_attempts(self):
+        db.session.add_all([
+            # Only unscored attempts for this pair
+            OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=22, attempt_canvas_id=200, score=None, occurred=datetime(2022, 3, 1)),
+            # Unscored, and later than every scored attempt
+            OutcomeAttempt(user_canvas_id=456, outcome_canvas_id=11, attempt_canvas_id=201, score=None, occurred=datetime(2022, 3, 1)),
+        ])
+        db.session.commit()
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+        aggregates = service.get_aggregates()
+
+        self.assertNotIn((999, 22), aggregates)
+        self.assertEqual(aggregates[(456, 11)], (7, 24, 6, 6))
+        self.assertIsNone(service.calculate_scores(MasteryCalculation.AVERAGE)[999][22])
+        self.assertEqual(service.calculate_scores(MasteryCalculation.HIGH_LAST_AVERAGE)[456][11], 6.0)
+
+    def test_apply_scores_uses_preferences(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        teacher = User.query.filter(User.name == "Teacher").first()
+
+        rebuild_outcome_scores()
+        students = ScoreService(course).apply_scores(teacher)
+        student = [s for s in students if s.canvas_id == 456][0]
+
+        self.assertEqual(student.scores[0], {"outcome_canvas_id": 11, "score": 5.0})
+        self.assertEqual(student.scores[1], {"outcome_canvas_id": 22, "score": 3.0})
+
+
+class TestAttemptOrder(ScoreTestBase):
+    def setUp(self):
+        super().setUp()
+
+        # Canvas IDs and insert order don't follow the assessment order.
+        db.session.add_all([
+            OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=11, attempt_canvas_id=300, score=4, occurred=datetime(2022, 2, 3)),
+            OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=11, attempt_canvas_id=301, score=1, occurred=datetime(2022, 2, 1)),
+            OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=11, attempt_canvas_id=302, score=2, occurred=datetime(2022, 2, 2)),
+            # Assessed at the same time, so the Canvas ID decides which is last
+            OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=22, attempt_canvas_id=311, score=1, occurred=datetime(2022, 2, 1)),
+            OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=22, attempt_canvas_id=310, score=4, occurred=datetime(2022, 2, 1)),
+        ])
+        db.session.commit()
+        rebuild_outcome_scores()
+
+        self.course = Course.query.filter(Course.canvas_id == 123).first()
+
+    def test_latest_attempt_is_last(self):
+        outcome = Outcome.query.filter(Outcome.canvas_id == 11).first()
+        service = ScoreService(self.course)
+
+        # Scores in assessment order are [1, 2, 4]
+        self.assertEqual(outcome.DECAYING_AVERAGE(999), 3.1)
+        self.assertEqual(outcome.HIGH_LAST_AVERAGE(999), 4.0)
+        self.assertEqual(service.get_scores(MasteryCalculation.DECAYING_AVERAGE)[999][11], 3.1)
+        self.assertEqual(service.get_scores(MasteryCalculation.HIGH_LAST_AVERAGE)[999][11], 4.0)
+        self.assertEqual(service.get_matrix()[999][11]['DECAYING_AVERAGE'], 3.1)
+        self.assertEqual(service.get_matrix()[999][11]['HIGH_LAST_AVERAGE'], 4.0)
+
+    def test_attempt_id_breaks_ties(self):
+        outcome = Outcome.query.filter(Outcome.canvas_id == 22).first()
+        service = ScoreService(self.course)
+
+        # Scores in assessment order are [4, 1]
+        self.assertEqual(outcome.HIGH_LAST_AVERAGE(999), 2.5)
+        self.assertEqual(service.get_scores(MasteryCalculation.HIGH_LAST_AVERAGE)[999][22], 2.5)
+        self.assertEqual(service.get_matrix()[999][22]['HIGH_LAST_AVERAGE'], 2.5)
+
+    def test_every_path_agrees(self):
+        service = ScoreService(self.course)
+        matrix = service.get_matrix()
+
+        self.assertScoresMatchOutcomes(service)
+        for method in CALCULATIONS:
+            stored = service.get_scores(method)
+            calculated = service.calculate_scores(method)
+            for outcome_canvas_id in [11, 22]:
+                self.assertEqual(stored[999][outcome_canvas_id], matrix[999][outcome_canvas_id][method.name])
+                self.assertEqual(calculated[999][outcome_canvas_id], matrix[999][outcome_canvas_id][method.name])
+
+
+class TestMaterializedScores(ScoreTestBase):
+    def test_rebuild_matches_calculated_scores(self):
+        self.assertEqual(rebuild_outcome_scores(), 4)
+
+        # One row for each calculation method
+        self.assertEqual(OutcomeScore.query.count(), 20)
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+        self.assertScoresMatchOutcomes(service)
+
+        for method in MasteryCalculation:
+            self.assertEqual(service.get_scores(method), service.calculate_scores(method))
+
+    def test_record_new_attempts(self):
+        rebuild_outcome_scores()
+
+        attempts = [
+            dict(user_canvas_id=456, outcome_canvas_id=22, attempt_canvas_id=100, score=1, occurred=datetime(2022, 3, 1)),
+            dict(user_canvas_id=456, outcome_canvas_id=22, attempt_canvas_id=101, score=4, occurred=datetime(2022, 3, 2)),
+            # First attempt for this student, so the pair is built from scratch
+            dict(user_canvas_id=999, outcome_canvas_id=11, attempt_canvas_id=102, score=2, occurred=datetime(2022, 3, 1)),
+        ]
+        db.session.execute(OutcomeAttempt.__table__.insert(), attempts)
+        self.assertEqual(record_outcome_attempts(attempts), 2)
+        db.session.commit()
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        service = ScoreService(course)
+        self.assertScoresMatchOutcomes(service)
+
+        self.assertEqual(service.get_scores(MasteryCalculation.HIGH_LAST_AVERAGE)[456][22], 4.0)
+        self.assertEqual(service.get_scores(MasteryCalculation.HIGHEST)[999][11], 2)
+
+    def test_out_of_order_attempt_does_not_replace_last(self):
+        rebuild_outcome_scores()
+
+        attempt = dict(user_canvas_id=789, outcome_canvas_id=11, attempt_canvas_id=100, score=1, occurred=datetime(2021, 1, 1))
+        db.session.execute(OutcomeAttempt.__table__.insert(), [attempt])
+        record_outcome_attempts([attempt])
+        db.session.commit()
+
+        row = OutcomeScore.query.filter_by(
+            user_canvas_id=789,
+            outcome_canvas_id=11,
+            calculation_method=MasteryCalculation.HIGH_LAST_AVERAGE
+        ).first()
+
+        self.assertEqual(row.attempt_count, 5)
+        self.assertEqual(row.last_score, 4)
+        self.assertEqual(row.score, 4.0)
+
+    def test_late_attempt_breaks_mode_ties_like_a_rebuild(self):
+        db.session.add(OutcomeAttempt(user_canvas_id=999, outcome_canvas_id=22, attempt_canvas_id=200, score=3, occurred=datetime(2022, 3, 2)))
+        db.session.commit()
+        rebuild_outcome_scores()
+
+        # Synced later, but assessed before the stored attempt. In assessment order the
+        # scores are [2, 3], so the MODE tie goes to 2.
+        attempt = dict(user_canvas_id=999, outcome_canvas_id=22, attempt_canvas_id=201, score=2, occurred=datetime(2022, 3, 1))
+        db.session.execute(OutcomeAttempt.__table__.insert(), [attempt])
+        record_outcome_attempts([attempt])
+        db.session.commit()
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        outcome = Outcome.query.filter(Outcome.canvas_id == 22).first()
+        incremental = ScoreService(course).get_scores(MasteryCalculation.MODE)[999][22]
+
+        rebuild_outcome_scores()
+
+        self.assertEqual(incremental, 2)
+        self.assertEqual(ScoreService(course).get_scores(MasteryCalculation.MODE)[999][22], 2)
+        self.assertEqual(outcome.MODE(999), 2)
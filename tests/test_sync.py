@@ -0,0 +1,791 @@
+import logging
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from sqlalchemy import event
+
+from app import app, db
+from app.canvas_auth_service import CanvasAuthService, CanvasClients
+from app.canvas_sync_service import CanvasSyncService, attempts_skipped, attempts_total, courses_synced, grade_posts
+from app.metrics import registry
+from app.models import Assignment, Course, Outcome, OutcomeAttempt, User, UserAssignment
+from app.util import canvas_score, parse_canvas_datetime
+
+# Registers the CLI commands. This has to happen before the app handles a request.
+import masteryhelper  # noqa: F401
+
+
+def outcome_result(id, user_id, outcome_id, score=3.0, submitted="2022-03-04T17:46:29Z"):
+    """ Build an object shaped like a Canvas outcome result """
+    return SimpleNamespace(
+        id=id,
+        links={
+            'user': str(user_id),
+            'learning_outcome': str(outcome_id),
+            'alignment': 'assignment_1'
+        },
+        mastery=score is not None and score >= 3,
+        score=score,
+        submitted_or_assessed_at=submitted
+    )
+
+
+class FakeProgress:
+    """ Canvas progress that moves through each state on every query """
+    def __init__(self, states, message=None):
+        self.states = list(states)
+        self.workflow_state = self.states.pop(0)
+        self.message = message
+        self.queries = 0
+
+    def query(self):
+        self.queries += 1
+        self.workflow_state = self.states.pop(0)
+        return self
+
+
+class FakeCanvasAssignment:
+    def __init__(self, id, progress):
+        self.id = id
+        self.progress = progress
+        self.updates = []
+
+    def submissions_bulk_update(self, **kwargs):
+        self.updates.append(kwargs)
+        return self.progress
+
+    def get_submission(self, user_id):
+        raise AssertionError('Grades should be posted in bulk')
+
+
+class FakeCanvasCourse:
+    def __init__(self, id, results=None, enrollments=None, assignments=None):
+        self.id = id
+        self.results = results or []
+        self.enrollments = enrollments or []
+        self.assignments = assignments or {}
+
+    def get_assignment(self, assignment_id):
+        return self.assignments[assignment_id]
+
+    def get_outcome_results(self, **kwargs):
+        return iter(self.results)
+
+    def get_enrollments(self, **kwargs):
+        return iter(self.enrollments)
+
+
+class FakeCanvas:
+    def __init__(self, course):
+        self.course = course
+
+    def get_course(self, course_id):
+        return self.course
+
+
+class SyncTestBase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.create_all()
+
+        course = Course(canvas_id=123, name="Course 1")
+        student = User(name="Student", usertype_id=3, canvas_id=456)
+        outcome = Outcome(name="Outcome 1", canvas_id=11)
+
+        db.session.add_all([course, student, outcome])
+        db.session.commit()
+
+        student.enroll(course)
+        course.outcomes.append(outcome)
+        db.session.commit()
+
+        # The Canvas client is swapped for a fake course in each test.
+        app.config['CANVAS_URI'] = 'https://canvas.test/'
+        app.config['CANVAS_KEY'] = 'test-token'
+        self.service = CanvasSyncService('server_only')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def use_course(self, canvas_course):
+        self.service.canvas = FakeCanvas(canvas_course)
+
+
+class TestOutcomeAttemptSync(SyncTestBase):
+    def test_store_new_attempts(self):
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11),
+            outcome_result(2, 456, 11, score=4.0),
+        ]))
+
+        result = self.service.get_outcome_attempts(123, [11])
+
+        self.assertEqual(result, "Stored 2 new attempts.")
+        self.assertEqual(OutcomeAttempt.query.count(), 2)
+
+    def test_skip_duplicates_unknown_users_and_unscored(self):
+        db.session.add(OutcomeAttempt(user_canvas_id=456, outcome_canvas_id=11, attempt_canvas_id=1, score=3))
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11),
+            outcome_result(2, 999, 11),
+            outcome_result(3, 456, 11, score=None),
+            outcome_result(4, 456, 11),
+        ]))
+
+        with self.assertLogs(app.logger, level='INFO') as logs:
+            result = self.service.get_outcome_attempts(123, [11])
+
+        self.assertEqual(result, "Stored 1 new attempts.")
+        self.assertEqual(OutcomeAttempt.query.count(), 2)
+        self.assertIn('1 duplicates and 1 from unknown users', logs.output[-1])
+
+    def test_attempts_are_counted(self):
+        registry.clear()
+        db.session.add(OutcomeAttempt(user_canvas_id=456, outcome_canvas_id=11, attempt_canvas_id=1, score=3))
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11),
+            outcome_result(2, 999, 11),
+            outcome_result(3, 456, 11, score=None),
+            outcome_result(4, 456, 11),
+        ]))
+
+        self.service.get_outcome_attempts(123, [11])
+
+        self.assertEqual(attempts_total.value(course='123', status='fetched'), 4)
+        self.assertEqual(attempts_total.value(course='123', status='stored'), 1)
+        self.assertEqual(attempts_skipped.value(course='123', reason='duplicate'), 1)
+        self.assertEqual(attempts_skipped.value(course='123', reason='unknown_user'), 1)
+        self.assertEqual(attempts_skipped.value(course='123', reason='unscored'), 1)
+
+    def test_user_checks_run_per_chunk(self):
+        self.service.chunk_size = 10
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(id, 456, 11) for id in range(1, 26)
+        ]))
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            self.service.get_outcome_attempts(123, [11])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        attempt_checks = [s for s in statements if 'FROM outcome_attempt' in s and 'attempt_canvas_id IN' in s]
+        user_checks = [s for s in statements if 'FROM user' in s and 'canvas_id IN' in s]
+
+        # 25 results in chunks of 10 is three chunks, each checked with one query per table.
+        self.assertEqual(len(attempt_checks), 3)
+        self.assertEqual(len(user_checks), 3)
+        self.assertEqual(OutcomeAttempt.query.count(), 25)
+
+
+    def test_duplicates_rebuild_scores(self):
+        from app.enums import MasteryCalculation
+        from app.models import OutcomeScore
+        from app.score_service import rebuild_outcome_scores
+
+        db.session.add(OutcomeAttempt(
+            user_canvas_id=456, outcome_canvas_id=11, attempt_canvas_id=1, score=2,
+            occurred=datetime(2022, 3, 1)
+        ))
+        db.session.commit()
+        rebuild_outcome_scores()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, score=2.0, submitted="2022-03-01T00:00:00Z"),
+            outcome_result(2, 456, 11, score=4.0, submitted="2022-03-02T00:00:00Z"),
+        ]))
+
+        self.service.get_outcome_attempts(123, [11])
+
+        # The stored attempt isn't counted twice
+        average = OutcomeScore.query.filter_by(user_canvas_id=456, outcome_canvas_id=11, calculation_method=MasteryCalculation.AVERAGE).one()
+        self.assertEqual(average.attempt_count, 2)
+        self.assertEqual(average.score, 3.0)
+
+
+    def test_only_new_attempts_are_folded(self):
+        from app.score_service import rebuild_outcome_scores
+
+        db.session.add(OutcomeAttempt(
+            user_canvas_id=456, outcome_canvas_id=11, attempt_canvas_id=1, score=2,
+            occurred=datetime(2022, 3, 1)
+        ))
+        db.session.commit()
+        rebuild_outcome_scores()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, score=2.0, submitted="2022-03-01T00:00:00Z"),
+            outcome_result(2, 456, 11, score=4.0, submitted="2022-03-02T00:00:00Z"),
+        ]))
+
+        with mock.patch('app.score_service.record_outcome_attempts') as record:
+            self.service.get_outcome_attempts(123, [11])
+
+        rows, = record.call_args.args
+        self.assertEqual([row["attempt_canvas_id"] for row in rows], [2])
+        self.assertEqual(record.call_args.kwargs, {"rebuild": False})
+
+    def test_fractional_scores_match_a_rebuild(self):
+        from app.enums import MasteryCalculation
+        from app.models import OutcomeScore
+        from app.score_service import rebuild_outcome_scores
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, score=2.5, submitted="2022-03-01T00:00:00Z"),
+            outcome_result(2, 456, 11, score=3.5, submitted="2022-03-02T00:00:00Z"),
+        ]))
+
+        self.service.get_outcome_attempts(123, [11])
+
+        def rows():
+            return {
+                row.calculation_method: (row.total, row.highest, row.last_score, row.histogram, row.score)
+                for row in OutcomeScore.query.filter_by(user_canvas_id=456, outcome_canvas_id=11)
+            }
+
+        synced = rows()
+        rebuild_outcome_scores()
+
+        self.assertEqual(synced, rows())
+        self.assertEqual(synced[MasteryCalculation.HIGHEST][1], 4)
+        self.assertEqual([attempt.score for attempt in OutcomeAttempt.query.order_by(OutcomeAttempt.id)], [3, 4])
+
+    def test_timestamps_stored_as_utc(self):
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, submitted="2022-03-04T17:46:29.250Z"),
+            outcome_result(2, 456, 11, submitted="2022-03-04T12:46:29-05:00"),
+        ]))
+
+        self.service.get_outcome_attempts(123, [11])
+
+        occurred = [attempt.occurred for attempt in OutcomeAttempt.query.order_by(OutcomeAttempt.attempt_canvas_id)]
+        self.assertEqual(occurred, [datetime(2022, 3, 4, 17, 46, 29, 250000), datetime(2022, 3, 4, 17, 46, 29)])
+
+
+class TestCanvasDatetime(unittest.TestCase):
+    def test_utc(self):
+        self.assertEqual(
+            parse_canvas_datetime("2022-03-04T17:46:29Z"),
+            datetime(2022, 3, 4, 17, 46, 29, tzinfo=timezone.utc)
+        )
+
+    def test_fractional_seconds(self):
+        cases = {
+            "2022-03-04T17:46:29.5Z": 500000,
+            "2022-03-04T17:46:29.123Z": 123000,
+            "2022-03-04T17:46:29.123456Z": 123456,
+            "2022-03-04T17:46:29.1234567Z": 123456,
+        }
+        for value, microsecond in cases.items():
+            with self.subTest(value=value):
+                self.assertEqual(parse_canvas_datetime(value).microsecond, microsecond)
+
+    def test_offsets_convert_to_utc(self):
+        expected = datetime(2022, 3, 4, 17, 46, 29, tzinfo=timezone.utc)
+
+        self.assertEqual(parse_canvas_datetime("2022-03-04T12:46:29-05:00"), expected)
+        self.assertEqual(parse_canvas_datetime("2022-03-05T03:16:29.000+09:30"), expected)
+        self.assertEqual(parse_canvas_datetime("2022-03-04T17:46:29+00:00").utcoffset(), timedelta(0))
+
+    def test_naive_is_utc(self):
+        self.assertEqual(parse_canvas_datetime("2022-03-04T17:46:29").tzinfo, timezone.utc)
+
+
+class TestCanvasScore(unittest.TestCase):
+    def test_rounds_half_away_from_zero(self):
+        self.assertEqual(canvas_score(3.0), 3)
+        self.assertEqual(canvas_score(2.5), 3)
+        self.assertEqual(canvas_score(3.5), 4)
+        self.assertEqual(canvas_score(2.4999), 2)
+        self.assertIsInstance(canvas_score(4.0), int)
+
+
+class TestStreamingSync(SyncTestBase):
+    def test_failed_sync_keeps_committed_chunks(self):
+        self.service.chunk_size = 10
+
+        def results():
+            for id in range(1, 16):
+                yield outcome_result(id, 456, 11, submitted="2022-03-06T08:00:00Z")
+            raise ConnectionError("Canvas went away")
+
+        course = FakeCanvasCourse(123)
+        course.get_outcome_results = lambda **kwargs: results()
+        self.use_course(course)
+
+        with self.assertRaises(ConnectionError):
+            self.service.get_outcome_attempts(123, [11])
+        db.session.rollback()
+
+        # The first chunk was committed before the failure, but the watermark didn't move.
+        self.assertEqual(OutcomeAttempt.query.count(), 10)
+        self.assertIsNone(Course.query.filter(Course.canvas_id == 123).first().results_synced_at)
+
+    def test_rerun_after_failure_skips_stored_attempts(self):
+        self.service.chunk_size = 10
+        db.session.execute(OutcomeAttempt.__table__.insert(), [
+            {"user_canvas_id": 456, "outcome_canvas_id": 11, "attempt_canvas_id": id, "score": 3} for id in range(1, 11)
+        ])
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(id, 456, 11) for id in range(1, 26)
+        ]))
+
+        result = self.service.get_outcome_attempts(123, [11])
+
+        self.assertEqual(result, "Stored 15 new attempts.")
+        self.assertEqual(OutcomeAttempt.query.count(), 25)
+
+
+class TestIncrementalSync(SyncTestBase):
+    def test_full_course_sync_sets_watermark(self):
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, submitted="2022-03-04T17:46:29Z"),
+            outcome_result(2, 456, 11, submitted="2022-03-06T08:00:00Z"),
+        ]))
+
+        self.service.get_outcome_attempts(123, [11])
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        self.assertEqual(course.results_synced_at, datetime(2022, 3, 6, 8, 0, 0))
+        self.assertIsNotNone(course.updated_at)
+
+    def test_results_graded_after_the_last_sync_are_stored(self):
+        # Grading an old submission gives a result dated before the last sync, but within
+        # the lookback window.
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        course.results_synced_at = datetime(2022, 3, 5)
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, submitted="2022-03-04T17:46:29Z"),
+            outcome_result(2, 456, 11, submitted="2022-03-06T08:00:00Z"),
+        ]))
+
+        result = self.service.get_outcome_attempts(123, [11])
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        self.assertEqual(result, "Stored 2 new attempts.")
+        self.assertEqual(course.results_synced_at, datetime(2022, 3, 6, 8, 0, 0))
+
+    def test_results_before_the_lookback_are_skipped(self):
+        registry.clear()
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        course.results_synced_at = datetime(2022, 6, 1)
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, submitted="2022-03-04T17:46:29Z"),
+            outcome_result(2, 456, 11, submitted="2022-05-20T08:00:00Z"),
+        ]))
+
+        result = self.service.get_outcome_attempts(123, [11])
+
+        self.assertEqual(result, "Stored 1 new attempts.")
+        self.assertEqual(attempts_skipped.value(course='123', reason='older'), 1)
+
+        # A full sync reads everything
+        result = self.service.get_outcome_attempts(123, [11], full=True)
+
+        self.assertEqual(result, "Stored 1 new attempts.")
+        self.assertEqual(OutcomeAttempt.query.count(), 2)
+        self.assertEqual(Course.query.filter(Course.canvas_id == 123).first().results_synced_at, datetime(2022, 6, 1))
+
+    def test_lookback_is_configurable(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        course.results_synced_at = datetime(2022, 3, 10)
+        db.session.commit()
+        app.config['RESULTS_SYNC_LOOKBACK_DAYS'] = 1
+        self.addCleanup(app.config.pop, 'RESULTS_SYNC_LOOKBACK_DAYS')
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, submitted="2022-03-04T17:46:29Z"),
+            outcome_result(2, 456, 11, submitted="2022-03-09T08:00:00Z"),
+        ]))
+
+        self.assertEqual(self.service.get_outcome_attempts(123, [11]), "Stored 1 new attempts.")
+
+    def test_partial_sync_ignores_watermark(self):
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        course.outcomes.append(Outcome(name="Outcome 2", canvas_id=22))
+        course.results_synced_at = datetime(2022, 6, 1)
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 22, submitted="2022-03-04T17:46:29Z"),
+            outcome_result(2, 456, 22, submitted="2022-07-01T00:00:00Z"),
+        ]))
+
+        result = self.service.get_outcome_attempts(123, [22])
+
+        # Outcome 11 wasn't read, so the course watermark stays where it was
+        self.assertEqual(result, "Stored 2 new attempts.")
+        self.assertEqual(Course.query.filter(Course.canvas_id == 123).first().results_synced_at, datetime(2022, 6, 1))
+
+    def test_unknown_users_do_not_move_watermark(self):
+        self.use_course(FakeCanvasCourse(123, results=[
+            outcome_result(1, 456, 11, submitted="2022-03-04T17:46:29Z"),
+            outcome_result(2, 999, 11, submitted="2022-03-06T08:00:00Z"),
+        ]))
+
+        self.service.get_outcome_attempts(123, [11])
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        self.assertEqual(course.results_synced_at, datetime(2022, 3, 4, 17, 46, 29))
+
+        # Once the student is enrolled their result is stored on the next sync.
+        db.session.add(User(name="Student 2", usertype_id=3, canvas_id=999))
+        db.session.commit()
+
+        result = self.service.get_outcome_attempts(123, [11])
+
+        self.assertEqual(result, "Stored 1 new attempts.")
+        self.assertEqual(OutcomeAttempt.query.count(), 2)
+
+
+class TestCanvasClients(unittest.TestCase):
+    def test_same_token_reuses_client(self):
+        clients = CanvasClients()
+
+        first = clients.get('https://canvas.test/', 'token-a')
+
+        self.assertIs(clients.get('https://canvas.test/', 'token-a'), first)
+        self.assertIsNot(clients.get('https://canvas.test/', 'token-b'), first)
+        self.assertIsNot(clients.get('https://other.test/', 'token-a'), first)
+
+    def test_pooled_adapter(self):
+        clients = CanvasClients(pool_size=4)
+
+        session = clients.get('https://canvas.test/', 'token-a')._Canvas__requester._session
+
+        self.assertEqual(session.get_adapter('https://canvas.test/')._pool_maxsize, 4)
+
+    def test_least_recently_used_is_evicted(self):
+        clients = CanvasClients(max_clients=2)
+
+        first = clients.get('https://canvas.test/', 'token-a')
+        clients.get('https://canvas.test/', 'token-b')
+        clients.get('https://canvas.test/', 'token-a')
+        clients.get('https://canvas.test/', 'token-c')
+
+        self.assertEqual(len(clients), 2)
+        self.assertIs(clients.get('https://canvas.test/', 'token-a'), first)
+
+    def test_idle_tokens_expire(self):
+        clients = CanvasClients(ttl=60)
+
+        with mock.patch('app.canvas_auth_service.time.monotonic', return_value=1000):
+            first = clients.get('https://canvas.test/', 'token-a')
+        with mock.patch('app.canvas_auth_service.time.monotonic', return_value=1061):
+            self.assertIsNot(clients.get('https://canvas.test/', 'token-a'), first)
+
+    def test_server_token_is_shared(self):
+        self.assertIs(
+            CanvasAuthService('server_only').init_canvas(),
+            CanvasAuthService('server_only').init_canvas()
+        )
+
+
+def enrollment(user_id, name):
+    """ Build an object shaped like a Canvas enrollment """
+    return SimpleNamespace(user_id=user_id, user={'sortable_name': name})
+
+
+class TestEnrollmentSync(SyncTestBase):
+    def test_enroll_new_and_existing_students(self):
+        db.session.add(User(name="Existing", usertype_id=3, canvas_id=457))
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, enrollments=[
+            enrollment(456, "Student"),
+            enrollment(457, "Existing"),
+            enrollment(458, "New, Student"),
+            # Enrolled in a second section
+            enrollment(458, "New, Student"),
+        ]))
+
+        course = self.service.get_enrollments(123)
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(User.query.filter(User.canvas_id == 458).one().name, "New, Student")
+        self.assertEqual(sorted(user.canvas_id for user in course.enrollments), [456, 457, 458])
+
+    def test_dropped_students_are_removed(self):
+        from app.models import OutcomeAttempt
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        teacher = User(name="Teacher", usertype_id=2, canvas_id=100)
+        db.session.add(teacher)
+        db.session.commit()
+        teacher.enroll(course)
+        db.session.add(OutcomeAttempt(user_canvas_id=456, outcome_canvas_id=11, attempt_canvas_id=1, score=3))
+        db.session.commit()
+
+        self.use_course(FakeCanvasCourse(123, enrollments=[enrollment(458, "New, Student")]))
+
+        course = self.service.get_enrollments(123)
+
+        # The teacher stays, and the dropped student keeps their user and results
+        self.assertEqual(sorted(user.canvas_id for user in course.enrollments), [100, 458])
+        self.assertIsNotNone(User.query.filter(User.canvas_id == 456).first())
+        self.assertEqual(OutcomeAttempt.query.count(), 1)
+
+    def test_concurrent_enrollment_is_not_duplicated(self):
+        from app.models import user_courses
+
+        existing = User(name="Existing", usertype_id=3, canvas_id=457)
+        db.session.add(existing)
+        db.session.commit()
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        course_id, user_id = course.id, existing.id
+
+        self.use_course(FakeCanvasCourse(123, enrollments=[enrollment(456, "Student"), enrollment(457, "Existing")]))
+
+        # Another sync enrolls the student after this one has read the local enrollments
+        get_user_ids = self.service._CanvasSyncService__get_user_ids
+
+        def racing_get_user_ids(canvas_ids):
+            db.session.execute(user_courses.insert(), [{"course_id": course_id, "user_id": user_id}])
+            return get_user_ids(canvas_ids)
+
+        with mock.patch.object(self.service, '_CanvasSyncService__get_user_ids', side_effect=racing_get_user_ids):
+            self.service.get_enrollments(123)
+
+        rows = db.session.query(user_courses).filter(user_courses.c.course_id == course_id, user_courses.c.user_id == user_id).count()
+        self.assertEqual(rows, 1)
+
+    def test_concluded_course_keeps_students(self):
+        # Canvas lists no active enrollments once a course is concluded
+        self.use_course(FakeCanvasCourse(123, enrollments=[]))
+
+        with self.assertLogs(app.logger, level='WARNING'):
+            course = self.service.get_enrollments(123)
+
+        self.assertEqual([user.canvas_id for user in course.enrollments], [456])
+
+    def test_unchanged_enrollments_are_not_written(self):
+        self.use_course(FakeCanvasCourse(123, enrollments=[enrollment(456, "Student")]))
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            self.service.get_enrollments(123)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertFalse([s for s in statements if not s.startswith('SELECT')])
+
+    def test_queries_do_not_grow_with_students(self):
+        self.use_course(FakeCanvasCourse(123, enrollments=[enrollment(456, "Student")] + [
+            enrollment(1000 + id, f"Student {id}") for id in range(50)
+        ]))
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            self.service.get_enrollments(123)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        # Course, enrollments, existing users, user insert, new user IDs, enrollment insert
+        # and the course version
+        self.assertLessEqual(len(statements), 7)
+        self.assertEqual(Course.query.filter(Course.canvas_id == 123).one().enrollments.count(), 51)
+
+
+class FakeSyncService:
+    """ Stands in for CanvasSyncService in `flask sync`. Records the thread and session each
+    course ran in, and fails the course in `failing`.
+    """
+    page_workers = 1
+
+    def __init__(self, failing):
+        self.failing = failing
+        self.sessions = {}
+        self.synced = []
+        self.lock = threading.Lock()
+
+    def set_connection_pool_size(self, size):
+        pass
+
+    def get_enrollments(self, course_id):
+        with self.lock:
+            self.sessions[course_id] = (threading.get_ident(), db.session())
+        if course_id == self.failing:
+            raise RuntimeError("Canvas is down")
+
+    def get_outcome_attempts(self, course_id, outcome_ids, full=False):
+        with self.lock:
+            self.synced.append(course_id)
+        return "Synced"
+
+
+class TestSyncCommand(SyncTestBase):
+    def setUp(self):
+        super().setUp()
+
+        outcome = Outcome.query.first()
+        for canvas_id in (124, 125):
+            course = Course(canvas_id=canvas_id, name="Course {}".format(canvas_id))
+            course.outcomes.append(outcome)
+            db.session.add(course)
+        db.session.commit()
+        self.failing_id = Course.query.filter(Course.canvas_id == 124).one().id
+
+        registry.clear()
+        self.log_level = app.logger.level
+
+    def tearDown(self):
+        app.logger.setLevel(self.log_level)
+        registry.clear()
+        super().tearDown()
+
+    def run_sync(self, service, *args):
+        calls = []
+        rollback, remove = db.session.rollback, db.session.remove
+
+        def record(name, method):
+            def call():
+                calls.append((name, threading.get_ident(), db.session()))
+                return method()
+            return call
+
+        with mock.patch('app.canvas_sync_service.CanvasSyncService', return_value=service), \
+                mock.patch('masteryhelper.RotatingFileHandler', return_value=logging.NullHandler()), \
+                mock.patch.object(db.session, 'rollback', side_effect=record('rollback', rollback)), \
+                mock.patch.object(db.session, 'remove', side_effect=record('remove', remove)), \
+                self.assertLogs(app.logger, level='INFO') as logs:
+            result = app.test_cli_runner().invoke(args=['sync', *args])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        return calls, logs.output
+
+    def test_failed_course_does_not_stop_the_others(self):
+        service = FakeSyncService(failing=124)
+
+        calls, output = self.run_sync(service, '--workers', '2')
+
+        self.assertEqual(sorted(service.synced), [123, 125])
+        self.assertEqual(courses_synced.value(result='completed'), 2)
+        self.assertEqual(courses_synced.value(result='failed'), 1)
+        self.assertTrue(any('Sync failed for course {}'.format(self.failing_id) in line for line in output))
+        self.assertTrue(any('1 failed: [{}]'.format(self.failing_id) in line for line in output))
+
+    def test_each_thread_cleans_up_its_own_session(self):
+        service = FakeSyncService(failing=124)
+
+        calls, output = self.run_sync(service, '--workers', '2')
+
+        self.assertEqual(len(service.sessions), 3)
+        self.assertEqual(len({id(session) for _, session in service.sessions.values()}), 3)
+        for canvas_id, (thread, session) in service.sessions.items():
+            self.assertNotEqual(thread, threading.get_ident())
+            self.assertIn(('remove', thread, session), calls)
+
+        rollbacks = [(thread, session) for name, thread, session in calls if name == 'rollback']
+        self.assertEqual(rollbacks, [service.sessions[124]])
+
+
+class TestGradePosting(SyncTestBase):
+    def setUp(self):
+        super().setUp()
+        self.service.progress_interval = 0
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        db.session.add(User(name="Student 2", usertype_id=3, canvas_id=789))
+        assignment = Assignment(canvas_id=55, name="Assignment 1", points_possible=10)
+        assignment.course.append(course)
+        db.session.add(assignment)
+        db.session.add_all([
+            UserAssignment(user_id=456, assignment_id=55, score=10),
+            UserAssignment(user_id=789, assignment_id=55, score=0),
+        ])
+        db.session.commit()
+
+    def test_post_grades_in_one_request(self):
+        canvas_assignment = FakeCanvasAssignment(55, FakeProgress(['queued', 'running', 'completed']))
+        self.use_course(FakeCanvasCourse(123, assignments={55: canvas_assignment}))
+
+        result = self.service.post_assignment_submission(Assignment.query.get(1))
+
+        self.assertEqual(len(canvas_assignment.updates), 1)
+        self.assertEqual(canvas_assignment.updates[0]['grade_data'], {
+            '456': {'posted_grade': 10},
+            '789': {'posted_grade': 0},
+        })
+        self.assertEqual(canvas_assignment.progress.queries, 2)
+        self.assertEqual(result['posted'], 2)
+        self.assertEqual(result['failed'], [])
+
+    def test_posts_are_counted(self):
+        registry.clear()
+        progress = FakeProgress(['queued', 'failed'], message='Grading period is closed')
+        self.use_course(FakeCanvasCourse(123, assignments={55: FakeCanvasAssignment(55, progress)}))
+
+        with self.assertLogs(app.logger, level='ERROR'):
+            self.service.post_assignment_submission(Assignment.query.get(1))
+
+        self.assertEqual(grade_posts.value(result='succeeded'), 0)
+        self.assertEqual(grade_posts.value(result='failed'), 2)
+
+    def test_report_failed_students(self):
+        progress = FakeProgress(['queued', 'failed'], message='Grading period is closed')
+        self.use_course(FakeCanvasCourse(123, assignments={55: FakeCanvasAssignment(55, progress)}))
+
+        with self.assertLogs(app.logger, level='ERROR'):
+            result = self.service.post_assignment_submission(Assignment.query.get(1))
+
+        self.assertEqual(result['posted'], 0)
+        self.assertEqual(sorted(result['failed']), [456, 789])
+        self.assertEqual(result['message'], 'Grading period is closed')
+
+    def test_only_changed_grades_are_posted(self):
+        canvas_assignment = FakeCanvasAssignment(55, FakeProgress(['completed']))
+        self.use_course(FakeCanvasCourse(123, assignments={55: canvas_assignment}))
+
+        self.service.post_assignment_submission(Assignment.query.get(1))
+        self.assertEqual(UserAssignment.query.filter(UserAssignment.posted_at.isnot(None)).count(), 2)
+
+        # Nothing changed, so Canvas isn't called at all
+        result = self.service.post_assignment_submission(Assignment.query.get(1))
+        self.assertEqual(len(canvas_assignment.updates), 1)
+        self.assertEqual(result['posted'], 0)
+
+        UserAssignment.query.filter_by(user_id=789).first().score = 10
+        db.session.commit()
+
+        self.service.post_assignment_submission(Assignment.query.get(1))
+        self.assertEqual(len(canvas_assignment.updates), 2)
+        self.assertEqual(canvas_assignment.updates[1]['grade_data'], {'789': {'posted_grade': 10}})
+
+    def test_failed_grades_are_posted_again(self):
+        canvas_assignment = FakeCanvasAssignment(55, FakeProgress(['failed']))
+        self.use_course(FakeCanvasCourse(123, assignments={55: canvas_assignment}))
+
+        with self.assertLogs(app.logger, level='ERROR'):
+            self.service.post_assignment_submission(Assignment.query.get(1))
+
+        self.assertTrue(all(row.is_dirty for row in UserAssignment.query.all()))
@@ -122,4 +122,17 @@ class TestUserCourseAPI(unittest.TestCase):
         resp = self.client.get('/users/123/courses')
 
         self.assertTrue(resp.status_code == 200)
-        self.assertEqual(len(resp.json), 1)
\ No newline at end of file
+        self.assertEqual(len(resp.json), 1)
+
+    def test_get_user_courses_not_modified(self):
+        etag = self.client.get('/users/123/courses').headers['ETag']
+
+        resp = self.client.get('/users/123/courses', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        course = Course.query.filter(Course.canvas_id == 123).first()
+        course.bump_version()
+        db.session.commit()
+
+        resp = self.client.get('/users/123/courses', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
\ No newline at end of file